@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Vega CRM - нагрузочный прогон всех вариантов сервера
+
+Заполняет SQLite заданным числом объектов, гоняет каждый GET endpoint
+каждого сервера через in-process клиент (ASGI для FastAPI, WSGI для Flask)
+с параллельной нагрузкой и печатает p50/p95/p99, RPS и пиковый RSS.
+Результаты можно сохранить как эталон и сравнивать с ним следующие прогоны.
+
+Примеры:
+    python benchmark.py --objects 10000 --requests 500 --concurrency 16
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select
+
+# Все варианты сервера из репозитория
+SERVER_MODULES = [
+    "railway_server",
+    "bulletproof_server",
+    "absolute_simple_server",
+    "hello_railway",
+    "ultra_simple",
+    "ultra_simple_railway",
+    "test_simple_server",
+]
+
+# Пути, которые не несут нагрузки API, и потоки, которые не заканчиваются (SSE)
+SKIPPED_PATHS = {"/docs", "/redoc", "/openapi.json", "/docs/oauth2-redirect", "/api/events"}
+
+# Обязательные параметры найденных endpoints: без них ответ - 400/422, а не нагрузка
+PATH_QUERIES = {
+    "/api/objects/search": "q=резервуар",
+    "/api/objects/nearby": "location=Сургут",
+    "/api/tools/available": "kind=pump&from=2026-03-01T00:00:00&to=2026-03-08T00:00:00",
+}
+
+# Параметризованные запросы сверх автоматически найденных GET endpoints
+EXTRA_PATHS = {
+    "railway_server": [
+        "/api/objects?limit=1000",
+        "/api/objects?status=in_progress&fields=id,name,progress",
+        "/api/gantt?from=2026-01-01&to=2026-03-31",
+        "/api/gantt?zoom=month",
+    ],
+}
+
+STATUSES = ("planning", "in_progress", "completed")
+LOCATIONS = ("Екатеринбург", "Челябинск", "Сабетта, ЯНАО", "Варандей", "Кемерово", "Тюмень", "Сургут")
+CUSTOMERS = ("ООО Нефтегаз", "АО Энергетика", "ЯНАО Терминал", "ООО Варандейский терминал", "АО Кузбассразрезуголь")
+
+
+def current_rss_mb():
+    """Текущий RSS процесса; без /proc - пиковый за всё время"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class RssSampler:
+    """Фоновый замер пикового RSS на время прогона одного endpoint"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+
+def seed_database(server, count, batch_size=10000):
+    """Создаёт схему и заполняет objects синтетическими данными через пакетную запись
+    сервера (write_objects_sync): сводки, журнал изменений, прогноз сроков и координаты
+    получаются такими же, как после импорта через API"""
+    server.create_tables()
+    table = server.Object.__table__
+    with server.engine.begin() as connection:
+        # Объекты прошлого прогона удаляются так же, как их удалил бы сервер
+        existing = [
+            dict(row._mapping)
+            for row in connection.execute(select(table.c.id, *(table.c[name] for name in server.TRACKED_OBJECT_FIELDS)))
+        ]
+        if existing:
+            connection.execute(table.delete())
+            server.on_objects_written(connection, [(row, None) for row in existing])
+    rng = random.Random(42)
+    base = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        start = base + timedelta(days=rng.randint(0, 365 * 4))
+        rows.append({
+            "name": f"Резервуар {rng.choice(('РВС', 'РГС'))}-{rng.randint(100, 50000)} №{i}",
+            "location": rng.choice(LOCATIONS),
+            "customer": rng.choice(CUSTOMERS),
+            "status": rng.choice(STATUSES),
+            "budget": rng.randint(100, 20000) * 1000,
+            "start_date": start,
+            "end_date": start + timedelta(days=rng.randint(14, 180)),
+            "progress": rng.randint(0, 100),
+            "description": "Зачистка резервуара",
+        })
+        if len(rows) >= batch_size or i == count - 1:
+            with server.engine.begin() as connection:
+                server.write_objects_sync(connection, rows)
+            rows = []
+
+
+def discover_paths(module_name, app):
+    """GET endpoints без параметров пути + заданные вручную запросы"""
+    paths = []
+    if hasattr(app, "url_map"):  # Flask
+        for rule in app.url_map.iter_rules():
+            if "GET" in rule.methods and not rule.arguments and rule.endpoint != "static":
+                paths.append(rule.rule)
+    else:
+        for route in app.routes:
+            methods = getattr(route, "methods", None) or set()
+            path = getattr(route, "path", "")
+            if "GET" in methods and "{" not in path and path not in SKIPPED_PATHS:
+                paths.append(path + "?" + PATH_QUERIES[path] if path in PATH_QUERIES else path)
+    return sorted(set(paths)) + EXTRA_PATHS.get(module_name, [])
+
+
+def summarize(latencies, errors, elapsed, peak_rss):
+    latencies_ms = sorted(value * 1000 for value in latencies)
+    if len(latencies_ms) >= 2:
+        quantiles = statistics.quantiles(latencies_ms, n=100, method="inclusive")
+        p50, p95, p99 = quantiles[49], quantiles[94], quantiles[98]
+    else:
+        p50 = p95 = p99 = latencies_ms[0] if latencies_ms else 0.0
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "rps": round(len(latencies_ms) / elapsed, 1) if elapsed > 0 else 0.0,
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+
+
+async def run_asgi(app, path, total, concurrency, warmup):
+    """Нагрузка через httpx.ASGITransport: concurrency корутин делят total запросов"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(warmup):
+            await client.get(path)
+        latencies = []
+        errors = 0
+        remaining = total
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                response = await client.get(path)
+                await response.aread()
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors += 1
+
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+    return summarize(latencies, errors, elapsed, rss.peak)
+
+
+async def run_asgi_paths(app, paths, total, concurrency, warmup):
+    """Все endpoints модуля в одном event loop внутри lifespan приложения: пул async-движка
+    привязан к своему циклу, а проверки БД для /readyz запускает startup"""
+    results = {}
+    async with app.router.lifespan_context(app):
+        for path in paths:
+            results[path] = await run_asgi(app, path, total, concurrency, warmup)
+    return results
+
+
+def run_wsgi(app, path, total, concurrency, warmup):
+    """Нагрузка через httpx.WSGITransport из пула потоков"""
+    client = httpx.Client(transport=httpx.WSGITransport(app=app), base_url="http://bench")
+    for _ in range(warmup):
+        client.get(path)
+
+    def one_request(_):
+        started = time.perf_counter()
+        response = client.get(path)
+        return time.perf_counter() - started, response.status_code >= 400
+
+    with RssSampler() as rss, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(one_request, range(total)))
+        elapsed = time.perf_counter() - started
+    client.close()
+    return summarize([latency for latency, _ in results], sum(failed for _, failed in results), elapsed, rss.peak)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Регрессии: p95 вырос или RPS упал больше чем на tolerance"""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if previous["p95_ms"] > 0 and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {previous['p95_ms']} -> {current['p95_ms']} мс")
+        if previous["rps"] > 0 and current["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: RPS {previous['rps']} -> {current['rps']}")
+    return regressions
+
+
+def print_table(results, baseline=None):
+    header = f"{'endpoint':<70} {'p50':>8} {'p95':>8} {'p99':>8} {'RPS':>9} {'RSS МБ':>8} {'err':>5}"
+    print(header)
+    print("-" * len(header))
+    for key, row in results.items():
+        line = (f"{key:<70} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} "
+                f"{row['rps']:>9.1f} {row['peak_rss_mb']:>8.1f} {row['errors']:>5}")
+        previous = (baseline or {}).get(key)
+        if previous and previous["p95_ms"] > 0:
+            line += f"  (p95 {(row['p95_ms'] / previous['p95_ms'] - 1) * 100:+.0f}%)"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон серверов Vega CRM")
+    parser.add_argument("--objects", type=int, default=1000, help="Сколько объектов засеять (1000..1000000)")
+    parser.add_argument("--requests", type=int, default=300, help="Запросов на endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="Одновременных клиентов")
+    parser.add_argument("--warmup", type=int, default=10, help="Прогревочных запросов на endpoint")
+    parser.add_argument("--servers", nargs="*", default=SERVER_MODULES, help="Какие модули гонять")
+    parser.add_argument("--database", help="Файл SQLite (по умолчанию временный)")
+    parser.add_argument("--no-cache", action="store_true", help="Отключить HTTP-кэш ответов railway_server")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    parser.add_argument("--save-baseline", help="Сохранить результаты как эталон")
+    parser.add_argument("--baseline", help="Сравнить с эталоном и вернуть код 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix="vega_bench_"), "bench.db")
+    # railway_server читает настройки при импорте - задаём их до него
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    # Все запросы идут от одного клиента - лимит на клиента превратил бы прогон в замер 429
+    os.environ["RATE_LIMIT_RPS"] = "0"
+    if args.no_cache:
+        os.environ["RESPONSE_CACHE_SIZE"] = "0"
+
+    print("=" * 60)
+    print("📊 VEGA CRM BENCHMARK")
+    print("=" * 60)
+    print(f"Объектов: {args.objects}, запросов на endpoint: {args.requests}, клиентов: {args.concurrency}")
+    print(f"База: {database}")
+
+    results = {}
+    for module_name in args.servers:
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as e:
+            print(f"⚠️ Пропускаю {module_name}: {e}")
+            continue
+        if module_name == "railway_server":
+            started = time.perf_counter()
+            seed_database(module, args.objects)
+            print(f"✅ Засеяно {args.objects} объектов за {time.perf_counter() - started:.1f} с")
+
+        paths = discover_paths(module_name, module.app)
+        if hasattr(module.app, "url_map"):
+            rows = {path: run_wsgi(module.app, path, args.requests, args.concurrency, args.warmup) for path in paths}
+        else:
+            rows = asyncio.run(run_asgi_paths(module.app, paths, args.requests, args.concurrency, args.warmup))
+        for path, row in rows.items():
+            results[f"{module_name} {path}"] = row
+
+    # Латентность ответов с ошибкой ничего не говорит о сервере - такой прогон не засчитывается
+    failed = {key: row for key, row in results.items() if row["errors"]}
+    if failed:
+        print()
+        print("❌ Ошибки в ответах, результаты не сохранены:")
+        for key, row in failed.items():
+            print(f"   {key}: {row['errors']} из {row['requests']}")
+        return 1
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    print()
+    print_table(results, baseline)
+
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "save_baseline", "baseline")},
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 Результаты сохранены в {path}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print()
+            print(f"❌ Регрессии относительно {args.baseline}:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"✅ Регрессий относительно {args.baseline} нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,13 +6,52 @@ Vega CRM - Сервер для развёртывания на Railway
 """
 
 import os
-from fastapi import FastAPI, HTTPException
+import sys
+import importlib.util
+from typing import Optional, List
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, WebSocket
+from pydantic import BaseModel, Field, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean
+from fastapi.responses import Response, StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from datetime import datetime, date
+from sqlalchemy import select, insert, update, text, table, column, MetaData, Table, literal, literal_column, bindparam, union_all, case, or_, and_, exists, cast, Index, ForeignKey, create_engine, Column, Integer, BigInteger, Float, String, Text, DateTime, Boolean, func, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.types import UserDefinedType
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError, IntegrityError, OperationalError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 import json
+import csv
+import io
+import re
+import math
+import time
+import tempfile
+import uuid
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+import contextvars
+import hashlib
+import gzip
+import zlib
+from collections import OrderedDict, deque
+from itertools import chain
+from email.utils import format_datetime
+from datetime import timezone, timedelta
+from decimal import Decimal
+
+# orjson в разы быстрее stdlib json и сам умеет datetime; без него - запасной путь
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Получаем переменные окружения Railway
 DATABASE_URL = os.environ.get("DATABASE_URL")
@@ -20,9 +59,39 @@ if not DATABASE_URL:
     # Для локальной разработки - используем SQLite если нет PostgreSQL
     DATABASE_URL = "sqlite:///./vega_crm.db"
     print("⚠️ Использую SQLite для локальной разработки")
+elif DATABASE_URL.startswith("postgres://"):
+    # Railway/Heroku отдают устаревшую схему, SQLAlchemy её не принимает
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+# Параметры пула соединений
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # секунды ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # пересоздавать соединения старше N секунд
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_json(content):
+    """JSON в байтах: orjson, если установлен, иначе json с тем же результатом"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """Ответ, сериализуемый dumps_json. Обработчик, вернувший его напрямую,
+    минует jsonable_encoder FastAPI - данные кодируются один раз."""
+
+    def render(self, content):
+        return dumps_json(content)
 
 # Создание FastAPI приложения
 app = FastAPI(
+    default_response_class=FastJSONResponse,
     title="Vega CRM - Система контроля объектов",
     description="CRM для компании 'Вега' - контроль объектов по зачистке резервуаров",
     version="2.0.0",
@@ -30,21 +99,326 @@ app = FastAPI(
     redoc_url="/redoc"
 )
 
-# Настройка CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Настройка SQLAlchemy
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
+
+def pool_options(url):
+    """Настройки пула; in-memory SQLite живёт в одном соединении и пул не настраивается"""
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True
+    }
+
+def async_database_url(url):
+    """Тот же адрес БД, но с асинхронным драйвером (asyncpg / aiosqlite)"""
+    scheme, sep, rest = url.partition("://")
+    if scheme in ("postgresql", "postgresql+psycopg2"):
+        return "postgresql+asyncpg://" + rest
+    if scheme == "sqlite":
+        return "sqlite+aiosqlite://" + rest
+    return url
+
+# Синхронный движок - для DDL и заполнения при старте
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок - для обработчиков запросов, чтобы не блокировать event loop
+try:
+    async_engine = create_async_engine(async_database_url(DATABASE_URL), **pool_options(DATABASE_URL))
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+except Exception as e:
+    async_engine = None
+    AsyncSessionLocal = None
+    print(f"⚠️ Асинхронный драйвер БД недоступен: {e}")
+
+# Счётчики занятости пула (для /api/db/pool)
+pool_metrics = {"checkouts": 0, "in_use": 0, "peak_in_use": 0, "timeouts": 0}
+
+if async_engine is not None:
+    @event.listens_for(async_engine.sync_engine, "checkout")
+    def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics["checkouts"] += 1
+        pool_metrics["in_use"] += 1
+        pool_metrics["peak_in_use"] = max(pool_metrics["peak_in_use"], pool_metrics["in_use"])
+
+    @event.listens_for(async_engine.sync_engine, "checkin")
+    def _pool_checkin(dbapi_connection, connection_record):
+        pool_metrics["in_use"] = max(pool_metrics["in_use"] - 1, 0)
+
+# Доступность БД: фоновая проверка раз в DB_PROBE_INTERVAL и предохранитель (circuit breaker).
+# Пока БД лежит, запросы получают 503 сразу, а не копят таймауты подключения;
+# health-check'и читают готовое состояние и не берут соединения из пула.
+DB_PROBE_INTERVAL = float(os.environ.get("DB_PROBE_INTERVAL", 5))  # секунд между проверками
+DB_PROBE_TIMEOUT = float(os.environ.get("DB_PROBE_TIMEOUT", 2))  # секунд на одну проверку
+DB_BREAKER_THRESHOLD = int(os.environ.get("DB_BREAKER_THRESHOLD", 3))  # неудач подряд до размыкания
+
+class DatabaseBreaker:
+    """Размыкается после DB_BREAKER_THRESHOLD неудач подряд (проверки или обрывы соединений),
+    замыкается первой успешной фоновой проверкой"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self.opened_at = None  # datetime размыкания
+        self.checked_at = None  # время последней проверки (monotonic)
+        self.last_ok = None
+        self.latency = None
+        self.error = None
+        self.trips = 0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self, latency):
+        if self.opened_at is not None:
+            print(f"✅ БД снова доступна после {(datetime.utcnow() - self.opened_at).total_seconds():.0f} с")
+        self.failures = 0
+        self.opened_at = None
+        self.error = None
+        self.latency = latency
+        self.checked_at = time.monotonic()
+        self.last_ok = datetime.utcnow()
+
+    def record_failure(self, error):
+        self.failures += 1
+        self.error = str(error).splitlines()[0] if str(error) else type(error).__name__
+        self.checked_at = time.monotonic()
+        if self.opened_at is None and self.failures >= self.threshold:
+            self.opened_at = datetime.utcnow()
+            self.trips += 1
+            print(f"❌ БД недоступна ({self.error}), запросы к ней отклоняются до восстановления")
+
+    def retry_after(self):
+        return str(max(1, round(DB_PROBE_INTERVAL)))
+
+    def unavailable(self):
+        return HTTPException(status_code=503, detail=f"Database unavailable: {self.error}", headers={"Retry-After": self.retry_after()})
+
+db_breaker = DatabaseBreaker(DB_BREAKER_THRESHOLD)
+
+# Отдельный движок без пула: проверка не отнимает соединения у обработчиков
+probe_engine = create_async_engine(async_database_url(DATABASE_URL), poolclass=NullPool) if async_engine is not None else None
+_probe_task = None
+
+async def probe_database():
+    """Одна проверка SELECT 1 с жёстким таймаутом; результат - в db_breaker"""
+    started = time.perf_counter()
+    try:
+        async def select_one():
+            async with probe_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+        await asyncio.wait_for(select_one(), DB_PROBE_TIMEOUT)
+    except Exception as e:
+        db_breaker.record_failure(e)
+        return False
+    db_breaker.record_success(time.perf_counter() - started)
+    return True
+
+async def probe_loop():
+    while True:
+        await asyncio.sleep(DB_PROBE_INTERVAL)
+        await probe_database()
+        await replica_router.refresh()
+
+def _connect_guard(dialect, conn_rec, cargs, cparams):
+    """Пока предохранитель разомкнут, новые подключения не ждут таймаута - отказ сразу"""
+    if db_breaker.is_open:
+        raise ConnectionRefusedError(f"Database circuit breaker is open: {db_breaker.error}")
+
+def _connection_failed(exception_context):
+    # Обрыв или неудачное подключение - признак недоступности БД, а не ошибки запроса
+    if exception_context.is_disconnect or exception_context.connection is None:
+        db_breaker.record_failure(exception_context.original_exception)
+
+for _engine in [engine] + ([async_engine.sync_engine] if async_engine is not None else []):
+    event.listen(_engine, "do_connect", _connect_guard)
+    event.listen(_engine, "handle_error", _connection_failed)
+
+@asynccontextmanager
+async def primary_session():
+    """Сессия основной БД; при разомкнутом предохранителе - сразу 503"""
+    if AsyncSessionLocal is None:
+        raise HTTPException(status_code=503, detail="Async database driver is not installed")
+    if db_breaker.is_open:
+        raise db_breaker.unavailable()
+    async with AsyncSessionLocal() as session:
+        try:
+            yield session
+        except PoolTimeoutError:
+            pool_metrics["timeouts"] += 1
+            raise
+
+async def get_async_db():
+    """FastAPI-зависимость: асинхронная сессия на время запроса"""
+    async with primary_session() as session:
+        yield session
+
+# Реплики для чтения: дашборды (объекты, Гант, статистика, поиск) читают с реплик
+# по кругу, запись и DDL - только основная БД. Отставание реплики меряется по
+# журналу change_log: какой seq она уже видит и как давно основная ушла вперёд.
+# Read-your-writes: ответ на запись несёт X-Write-Seq (и cookie); пока реплика не
+# догнала этот seq, чтения клиента идут в основную БД.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))  # секунд отставания, после которых реплика не читается
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 60))  # срок cookie с seq последней записи
+WRITE_SEQ_COOKIE = "vega_write_seq"
+
+class Replica:
+    def __init__(self, name, url):
+        if url.startswith("postgres://"):
+            url = "postgresql://" + url[len("postgres://"):]
+        self.name = name
+        self.host = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_async_engine(async_database_url(url), **pool_options(url))
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+        self.probe_engine = create_async_engine(async_database_url(url), poolclass=NullPool)
+        self.healthy = False
+        self.seq = 0  # последний seq журнала, который видит реплика
+        self.lag = None  # секунд
+        self.checked_at = None
+        self.error = None
+        self.reads = 0
+
+    def status(self):
+        return {
+            "name": self.name,
+            "url": self.host,
+            "healthy": self.healthy,
+            "seq": self.seq,
+            "lag_seconds": round(self.lag, 3) if self.lag is not None else None,
+            "checked_ago": round(time.monotonic() - self.checked_at, 1) if self.checked_at is not None else None,
+            "error": self.error,
+            "reads": self.reads
+        }
+
+class ReplicaRouter:
+    """Выбор реплики для чтения: по кругу среди здоровых, не отставших и уже видящих
+    последнюю запись клиента; если таких нет - основная БД (None)"""
+
+    def __init__(self, urls):
+        self.replicas = [Replica(f"replica{index}", url) for index, url in enumerate(urls)]
+        self.turn = 0
+        self.primary_reads = 0
+
+    def choose(self, scope):
+        if not self.replicas:
+            return None
+        min_seq = client_write_seq(scope)
+        now = time.monotonic()
+        eligible = [
+            replica for replica in self.replicas
+            if replica.healthy and replica.lag is not None and replica.lag <= REPLICA_MAX_LAG and replica.seq >= min_seq
+            and now - replica.checked_at <= 3 * DB_PROBE_INTERVAL + DB_PROBE_TIMEOUT
+        ]
+        if not eligible:
+            return None
+        self.turn += 1
+        return eligible[self.turn % len(eligible)]
+
+    async def refresh(self):
+        """Seq и отставание реплик; вызывается фоновой проверкой, соединения - вне пулов"""
+        for replica in self.replicas:
+            try:
+                async def replica_seq():
+                    async with replica.probe_engine.connect() as connection:
+                        return (await connection.execute(select(func.coalesce(func.max(ChangeLog.seq), 0)))).scalar()
+                replica.seq = await asyncio.wait_for(replica_seq(), DB_PROBE_TIMEOUT)
+                replica.healthy = True
+                replica.error = None
+            except Exception as e:
+                replica.healthy = False
+                replica.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            replica.checked_at = time.monotonic()
+            if not replica.healthy or db_breaker.is_open:
+                # Без основной БД отставание не измерить - остаётся последнее известное
+                continue
+            try:
+                async def first_missing():
+                    async with probe_engine.connect() as connection:
+                        return (await connection.execute(
+                            select(ChangeLog.changed_at).where(ChangeLog.seq > replica.seq).order_by(ChangeLog.seq).limit(1)
+                        )).scalar()
+                missing_since = as_datetime(await asyncio.wait_for(first_missing(), DB_PROBE_TIMEOUT))
+                replica.lag = max((datetime.utcnow() - missing_since).total_seconds(), 0.0) if missing_since else 0.0
+            except Exception as e:
+                replica.error = f"primary: {str(e).splitlines()[0] if str(e) else type(e).__name__}"
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.engine.dispose()
+            await replica.probe_engine.dispose()
+
+def client_write_seq(scope):
+    """Seq последней записи клиента: заголовок X-Min-Seq или cookie от ответа на запись"""
+    headers = dict(scope["headers"])
+    values = [headers.get(b"x-min-seq", b"").decode("latin-1")]
+    for part in headers.get(b"cookie", b"").decode("latin-1").split(";"):
+        name, _, value = part.strip().partition("=")
+        if name == WRITE_SEQ_COOKIE:
+            values.append(value)
+    return max((int(value) for value in values if value.strip().isdigit()), default=0)
+
+replica_router = ReplicaRouter(DATABASE_REPLICA_URLS if async_engine is not None else [])
+
+async def get_read_db(request: Request):
+    """FastAPI-зависимость для читающих endpoints: сессия реплики, выбранной роутером
+    (или ConditionalGetMiddleware - тогда ETag и данные из одной БД), иначе основной"""
+    state = request.scope.get("state") or {}
+    replica = state["read_replica"] if "read_replica" in state else replica_router.choose(request.scope)
+    if replica is None:
+        replica_router.primary_reads += 1
+        async with primary_session() as session:
+            yield session
+        return
+    replica.reads += 1
+    async with replica.sessionmaker() as session:
+        yield session
+
+class WriteSeqMiddleware:
+    """Ответ на успешную запись несёт seq журнала изменений: по нему роутер
+    не отправит следующие чтения клиента на ещё не догнавшую реплику"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS") or not replica_router.replicas:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_seq(message):
+            if message["type"] == "http.response.start" and message["status"] < 400 and not db_breaker.is_open:
+                try:
+                    async with async_engine.connect() as connection:
+                        seq = (await connection.execute(select(func.coalesce(func.max(ChangeLog.seq), 0)))).scalar()
+                except Exception:
+                    seq = None
+                if seq is not None:
+                    cookie = f"{WRITE_SEQ_COOKIE}={seq}; Max-Age={REPLICA_STICKY_SECONDS}; Path=/; SameSite=Lax"
+                    message = dict(message, headers=list(message.get("headers", [])) + [
+                        (b"x-write-seq", str(seq).encode()), (b"set-cookie", cookie.encode())
+                    ])
+            await send(message)
+
+        await self.app(scope, receive, send_with_seq)
+
+app.add_middleware(WriteSeqMiddleware)
+
 # Модели базы данных
+# Заказчик - отдельная сущность; Object.customer остаётся отображаемым именем
+class Customer(Base):
+    __tablename__ = "customers"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(200), nullable=False, unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Object(Base):
     __tablename__ = "objects"
     
@@ -52,91 +426,1118 @@ class Object(Base):
     name = Column(String(200), nullable=False)
     location = Column(String(200))
     customer = Column(String(200))
+    customer_id = Column(Integer, ForeignKey("customers.id"))  # заполняется по customer при записи
     status = Column(String(50))  # planning, in_progress, completed
     budget = Column(Integer)  # в рублях
     start_date = Column(DateTime)
     end_date = Column(DateTime)
     progress = Column(Integer)  # 0-100%
     description = Column(Text)
+    # Координаты - из справочника мест по location или явные (GPS с объекта);
+    # индексы по ним строит миграция 5, пространственный - вне модели (R-tree / PostGIS)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    geohash = Column(String(12))  # для кластеров на карте: общий префикс - соседние объекты
+    region = Column(String(100))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        # Окно диаграммы Ганта: start_date <= to AND end_date >= from
+        Index("ix_objects_start_end", "start_date", "end_date"),
+        # Объекты заказчика постранично: customer_id = ? AND id > after
+        Index("ix_objects_customer_id", "customer_id", "id"),
+        # Фильтры /api/objects?status=...&customer=...
+        Index("ix_objects_status", "status"),
+        Index("ix_objects_customer", "customer"),
+    )
+
+# Офлайн-справочник мест: геокодирование location без внешних сервисов
+class Gazetteer(Base):
+    __tablename__ = "gazetteer"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(200), nullable=False)
+    name_key = Column(String(200), nullable=False, unique=True)  # place_key(name)
+    region = Column(String(100))
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+
+# Города и промышленные площадки, где работают бригады; пополняется вставкой в gazetteer
+GAZETTEER = [
+    ("Москва", "Москва", 55.7558, 37.6173),
+    ("Санкт-Петербург", "Санкт-Петербург", 59.9386, 30.3141),
+    ("Кириши", "Ленинградская область", 59.4470, 32.0080),
+    ("Приморск", "Ленинградская область", 60.3660, 28.6130),
+    ("Усть-Луга", "Ленинградская область", 59.6650, 28.3150),
+    ("Мурманск", "Мурманская область", 68.9585, 33.0827),
+    ("Архангельск", "Архангельская область", 64.5393, 40.5187),
+    ("Нарьян-Мар", "НАО", 67.6380, 53.0069),
+    ("Варандей", "НАО", 68.8167, 58.0167),
+    ("Усинск", "Республика Коми", 65.9940, 57.5570),
+    ("Ухта", "Республика Коми", 63.5671, 53.6835),
+    ("Воркута", "Республика Коми", 67.4974, 64.0610),
+    ("Ярославль", "Ярославская область", 57.6261, 39.8845),
+    ("Нижний Новгород", "Нижегородская область", 56.3269, 44.0059),
+    ("Казань", "Республика Татарстан", 55.7887, 49.1221),
+    ("Альметьевск", "Республика Татарстан", 54.9014, 52.2971),
+    ("Нижнекамск", "Республика Татарстан", 55.6366, 51.8245),
+    ("Самара", "Самарская область", 53.1959, 50.1002),
+    ("Сызрань", "Самарская область", 53.1559, 48.4745),
+    ("Оренбург", "Оренбургская область", 51.7682, 55.0970),
+    ("Уфа", "Республика Башкортостан", 54.7388, 55.9721),
+    ("Пермь", "Пермский край", 58.0105, 56.2502),
+    ("Волгоград", "Волгоградская область", 48.7080, 44.5133),
+    ("Астрахань", "Астраханская область", 46.3497, 48.0408),
+    ("Ростов-на-Дону", "Ростовская область", 47.2357, 39.7015),
+    ("Краснодар", "Краснодарский край", 45.0355, 38.9753),
+    ("Новороссийск", "Краснодарский край", 44.7239, 37.7689),
+    ("Туапсе", "Краснодарский край", 44.0950, 39.0740),
+    ("Екатеринбург", "Свердловская область", 56.8389, 60.6057),
+    ("Челябинск", "Челябинская область", 55.1644, 61.4368),
+    ("Тюмень", "Тюменская область", 57.1522, 65.5272),
+    ("Тобольск", "Тюменская область", 58.1981, 68.2645),
+    ("Ханты-Мансийск", "ХМАО", 61.0042, 69.0019),
+    ("Сургут", "ХМАО", 61.2540, 73.3962),
+    ("Нефтеюганск", "ХМАО", 61.0998, 72.6035),
+    ("Нижневартовск", "ХМАО", 60.9344, 76.5531),
+    ("Мегион", "ХМАО", 61.0296, 76.1136),
+    ("Когалым", "ХМАО", 62.2654, 74.4791),
+    ("Салехард", "ЯНАО", 66.5299, 66.6140),
+    ("Надым", "ЯНАО", 65.5333, 72.5167),
+    ("Новый Уренгой", "ЯНАО", 66.0833, 76.6333),
+    ("Ноябрьск", "ЯНАО", 63.2018, 75.4510),
+    ("Губкинский", "ЯНАО", 64.4333, 76.5000),
+    ("Муравленко", "ЯНАО", 63.7900, 74.5200),
+    ("Ямбург", "ЯНАО", 67.9300, 75.1000),
+    ("Бованенково", "ЯНАО", 70.3600, 68.3800),
+    ("Сабетта", "ЯНАО", 71.2650, 72.0600),
+    ("Омск", "Омская область", 54.9885, 73.3242),
+    ("Томск", "Томская область", 56.4977, 84.9744),
+    ("Стрежевой", "Томская область", 60.7330, 77.6040),
+    ("Новосибирск", "Новосибирская область", 55.0084, 82.9357),
+    ("Кемерово", "Кемеровская область", 55.3547, 86.0873),
+    ("Новокузнецк", "Кемеровская область", 53.7596, 87.1216),
+    ("Красноярск", "Красноярский край", 56.0153, 92.8932),
+    ("Ачинск", "Красноярский край", 56.2694, 90.4993),
+    ("Норильск", "Красноярский край", 69.3558, 88.1893),
+    ("Иркутск", "Иркутская область", 52.2870, 104.3050),
+    ("Ангарск", "Иркутская область", 52.5448, 103.8885),
+    ("Хабаровск", "Хабаровский край", 48.4802, 135.0719),
+    ("Комсомольск-на-Амуре", "Хабаровский край", 50.5499, 137.0079),
+    ("Владивосток", "Приморский край", 43.1155, 131.8855),
+    ("Находка", "Приморский край", 42.8240, 132.8920),
+    ("Южно-Сахалинск", "Сахалинская область", 46.9591, 142.7380),
+]
+
+# Материализованная сводка по статусам: одна строка на статус,
+# обновляется инкрементально при каждой записи Object
+class ObjectStats(Base):
+    __tablename__ = "object_stats"
+
+    status = Column(String(50), primary_key=True)  # "" для объектов без статуса
+    count = Column(Integer, nullable=False, default=0)
+    budget_sum = Column(BigInteger, nullable=False, default=0)
+
+# Та же сводка в разрезе заказчика: порталу заказчика не нужны ни сканы objects,
+# ни глобальные агрегаты. progress_sum - для среднего прогресса без пересчёта.
+class CustomerStats(Base):
+    __tablename__ = "customer_stats"
+
+    customer_id = Column(Integer, ForeignKey("customers.id"), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    budget_sum = Column(BigInteger, nullable=False, default=0)
+    progress_sum = Column(BigInteger, nullable=False, default=0)
+
+# Журнал изменений для офлайн-синхронизации: seq растёт с каждой записью,
+# клиент запрашивает всё, что новее его последнего seq
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String(20), nullable=False)  # object, report
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String(10), nullable=False)  # upsert, delete
+    changed_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Последнее изменение записи - для обнаружения конфликтов
+        Index("ix_change_log_entity", "entity", "entity_id", "seq"),
+    )
+
+CHANGE_LOG_LOCK_ID = 20260222  # ключ pg_advisory_xact_lock для записи в журнал
+
+def lock_change_log(connection):
+    """PostgreSQL выдаёт seq параллельным транзакциям при вставке, а коммитятся они в любом
+    порядке: клиент, уже получивший seq 11, никогда не увидел бы закоммиченный позже seq 10.
+    Пишущая транзакция держит блокировку до коммита - порядок seq совпадает с порядком
+    коммитов. Берётся до записи строк (before_flush, начало пакета), иначе возможна
+    взаимоблокировка с блокировками строк. SQLite и так пропускает одного писателя за раз."""
+    if connection.dialect.name == "postgresql" and not connection.info.get("change_log_locked"):
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK_ID})
+        connection.info["change_log_locked"] = True
+
+def record_changes(connection, entity, changes):
+    """Пишет в журнал (id, op) пары в транзакции самой записи"""
+    if changes:
+        lock_change_log(connection)
+        now = datetime.utcnow()
+        connection.execute(
+            ChangeLog.__table__.insert(),
+            [{"entity": entity, "entity_id": entity_id, "op": op, "changed_at": now} for entity_id, op in changes]
+        )
+
+def apply_stats_delta(connection, status, count_delta, budget_delta):
+    """Сдвигает счётчики сводки для статуса (в той же транзакции, что и запись)"""
+    key = status or ""
+    table = ObjectStats.__table__
+    result = connection.execute(
+        table.update()
+        .where(table.c.status == key)
+        .values(count=table.c.count + count_delta, budget_sum=table.c.budget_sum + budget_delta)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(status=key, count=count_delta, budget_sum=budget_delta))
+
+def apply_customer_delta(connection, customer_id, status, count_delta, budget_delta, progress_delta):
+    table = CustomerStats.__table__
+    result = connection.execute(
+        table.update()
+        .where(table.c.customer_id == customer_id, table.c.status == status)
+        .values(
+            count=table.c.count + count_delta,
+            budget_sum=table.c.budget_sum + budget_delta,
+            progress_sum=table.c.progress_sum + progress_delta
+        )
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(
+            customer_id=customer_id, status=status,
+            count=count_delta, budget_sum=budget_delta, progress_sum=progress_delta
+        ))
+
+def resolve_customer_ids(connection, names):
+    """{имя: id} для имён заказчиков; недостающих заказчиков создаёт"""
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    table = Customer.__table__
+    found = dict(connection.execute(select(table.c.name, table.c.id).where(table.c.name.in_(names))).all())
+    missing = names - found.keys()
+    if missing:
+        dialect_insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[connection.dialect.name]
+        # Параллельная запись могла создать того же заказчика - конфликт имени не ошибка
+        connection.execute(
+            dialect_insert(table).on_conflict_do_nothing(index_elements=[table.c.name]),
+            [{"name": name, "created_at": datetime.utcnow()} for name in sorted(missing)]
+        )
+        found.update(connection.execute(select(table.c.name, table.c.id).where(table.c.name.in_(missing))).all())
+    return found
+
+@event.listens_for(Object, "before_insert")
+@event.listens_for(Object, "before_update")
+def _object_resolve_customer(mapper, connection, target):
+    if inspect(target).attrs.customer.history.has_changes() or (target.customer and target.customer_id is None):
+        target.customer_id = resolve_customer_ids(connection, [target.customer]).get(target.customer)
+
+# Геокодирование по справочнику gazetteer и geohash для кластеров
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 9  # ячейка ~5 м
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+PLACE_PREFIXES = {"г", "гор", "город", "пос", "поселок", "пгт", "п", "с", "село", "д", "деревня", "ст", "мкр"}
+_gazetteer = None  # {name_key: (lat, lon, region)} - справочник статичен, читается один раз на процесс
+
+def place_key(value):
+    """Ключ поиска места: нижний регистр, ё -> е, без знаков и «г.», «пос.»"""
+    words = re.findall(r"[\w-]+", (value or "").lower().replace("ё", "е"))
+    return " ".join(word for word in words if word not in PLACE_PREFIXES)
+
+def build_places(rows):
+    global _gazetteer
+    places = {row.name_key: (row.latitude, row.longitude, row.region) for row in rows}
+    if places:
+        # Пустой справочник не кэшируем: его заполнит миграция, пока процесс работает
+        _gazetteer = places
+    return places
+
+def load_gazetteer(connection):
+    if _gazetteer is not None:
+        return _gazetteer
+    return build_places(connection.execute(select(Gazetteer.name_key, Gazetteer.latitude, Gazetteer.longitude, Gazetteer.region)))
+
+def geocode(location, places):
+    """(lat, lon, region) по свободному тексту: целиком, по частям через запятую,
+    затем по сочетаниям слов ("Сабетта, ЯНАО", "г. Новый Уренгой, куст 5")"""
+    if not location or not places:
+        return None
+    for part in [location] + re.split(r"[,;/()]", location):
+        place = places.get(place_key(part))
+        if place is not None:
+            return place
+    words = place_key(location).split()
+    for size in range(min(len(words), 3), 0, -1):
+        for start in range(len(words) - size + 1):
+            place = places.get(" ".join(words[start:start + size]))
+            if place is not None:
+                return place
+    return None
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        target, bounds = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if target >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Расстояние по большому кругу (гаверсинус)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def object_geo(places, location, latitude=None, longitude=None):
+    """Координаты, geohash и регион объекта: явные координаты важнее места из справочника;
+    регион для них - от ближайшего известного места"""
+    if latitude is None or longitude is None:
+        place = geocode(location, places)
+        if place is None:
+            return {"latitude": None, "longitude": None, "geohash": None, "region": None}
+        latitude, longitude, region = place
+    else:
+        nearest = min(places.values(), key=lambda place: distance_km(latitude, longitude, place[0], place[1]), default=None)
+        region = nearest[2] if nearest is not None else None
+    return {"latitude": latitude, "longitude": longitude, "geohash": geohash_encode(latitude, longitude), "region": region}
+
+@event.listens_for(Object, "before_insert")
+@event.listens_for(Object, "before_update")
+def _object_geocode(mapper, connection, target):
+    attrs = inspect(target).attrs
+    explicit = attrs.latitude.history.has_changes() or attrs.longitude.history.has_changes()
+    if not explicit and not attrs.location.history.has_changes():
+        return
+    latitude, longitude = (target.latitude, target.longitude) if explicit else (None, None)
+    for name, value in object_geo(load_gazetteer(connection), target.location, latitude, longitude).items():
+        setattr(target, name, value)
+
+# Поля, которые нужны реакциям на запись (сводки, кэши); их старые значения
+# подгружаются даже если атрибут не был загружен до изменения
+TRACKED_OBJECT_FIELDS = ("status", "budget", "customer_id", "progress", "start_date", "end_date")
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+for _field in TRACKED_OBJECT_FIELDS:
+    event.listen(getattr(Object, _field), "set", _keep_old_value, active_history=True)
+
+def on_objects_written(connection, changes):
+    """Единая точка реакции на запись объектов - и из ORM, и из пакетных путей.
+
+    changes - список пар (old, new): словари TRACKED_OBJECT_FIELDS + id до и после
+    записи; old=None для вставки, new=None для удаления. Вызывается в той же
+    транзакции, что и сама запись.
+    """
+    deltas = {}
+    for old, new in changes:
+        if old is not None and new is not None and all(old[f] == new[f] for f in ("status", "budget")):
+            continue
+        if old is not None:
+            count, budget = deltas.get(old["status"] or "", (0, 0))
+            deltas[old["status"] or ""] = (count - 1, budget - (old["budget"] or 0))
+        if new is not None:
+            count, budget = deltas.get(new["status"] or "", (0, 0))
+            deltas[new["status"] or ""] = (count + 1, budget + (new["budget"] or 0))
+    for status, (count, budget) in deltas.items():
+        if count or budget:
+            apply_stats_delta(connection, status, count, budget)
+
+    customer_deltas = {}
+    for old, new in changes:
+        for snapshot, sign in ((old, -1), (new, 1)):
+            if snapshot is not None and snapshot["customer_id"] is not None:
+                key = (snapshot["customer_id"], snapshot["status"] or "")
+                count, budget, progress = customer_deltas.get(key, (0, 0, 0))
+                customer_deltas[key] = (
+                    count + sign, budget + sign * (snapshot["budget"] or 0), progress + sign * (snapshot["progress"] or 0)
+                )
+    for (customer_id, status), (count, budget, progress) in customer_deltas.items():
+        if count or budget or progress:
+            apply_customer_delta(connection, customer_id, status, count, budget, progress)
+    # История прогресса и прогноз сроков - только для объектов, где поменялся график
+    now = datetime.utcnow()
+    history = [
+        {"object_id": new["id"], "progress": new["progress"], "recorded_at": now}
+        for old, new in changes
+        if new is not None and new["progress"] is not None and (old is None or old["progress"] != new["progress"])
+    ]
+    if history:
+        connection.execute(ProgressHistory.__table__.insert(), history)
+    rescheduled = [
+        new["id"] for old, new in changes
+        if new is not None and (old is None or any(old[f] != new[f] for f in SCHEDULE_FIELDS))
+    ]
+    if rescheduled:
+        refresh_schedule(connection, rescheduled)
+    deleted = [old["id"] for old, new in changes if new is None]
+    if deleted:
+        connection.execute(ProgressHistory.__table__.delete().where(ProgressHistory.object_id.in_(deleted)))
+        connection.execute(ObjectSchedule.__table__.delete().where(ObjectSchedule.object_id.in_(deleted)))
+
+    record_changes(connection, "object", [
+        (new["id"], "upsert") if new is not None else (old["id"], "delete") for old, new in changes
+    ])
+    # Живым клиентам - только после коммита, см. _publish_committed
+    connection.info.setdefault("changed_objects", set()).update(
+        (new or old)["id"] for old, new in changes
+    )
+    # Кэш ответов сбрасывается после коммита: _clear_cache_after_commit для ORM,
+    # write_objects_chunk для пакетной записи
+
+def object_snapshot(target, before=False):
+    """Значения отслеживаемых полей ORM-объекта; before=True - до текущего изменения"""
+    snapshot = {"id": target.id}
+    state = inspect(target)
+    for field in TRACKED_OBJECT_FIELDS:
+        history = state.attrs[field].history
+        snapshot[field] = history.deleted[0] if before and history.deleted else getattr(target, field)
+    return snapshot
+
+def mark_objects_written(target):
+    inspect(target).session.info["objects_written"] = True
+
+@event.listens_for(Object, "after_insert")
+def _object_after_insert(mapper, connection, target):
+    on_objects_written(connection, [(None, object_snapshot(target))])
+    mark_objects_written(target)
+
+@event.listens_for(Object, "after_delete")
+def _object_after_delete(mapper, connection, target):
+    on_objects_written(connection, [(object_snapshot(target, before=True), None)])
+    mark_objects_written(target)
+
+@event.listens_for(Object, "after_update")
+def _object_after_update(mapper, connection, target):
+    on_objects_written(connection, [(object_snapshot(target, before=True), object_snapshot(target))])
+    mark_objects_written(target)
+
+# Контроль сроков: история прогресса даёт скорость (процентов в день) и прогноз
+# окончания. Прогноз хранится в object_schedule и пересчитывается только для
+# объектов, у которых изменился прогресс или даты; чтение не считает ничего.
+SCHEDULE_FIELDS = ("progress", "status", "start_date", "end_date")
+SCHEDULE_TOLERANCE_DAYS = float(os.environ.get("SCHEDULE_TOLERANCE_DAYS", 3))  # допустимое опоздание прогноза
+EPOCH = datetime(1970, 1, 1)
+
+class ProgressHistory(Base):
+    __tablename__ = "progress_history"
+
+    id = Column(Integer, primary_key=True)
+    object_id = Column(Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False)
+    progress = Column(Integer, nullable=False)
+    recorded_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_progress_history_object", "object_id", "recorded_at"),
+    )
+
+class ObjectSchedule(Base):
+    __tablename__ = "object_schedule"
+
+    object_id = Column(Integer, ForeignKey("objects.id", ondelete="CASCADE"), primary_key=True)
+    velocity = Column(Float)  # процентов в день; None - данных для оценки нет
+    projected_end = Column(DateTime)  # когда при текущей скорости объект дойдёт до 100%
+    variance_days = Column(Float, index=True)  # projected_end - end_date; > 0 - опоздание
+    computed_at = Column(DateTime, default=datetime.utcnow)
+
+def epoch_days(column, dialect_name):
+    """Дата как число дней от 1970-01-01 - для регрессии в SQL"""
+    if dialect_name == "postgresql":
+        return func.extract("epoch", column) / 86400.0
+    return func.julianday(column) - 2440587.5
+
+def as_days(value):
+    return (value - EPOCH).total_seconds() / 86400
+
+def project_schedule(progress, start_date, end_date, status, points):
+    """Скорость по методу наименьших квадратов по всей истории и прогноз окончания.
+    points - (n, sum_t, sum_p, sum_tp, sum_tt, last_t) по истории объекта."""
+    n, sum_t, sum_p, sum_tp, sum_tt, last_t = points or (0, 0, 0, 0, 0, None)
+    velocity = None
+    denominator = n * sum_tt - sum_t * sum_t
+    if n >= 2 and denominator > 1e-9:
+        velocity = (n * sum_tp - sum_t * sum_p) / denominator
+    elif last_t is not None and start_date is not None and last_t > as_days(start_date) and progress:
+        # Одна точка: считаем, что с начала работ прогресс рос равномерно
+        velocity = progress / (last_t - as_days(start_date))
+
+    projected_end = None
+    if status == "completed" or (progress or 0) >= 100:
+        projected_end = EPOCH + timedelta(days=last_t) if last_t is not None else end_date
+    elif velocity and velocity > 0 and last_t is not None:
+        projected_end = EPOCH + timedelta(days=last_t + (100 - (progress or 0)) / velocity)
+    variance_days = None
+    if projected_end is not None and end_date is not None:
+        variance_days = round((projected_end - end_date).total_seconds() / 86400, 1)
+    return velocity, projected_end, variance_days
+
+def refresh_schedule(connection, object_ids=None):
+    """Пересчёт прогноза одним проходом: суммы для регрессии агрегирует БД,
+    object_ids=None - по всем объектам сразу"""
+    history = ProgressHistory.__table__
+    t = epoch_days(history.c.recorded_at, connection.dialect.name)
+    p = history.c.progress
+    points_stmt = select(
+        history.c.object_id, func.count(), func.sum(t), func.sum(p), func.sum(t * p), func.sum(t * t), func.max(t)
+    ).group_by(history.c.object_id)
+    objects_stmt = select(Object.id, Object.progress, Object.start_date, Object.end_date, Object.status)
+    if object_ids is not None:
+        points_stmt = points_stmt.where(history.c.object_id.in_(object_ids))
+        objects_stmt = objects_stmt.where(Object.id.in_(object_ids))
+    points = {row[0]: tuple(float(value or 0) for value in row[1:6]) + (row[6],) for row in connection.execute(points_stmt)}
+
+    now = datetime.utcnow()
+    rows = []
+    for object_id, progress, start_date, end_date, status in connection.execute(objects_stmt):
+        velocity, projected_end, variance_days = project_schedule(progress, start_date, end_date, status, points.get(object_id))
+        rows.append({
+            "object_id": object_id, "velocity": velocity, "projected_end": projected_end,
+            "variance_days": variance_days, "computed_at": now
+        })
+    table = ObjectSchedule.__table__
+    delete = table.delete()
+    if object_ids is not None:
+        delete = delete.where(table.c.object_id.in_(object_ids))
+    connection.execute(delete)
+    if rows:
+        connection.execute(table.insert(), rows)
+
+# Ежедневные отчёты мастеров и фото к ним
+class Report(Base):
+    __tablename__ = "reports"
+
+    id = Column(Integer, primary_key=True, index=True)
+    object_id = Column(Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False, index=True)
+    author = Column(String(200))  # мастер
+    report_date = Column(DateTime, default=datetime.utcnow)
+    text = Column(Text)
+    progress = Column(Integer)  # 0-100%, если мастер его обновил
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Функция для создания таблиц (вызывается при запуске)
-def create_tables():
+class ReportPhoto(Base):
+    __tablename__ = "report_photos"
+
+    id = Column(Integer, primary_key=True, index=True)
+    report_id = Column(Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False, index=True)
+    sha256 = Column(String(64), nullable=False, index=True)  # файл хранится один раз на содержимое
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String(100))
+    filename = Column(String(255))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Незавершённая загрузка фото. Принятое смещение хранится в БД, право дописать
+# кусок выдаётся условным UPDATE (claim_upload) - докачку может продолжить любой воркер
+class PhotoUpload(Base):
+    __tablename__ = "photo_uploads"
+
+    id = Column(String(32), primary_key=True)  # uuid4().hex
+    report_id = Column(Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False, index=True)
+    filename = Column(String(255))
+    content_type = Column(String(100))
+    size = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64))  # ожидаемый хэш, если клиент его прислал
+    photo_id = Column(Integer, ForeignKey("report_photos.id"))  # заполняется по завершении
+    received = Column(BigInteger, nullable=False, default=0)  # принято байт; дальше в .part - недописанный хвост
+    writing_since = Column(DateTime)  # кусок сейчас пишет какой-то воркер
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Инструмент (насосы, вентиляторы, шланги) и его выдача на объекты по интервалам времени
+class Tool(Base):
+    __tablename__ = "tools"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(200), nullable=False)
+    kind = Column(String(50), nullable=False, index=True)  # pump, fan, hose, ...
+    serial = Column(String(100), unique=True)
+    location = Column(String(200))  # где инструмент хранится
+    latitude = Column(Float)  # место хранения по справочнику gazetteer
+    longitude = Column(Float)
+    status = Column(String(20), nullable=False, default="active")  # active, maintenance, retired
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+@event.listens_for(Tool, "before_insert")
+@event.listens_for(Tool, "before_update")
+def _tool_geocode(mapper, connection, target):
+    if not inspect(target).attrs.location.history.has_changes():
+        return
+    place = geocode(target.location, load_gazetteer(connection))
+    target.latitude, target.longitude = (place[0], place[1]) if place is not None else (None, None)
+
+class ToolAssignment(Base):
+    __tablename__ = "tool_assignments"
+
+    id = Column(Integer, primary_key=True)
+    tool_id = Column(Integer, ForeignKey("tools.id"), nullable=False)
+    object_id = Column(Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False, index=True)
+    foreman = Column(String(200))
+    starts_at = Column(DateTime, nullable=False)
+    ends_at = Column(DateTime, nullable=False)  # плановый возврат; при возврате - фактический
+    checked_out_at = Column(DateTime)  # None - бронь, инструмент ещё не забрали
+    checked_in_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Пересечение с окном: ends_at > from отсекает всю прошлую историю инструмента,
+        # так что поиск не замедляется с ростом числа выдач
+        Index("ix_tool_assignments_busy", "tool_id", "ends_at", "starts_at"),
+        # Выданные и не возвращённые - заняты, даже если плановый срок прошёл
+        Index("ix_tool_assignments_open", "tool_id", "checked_in_at", "ends_at"),
+    )
+
+@event.listens_for(Report, "after_insert")
+@event.listens_for(Report, "after_update")
+def _report_after_write(mapper, connection, target):
+    record_changes(connection, "report", [(target.id, "upsert")])
+
+@event.listens_for(Report, "after_delete")
+def _report_after_delete(mapper, connection, target):
+    record_changes(connection, "report", [(target.id, "delete")])
+
+@event.listens_for(Session, "before_flush")
+def _lock_change_log_before_flush(session, flush_context, instances):
+    if any(isinstance(item, (Object, Report)) for item in chain(session.new, session.dirty, session.deleted)):
+        lock_change_log(session.connection())
+
+# Таблицы уже созданы в этом процессе (или в мастере до fork)
+schema_ready = False
+SCHEMA_LOCK_ID = 20260221  # ключ pg_advisory_lock для DDL при старте
+
+@contextmanager
+def schema_lock():
+    """Межпроцессная блокировка на время создания схемы:
+    pg_advisory_lock на PostgreSQL, flock на файле рядом с базой для SQLite"""
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_ID})
+                connection.commit()
+        return
     try:
-        Base.metadata.create_all(bind=engine)
-        print("✅ Таблицы базы данных созданы/проверены")
-        
-        # Добавляем тестовые данные если таблица пустая
-        db = SessionLocal()
+        import fcntl
+    except ImportError:  # Windows - локальная разработка в один процесс
+        yield
+        return
+    database = engine.url.database
+    lock_path = (database if database and database != ":memory:" else os.path.join(tempfile.gettempdir(), "vega_crm")) + ".lock"
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
         try:
-            count = db.query(Object).count()
-            if count == 0:
-                test_objects = [
-                    Object(
-                        name="Резервуар РВС-5000",
-                        location="Екатеринбург",
-                        customer="ООО Нефтегаз",
-                        status="in_progress",
-                        budget=2500000,
-                        start_date=datetime(2026, 1, 15),
-                        end_date=datetime(2026, 3, 30),
-                        progress=65,
-                        description="Зачистка резервуара дизельного топлива"
-                    ),
-                    Object(
-                        name="Резервуар РГС-100",
-                        location="Челябинск",
-                        customer="АО Энергетика",
-                        status="planning",
-                        budget=500000,
-                        start_date=datetime(2026, 3, 1),
-                        end_date=datetime(2026, 4, 15),
-                        progress=0,
-                        description="Малый резервуар для технических нужд"
-                    ),
-                    Object(
-                        name="Резервуар 50 000 м³",
-                        location="Сабетта, ЯНАО",
-                        customer="ЯНАО Терминал",
-                        status="completed",
-                        budget=15000000,
-                        start_date=datetime(2025, 10, 1),
-                        end_date=datetime(2025, 12, 20),
-                        progress=100,
-                        description="Крупный резервуар на арктическом терминале"
-                    ),
-                    Object(
-                        name="Резервуар 20 000 м³",
-                        location="Варандей",
-                        customer="ООО Варандейский терминал",
-                        status="in_progress",
-                        budget=8000000,
-                        start_date=datetime(2026, 1, 10),
-                        end_date=datetime(2026, 5, 30),
-                        progress=40,
-                        description="Резервуар для хранения нефтепродуктов"
-                    ),
-                    Object(
-                        name="Резервуар 10 000 м³",
-                        location="Кемерово",
-                        customer="АО Кузбассразрезуголь",
-                        status="planning",
-                        budget=4500000,
-                        start_date=datetime(2026, 4, 1),
-                        end_date=datetime(2026, 6, 30),
-                        progress=0,
-                        description="Резервуар для угольного производства"
-                    )
-                ]
-                db.add_all(test_objects)
-                db.commit()
-                print(f"✅ Добавлено {len(test_objects)} тестовых объектов")
-            else:
-                print(f"✅ В базе уже есть {count} объектов")
+            yield
         finally:
-            db.close()
-            
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Версионированные миграции схемы. Применённые записываются в schema_version,
+# при старте сверяется только номер последней - без create_all и интроспекции.
+# Каждая миграция работает со своим снимком схемы (SCHEMA_V1, сырой DDL), а не
+# с моделями, и пишется так, чтобы повторное применение было безопасным
+# (add_column, build_index с проверкой существования) - базы до миграций
+# уже могут содержать часть таблиц и колонок.
+MIGRATIONS = []
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+def migration(version, description, transactional=True):
+    """Регистрирует миграцию. transactional=False - для DDL, который нельзя выполнять
+    в транзакции (CREATE INDEX CONCURRENTLY): соединение получает AUTOCOMMIT."""
+    def register(function):
+        MIGRATIONS.append((version, description, transactional, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return register
+
+def add_column(connection, table_name, column_name, ddl):
+    if column_name not in {column["name"] for column in inspect(connection).get_columns(table_name)}:
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl}"))
+
+def build_index(connection, name, table_name, columns, unique=False, using=None):
+    """PostgreSQL: CREATE INDEX CONCURRENTLY - таблица доступна на запись всё время
+    построения. Прерванная сборка оставляет невалидный индекс - его пересоздаём."""
+    unique = "UNIQUE " if unique else ""
+    using = f"USING {using} " if using else ""
+    if connection.dialect.name != "postgresql":
+        connection.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS {name} ON {table_name} {using}({columns})"))
+        return
+    invalid = connection.execute(text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    connection.execute(text(
+        f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table_name} {using}({columns})"
+    ))
+
+# Схема на момент миграции 1. Миграции не опираются на модели: модели описывают
+# последнюю версию, а база при обновлении проходит через все промежуточные.
+# Новые колонки и таблицы добавляют следующие миграции, этот снимок не меняется.
+SCHEMA_V1 = MetaData()
+
+Table(
+    "customers", SCHEMA_V1,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(200), nullable=False, unique=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "objects", SCHEMA_V1,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String(200), nullable=False),
+    Column("location", String(200)),
+    Column("customer", String(200)),
+    Column("customer_id", Integer, ForeignKey("customers.id")),
+    Column("status", String(50)),
+    Column("budget", Integer),
+    Column("start_date", DateTime),
+    Column("end_date", DateTime),
+    Column("progress", Integer),
+    Column("description", Text),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("updated_at", DateTime, default=datetime.utcnow, index=True),
+    Index("ix_objects_start_end", "start_date", "end_date"),
+    Index("ix_objects_customer_id", "customer_id", "id"),
+    Index("ix_objects_status", "status"),
+    Index("ix_objects_customer", "customer"),
+)
+Table(
+    "object_stats", SCHEMA_V1,
+    Column("status", String(50), primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+    Column("budget_sum", BigInteger, nullable=False, default=0),
+)
+Table(
+    "customer_stats", SCHEMA_V1,
+    Column("customer_id", Integer, ForeignKey("customers.id"), primary_key=True),
+    Column("status", String(50), primary_key=True),
+    Column("count", Integer, nullable=False, default=0),
+    Column("budget_sum", BigInteger, nullable=False, default=0),
+    Column("progress_sum", BigInteger, nullable=False, default=0),
+)
+Table(
+    "change_log", SCHEMA_V1,
+    Column("seq", Integer, primary_key=True, autoincrement=True),
+    Column("entity", String(20), nullable=False),
+    Column("entity_id", Integer, nullable=False),
+    Column("op", String(10), nullable=False),
+    Column("changed_at", DateTime, default=datetime.utcnow),
+    Index("ix_change_log_entity", "entity", "entity_id", "seq"),
+)
+Table(
+    "progress_history", SCHEMA_V1,
+    Column("id", Integer, primary_key=True),
+    Column("object_id", Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False),
+    Column("progress", Integer, nullable=False),
+    Column("recorded_at", DateTime, nullable=False, default=datetime.utcnow),
+    Index("ix_progress_history_object", "object_id", "recorded_at"),
+)
+Table(
+    "object_schedule", SCHEMA_V1,
+    Column("object_id", Integer, ForeignKey("objects.id", ondelete="CASCADE"), primary_key=True),
+    Column("velocity", Float),
+    Column("projected_end", DateTime),
+    Column("variance_days", Float, index=True),
+    Column("computed_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "reports", SCHEMA_V1,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("object_id", Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False, index=True),
+    Column("author", String(200)),
+    Column("report_date", DateTime, default=datetime.utcnow),
+    Column("text", Text),
+    Column("progress", Integer),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("updated_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "report_photos", SCHEMA_V1,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("report_id", Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False, index=True),
+    Column("sha256", String(64), nullable=False, index=True),
+    Column("size", BigInteger, nullable=False),
+    Column("content_type", String(100)),
+    Column("filename", String(255)),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "photo_uploads", SCHEMA_V1,
+    Column("id", String(32), primary_key=True),
+    Column("report_id", Integer, ForeignKey("reports.id", ondelete="CASCADE"), nullable=False, index=True),
+    Column("filename", String(255)),
+    Column("content_type", String(100)),
+    Column("size", BigInteger, nullable=False),
+    Column("sha256", String(64)),
+    Column("photo_id", Integer, ForeignKey("report_photos.id")),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "tools", SCHEMA_V1,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(200), nullable=False),
+    Column("kind", String(50), nullable=False, index=True),
+    Column("serial", String(100), unique=True),
+    Column("location", String(200)),
+    Column("status", String(20), nullable=False, default="active"),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("updated_at", DateTime, default=datetime.utcnow),
+)
+Table(
+    "tool_assignments", SCHEMA_V1,
+    Column("id", Integer, primary_key=True),
+    Column("tool_id", Integer, ForeignKey("tools.id"), nullable=False),
+    Column("object_id", Integer, ForeignKey("objects.id", ondelete="CASCADE"), nullable=False, index=True),
+    Column("foreman", String(200)),
+    Column("starts_at", DateTime, nullable=False),
+    Column("ends_at", DateTime, nullable=False),
+    Column("checked_out_at", DateTime),
+    Column("checked_in_at", DateTime),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Index("ix_tool_assignments_busy", "tool_id", "ends_at", "starts_at"),
+    Index("ix_tool_assignments_open", "tool_id", "checked_in_at", "ends_at"),
+)
+Table(
+    "export_jobs", SCHEMA_V1,
+    Column("id", String(32), primary_key=True),
+    Column("kind", String(20), nullable=False),
+    Column("target_id", Integer, nullable=False),
+    Column("format", String(10), nullable=False),
+    Column("cache_key", String(64), nullable=False, index=True),
+    Column("status", String(20), nullable=False, default="queued"),
+    Column("size", BigInteger),
+    Column("error", Text),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("finished_at", DateTime),
+)
+
+@migration(1, "базовая схема")
+def migrate_base_schema(connection):
+    SCHEMA_V1.create_all(bind=connection)
+    # Колонка появилась вместе с таблицей customers - в базах до миграций её нет
+    add_column(connection, "objects", "customer_id", "INTEGER REFERENCES customers(id)")
+    create_tool_constraints(connection)
+
+@migration(2, "индексы горячих путей objects", transactional=False)
+def migrate_object_indexes(connection):
+    # Базы до миграций: таблица objects уже была, create_all её индексы не создаёт
+    for name, columns in (
+        ("ix_objects_customer", "customer"),
+        ("ix_objects_customer_id", "customer_id, id"),
+        ("ix_objects_id", "id"),
+        ("ix_objects_start_end", "start_date, end_date"),
+        ("ix_objects_status", "status"),
+        ("ix_objects_updated_at", "updated_at"),
+    ):
+        build_index(connection, name, "objects", columns)
+
+SEED_OBJECTS = [
+    {
+        "name": "Резервуар РВС-5000",
+        "location": "Екатеринбург",
+        "customer": "ООО Нефтегаз",
+        "status": "in_progress",
+        "budget": 2500000,
+        "start_date": datetime(2026, 1, 15),
+        "end_date": datetime(2026, 3, 30),
+        "progress": 65,
+        "description": "Зачистка резервуара дизельного топлива"
+    },
+    {
+        "name": "Резервуар РГС-100",
+        "location": "Челябинск",
+        "customer": "АО Энергетика",
+        "status": "planning",
+        "budget": 500000,
+        "start_date": datetime(2026, 3, 1),
+        "end_date": datetime(2026, 4, 15),
+        "progress": 0,
+        "description": "Малый резервуар для технических нужд"
+    },
+    {
+        "name": "Резервуар 50 000 м³",
+        "location": "Сабетта, ЯНАО",
+        "customer": "ЯНАО Терминал",
+        "status": "completed",
+        "budget": 15000000,
+        "start_date": datetime(2025, 10, 1),
+        "end_date": datetime(2025, 12, 20),
+        "progress": 100,
+        "description": "Крупный резервуар на арктическом терминале"
+    },
+    {
+        "name": "Резервуар 20 000 м³",
+        "location": "Варандей",
+        "customer": "ООО Варандейский терминал",
+        "status": "in_progress",
+        "budget": 8000000,
+        "start_date": datetime(2026, 1, 10),
+        "end_date": datetime(2026, 5, 30),
+        "progress": 40,
+        "description": "Резервуар для хранения нефтепродуктов"
+    },
+    {
+        "name": "Резервуар 10 000 м³",
+        "location": "Кемерово",
+        "customer": "АО Кузбассразрезуголь",
+        "status": "planning",
+        "budget": 4500000,
+        "start_date": datetime(2026, 4, 1),
+        "end_date": datetime(2026, 6, 30),
+        "progress": 0,
+        "description": "Резервуар для угольного производства"
+    }
+]
+
+@migration(3, "тестовые данные и заполнение сводок")
+def migrate_seed_and_backfill(connection):
+    # Таблицы из снимка SCHEMA_V1: на этом шаге в базе ещё нет колонок следующих миграций
+    tables = SCHEMA_V1.tables
+    objects, customers = tables["objects"], tables["customers"]
+    count = connection.execute(select(func.count()).select_from(objects)).scalar()
+    if count == 0:
+        connection.execute(objects.insert(), SEED_OBJECTS)
+        print(f"✅ Добавлено {len(SEED_OBJECTS)} тестовых объектов")
+    else:
+        print(f"✅ В базе уже есть {count} объектов")
+
+    # Заказчики из текстового поля customer для объектов, записанных до появления customers
+    unresolved = and_(objects.c.customer.isnot(None), objects.c.customer_id.is_(None))
+    names = {name for (name,) in connection.execute(select(objects.c.customer).where(unresolved).distinct())}
+    names -= {name for (name,) in connection.execute(select(customers.c.name).where(customers.c.name.in_(names)))}
+    if names:
+        connection.execute(customers.insert(), [{"name": name} for name in sorted(names)])
+    connection.execute(
+        objects.update()
+        .where(unresolved)
+        .values(customer_id=select(customers.c.id).where(customers.c.name == objects.c.customer).scalar_subquery())
+    )
+
+    # Сводки пересобираются по данным: прежние версии их не вели
+    status = func.coalesce(objects.c.status, "")
+    connection.execute(tables["object_stats"].delete())
+    connection.execute(tables["object_stats"].insert().from_select(
+        ["status", "count", "budget_sum"],
+        select(status, func.count(), func.coalesce(func.sum(objects.c.budget), 0)).group_by(status)
+    ))
+    connection.execute(tables["customer_stats"].delete())
+    connection.execute(tables["customer_stats"].insert().from_select(
+        ["customer_id", "status", "count", "budget_sum", "progress_sum"],
+        select(
+            objects.c.customer_id, status, func.count(),
+            func.coalesce(func.sum(objects.c.budget), 0), func.coalesce(func.sum(objects.c.progress), 0)
+        ).where(objects.c.customer_id.isnot(None)).group_by(objects.c.customer_id, status)
+    ))
+    print("✅ Заказчики и сводки заполнены")
+
+    # История прогресса начинается с текущего значения, прогноз - для всех объектов
+    history, schedule = tables["progress_history"], tables["object_schedule"]
+    if connection.execute(select(history.c.id).limit(1)).first() is None:
+        connection.execute(history.insert().from_select(
+            ["object_id", "progress", "recorded_at"],
+            select(objects.c.id, objects.c.progress, func.coalesce(objects.c.updated_at, func.now()))
+            .where(objects.c.progress.isnot(None))
+        ))
+    t = epoch_days(history.c.recorded_at, connection.dialect.name)
+    p = history.c.progress
+    points = {row[0]: tuple(float(value or 0) for value in row[1:6]) + (row[6],) for row in connection.execute(
+        select(history.c.object_id, func.count(), func.sum(t), func.sum(p), func.sum(t * p), func.sum(t * t), func.max(t))
+        .group_by(history.c.object_id)
+    )}
+    now = datetime.utcnow()
+    rows = []
+    for row in connection.execute(select(objects.c.id, objects.c.progress, objects.c.start_date, objects.c.end_date, objects.c.status)):
+        velocity, projected_end, variance_days = project_schedule(row.progress, row.start_date, row.end_date, row.status, points.get(row.id))
+        rows.append({
+            "object_id": row.id, "velocity": velocity, "projected_end": projected_end,
+            "variance_days": variance_days, "computed_at": now
+        })
+    connection.execute(schedule.delete())
+    if rows:
+        connection.execute(schedule.insert(), rows)
+
+    # Объекты, созданные до появления журнала, иначе не попадут к клиентам
+    change_log = tables["change_log"]
+    if connection.execute(select(change_log.c.seq).limit(1)).first() is None:
+        for source, entity in ((objects, "object"), (tables["reports"], "report")):
+            connection.execute(change_log.insert().from_select(
+                ["entity", "entity_id", "op", "changed_at"],
+                select(literal(entity), source.c.id, literal("upsert"), func.coalesce(source.c.updated_at, func.now()))
+                .order_by(source.c.id)
+            ))
+        print("✅ Журнал изменений заполнен текущими данными")
+
+# Справочник мест на момент миграции 4
+SCHEMA_V4 = MetaData()
+
+Table(
+    "gazetteer", SCHEMA_V4,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(200), nullable=False),
+    Column("name_key", String(200), nullable=False, unique=True),
+    Column("region", String(100)),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+)
+
+@migration(4, "координаты объектов и справочник мест")
+def migrate_object_geo(connection):
+    global _gazetteer
+    gazetteer = SCHEMA_V4.tables["gazetteer"]
+    gazetteer.create(bind=connection, checkfirst=True)
+    for name, ddl in (("latitude", "FLOAT"), ("longitude", "FLOAT"), ("geohash", "VARCHAR(12)"), ("region", "VARCHAR(100)")):
+        add_column(connection, "objects", name, ddl)
+    if connection.execute(select(gazetteer.c.id).limit(1)).first() is None:
+        connection.execute(gazetteer.insert(), [
+            {"name": name, "name_key": place_key(name), "region": region, "latitude": latitude, "longitude": longitude}
+            for name, region, latitude, longitude in GAZETTEER
+        ])
+        _gazetteer = None
+    places = {
+        row.name_key: (row.latitude, row.longitude, row.region)
+        for row in connection.execute(select(gazetteer.c.name_key, gazetteer.c.latitude, gazetteer.c.longitude, gazetteer.c.region))
+    }
+    objects = table(
+        "objects", column("id"), column("location"),
+        column("latitude"), column("longitude"), column("geohash"), column("region")
+    )
+    rows = connection.execute(
+        select(objects.c.id, objects.c.location).where(objects.c.latitude.is_(None), objects.c.location.isnot(None))
+    ).all()
+    located = [dict(object_geo(places, row.location), object_id=row.id) for row in rows]
+    located = [row for row in located if row["latitude"] is not None]
+    if located:
+        connection.execute(objects.update().where(objects.c.id == bindparam("object_id")), located)
+        # Офлайн-клиенты получат координаты обычной дельтой синхронизации
+        lock_change_log(connection)
+        now = datetime.utcnow()
+        connection.execute(SCHEMA_V1.tables["change_log"].insert(), [
+            {"entity": "object", "entity_id": row["object_id"], "op": "upsert", "changed_at": now} for row in located
+        ])
+        print(f"✅ Координаты определены для {len(located)} из {len(rows)} объектов")
+    create_spatial_index(connection)
+
+@migration(5, "пространственные индексы objects", transactional=False)
+def migrate_geo_indexes(connection):
+    # Кандидаты по прямоугольнику и кластеры по префиксу geohash
+    build_index(connection, "ix_objects_lat_lon", "objects", "latitude, longitude")
+    build_index(connection, "ix_objects_geohash", "objects", "geohash")
+    if connection.dialect.name == "postgresql":
+        create_postgis_index(connection)
+
+@migration(6, "смещение загрузок фото в БД")
+def migrate_upload_offsets(connection):
+    add_column(connection, "photo_uploads", "received", "BIGINT NOT NULL DEFAULT 0")
+    add_column(connection, "photo_uploads", "writing_since", "TIMESTAMP")
+    # До миграции смещением был размер .part-файла - начатые загрузки продолжаются с него
+    rows = connection.execute(text("SELECT id FROM photo_uploads WHERE photo_id IS NULL")).all()
+    for (upload_id,) in rows:
+        if os.path.exists(partial_path(upload_id)):
+            connection.execute(
+                text("UPDATE photo_uploads SET received = :received WHERE id = :id"),
+                {"received": os.path.getsize(partial_path(upload_id)), "id": upload_id}
+            )
+
+@migration(7, "отметка живости заданий экспорта")
+def migrate_export_heartbeat(connection):
+    add_column(connection, "export_jobs", "heartbeat_at", "TIMESTAMP")
+
+@migration(8, "поисковые индексы objects", transactional=False)
+def migrate_search_indexes(connection):
+    if connection.dialect.name == "postgresql":
+        create_search_index(connection)
+        return
+    # FTS5-таблица и её триггеры - обычный DDL SQLite: целиком или никак
+    with engine.begin() as transaction:
+        create_search_index(transaction)
+
+@migration(9, "координаты мест хранения инструмента")
+def migrate_tool_geo(connection):
+    add_column(connection, "tools", "latitude", "FLOAT")
+    add_column(connection, "tools", "longitude", "FLOAT")
+    gazetteer = SCHEMA_V4.tables["gazetteer"]
+    places = {
+        row.name_key: (row.latitude, row.longitude, row.region)
+        for row in connection.execute(select(gazetteer.c.name_key, gazetteer.c.latitude, gazetteer.c.longitude, gazetteer.c.region))
+    }
+    tools = table("tools", column("id"), column("location"), column("latitude"), column("longitude"))
+    located = []
+    for row in connection.execute(select(tools.c.id, tools.c.location).where(tools.c.location.isnot(None))):
+        place = geocode(row.location, places)
+        if place is not None:
+            located.append({"tool_id": row.id, "latitude": place[0], "longitude": place[1]})
+    if located:
+        connection.execute(tools.update().where(tools.c.id == bindparam("tool_id")), located)
+        print(f"✅ Координаты определены для {len(located)} инструментов")
+
+def current_schema_version():
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+    except Exception:
+        return 0  # schema_version ещё нет - база до миграций или пустая
+
+def migrate():
+    """Применяет недостающие миграции по порядку; актуальная база - один SELECT"""
+    latest = MIGRATIONS[-1][0]
+    if current_schema_version() >= latest:
+        return 0
+    applied = 0
+    # Несколько воркеров/контейнеров: миграции выполняет только один
+    with schema_lock():
+        current = current_schema_version()  # пока ждали блокировку, мог успеть другой процесс
+        SchemaVersion.__table__.create(bind=engine, checkfirst=True)
+        for version, description, transactional, function in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            if transactional:
+                with engine.begin() as connection:
+                    function(connection)
+                    connection.execute(insert(SchemaVersion).values(version=version, description=description, applied_at=datetime.utcnow()))
+            else:
+                with engine.connect() as connection:
+                    function(connection.execution_options(isolation_level="AUTOCOMMIT"))
+                with engine.begin() as connection:
+                    connection.execute(insert(SchemaVersion).values(version=version, description=description, applied_at=datetime.utcnow()))
+            applied += 1
+            print(f"✅ Миграция {version}: {description} ({(time.perf_counter() - started) * 1000:.0f} мс)")
+    return applied
+
+# Функция для подготовки базы (вызывается при запуске)
+def create_tables():
+    global schema_ready
+    try:
+        migrate()
+        print(f"✅ Схема базы данных актуальна (версия {MIGRATIONS[-1][0]})")
+        schema_ready = True
     except Exception as e:
         print(f"⚠️ Ошибка при создании таблиц: {e}")
         print("⚠️ Продолжаем без базы данных")
@@ -144,7 +1545,37 @@ def create_tables():
 # Создаём таблицы при запуске (но не при импорте)
 @app.on_event("startup")
 async def startup_event():
-    create_tables()
+    # В production-режиме схему уже подготовил мастер-процесс до fork
+    global _probe_task
+    if not schema_ready:
+        create_tables()
+    if AsyncSessionLocal is not None and schema_ready:
+        try:
+            async with AsyncSessionLocal() as db:
+                orphaned = await fail_orphaned_exports(db)
+            if orphaned:
+                print(f"⚠️ Заданий экспорта без воркера: {orphaned}, помечены failed")
+        except Exception as e:
+            print(f"⚠️ Не удалось проверить задания экспорта: {e}")
+    if probe_engine is not None:
+        # Первая проверка до приёма трафика - /readyz сразу отвечает по факту
+        await probe_database()
+        await replica_router.refresh()
+        _probe_task = asyncio.create_task(probe_loop())
+    await event_hub.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await event_hub.stop()
+    if _probe_task is not None:
+        _probe_task.cancel()
+    for pool in (_thumbnail_pool, _export_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    for pool_engine in (async_engine, probe_engine):
+        if pool_engine is not None:
+            await pool_engine.dispose()
+    await replica_router.dispose()
 
 # API endpoints
 @app.get("/")
@@ -155,104 +1586,3131 @@ async def root():
         "description": "CRM для компании 'Вега' - контроль объектов по зачистке резервуаров",
         "endpoints": {
             "health": "/api/health",
+            "livez": "/livez",
+            "readyz": "/readyz",
+            "db_pool": "/api/db/pool",
             "objects": "/api/objects",
+            "search": "/api/objects/search",
+            "nearby": "/api/objects/nearby",
+            "clusters": "/api/objects/clusters",
+            "customers": "/api/customers",
+            "exports": "/api/exports",
+            "schedule": "/api/analytics/schedule",
+            "tools": "/api/tools",
             "gantt": "/api/gantt",
             "stats": "/api/stats",
+            "reports": "/api/reports",
+            "sync": "/api/sync",
+            "events": "/api/events",
             "docs": "/docs"
         }
     }
 
+def database_state():
+    """Последний результат фоновой проверки БД; сама проверка здесь не выполняется"""
+    stale = db_breaker.checked_at is None or time.monotonic() - db_breaker.checked_at > 3 * DB_PROBE_INTERVAL + DB_PROBE_TIMEOUT
+    connected = probe_engine is not None and not db_breaker.is_open and db_breaker.failures == 0 and not stale
+    return connected, {
+        "database": "connected" if connected else "disconnected",
+        "breaker": "open" if db_breaker.is_open else "closed",
+        "failures": db_breaker.failures,
+        "error": db_breaker.error,
+        "latency_ms": round(db_breaker.latency * 1000, 1) if db_breaker.latency is not None else None,
+        "last_ok": db_breaker.last_ok,
+        "checked_ago": round(time.monotonic() - db_breaker.checked_at, 1) if db_breaker.checked_at is not None else None
+    }
+
 @app.get("/api/health")
 async def health():
+    connected, state = database_state()
+    return {"status": "healthy" if connected else "degraded", **state, "timestamp": datetime.utcnow().isoformat()}
+
+@app.get("/livez", include_in_schema=False)
+async def livez():
+    """Процесс жив и event loop отвечает; БД не трогаем - её падение не повод перезапускать контейнер"""
+    return {"status": "alive"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Готов принимать трафик: схема применена и последняя проверка БД успешна"""
+    connected, state = database_state()
+    ready = connected and schema_ready
+    return FastJSONResponse(
+        {"status": "ready" if ready else "not_ready", "schema": "ready" if schema_ready else "pending", **state},
+        status_code=200 if ready else 503,
+        headers=None if ready else {"Retry-After": db_breaker.retry_after()}
+    )
+
+# Поля объекта, доступные для выборки через ?fields=
+OBJECT_FIELDS = {
+    "id": Object.id,
+    "name": Object.name,
+    "location": Object.location,
+    "customer": Object.customer,
+    "customer_id": Object.customer_id,
+    "status": Object.status,
+    "budget": Object.budget,
+    "progress": Object.progress,
+    "start_date": Object.start_date,
+    "end_date": Object.end_date,
+    "description": Object.description,
+    "latitude": Object.latitude,
+    "longitude": Object.longitude,
+    "region": Object.region
+}
+OBJECTS_PAGE_DEFAULT = 100
+OBJECTS_PAGE_MAX = 1000
+STREAM_BATCH_SIZE = 1000
+
+def parse_object_fields(fields):
+    """Список запрошенных полей; id всегда первым - по нему строится курсор"""
+    if not fields:
+        return list(OBJECT_FIELDS)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in OBJECT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [name for name in dict.fromkeys(names) if name != "id"]
+
+def build_objects_query(names, after=None, status=None, customer=None, location=None, customer_id=None):
+    """SELECT только нужных колонок с keyset-условием id > after"""
+    stmt = select(*(OBJECT_FIELDS[name] for name in names)).order_by(Object.id)
+    if customer_id is not None:
+        stmt = stmt.where(Object.customer_id == customer_id)
+    if after is not None:
+        stmt = stmt.where(Object.id > after)
+    if status:
+        stmt = stmt.where(Object.status == status)
+    if customer:
+        stmt = stmt.where(Object.customer == customer)
+    if location:
+        stmt = stmt.where(Object.location == location)
+    return stmt
+
+def columnar(names, rows):
+    """Компактный JSON: имена полей один раз, строки - массивами значений"""
+    return {"columns": list(names), "rows": [list(row) for row in rows]}
+
+async def stream_objects_ndjson(stmt, names, bind):
+    """Построчная выдача с серверного курсора - в памяти не больше одной пачки"""
+    async with bind.connect() as connection:
+        result = await connection.stream(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for row in result:
+            yield dumps_json(dict(zip(names, row))) + b"\n"
+
+@app.get("/api/objects")
+async def get_objects(
+    limit: Optional[int] = Query(None, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего объекта предыдущей страницы"),
+    status: Optional[str] = None,
+    customer: Optional[str] = None,
+    location: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Поля через запятую, например id,name,status"),
+    format: str = Query("json", pattern="^(json|ndjson|columnar)$"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    names = parse_object_fields(fields)
+    stmt = build_objects_query(names, after, status, customer, location)
+
+    if format == "ndjson":
+        # Без limit отдаём всю выборку потоком, с limit - одну страницу
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return StreamingResponse(stream_objects_ndjson(stmt, names, db.bind), media_type="application/x-ndjson")
+
+    page_size = limit or OBJECTS_PAGE_DEFAULT
     try:
-        # Проверяем подключение к базе
-        db = SessionLocal()
-        db.execute("SELECT 1")
-        db.close()
-        return {"status": "healthy", "database": "connected", "timestamp": datetime.utcnow().isoformat()}
+        # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+        rows = (await db.execute(stmt.limit(page_size + 1))).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if format == "columnar":
+            return FastJSONResponse(dict(
+                columnar(names, rows), count=len(rows), next_after=rows[-1][0] if has_more else None
+            ))
+        # Строки Row -> словари через zip, без isoformat и без jsonable_encoder
+        return FastJSONResponse({
+            "objects": [dict(zip(names, row)) for row in rows],
+            "count": len(rows),
+            "next_after": rows[-1][0] if has_more else None
+        })
     except Exception as e:
-        return {"status": "degraded", "database": "disconnected", "error": str(e), "timestamp": datetime.utcnow().isoformat()}
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-@app.get("/api/objects")
-async def get_objects():
+# Полнотекстовый поиск по name, location, customer, description.
+# PostgreSQL: GIN по to_tsvector('russian', ...) со стеммингом + GIN pg_trgm для опечаток.
+# SQLite (локальная разработка): FTS5 с триггерами, опечатки - через словарь индекса.
+SEARCH_COLUMNS = ("name", "location", "customer", "description")
+SEARCH_DOCUMENT = " || ' ' || ".join(f"coalesce({name}, '')" for name in SEARCH_COLUMNS)
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MAX_OFFSET = 1000  # глубже ранжированный поиск не листают - уточняют запрос
+FUZZY_CANDIDATES = 5  # вариантов исправления на одно слово
+_search_trigram = None  # pg_trgm установлен - проверяется один раз на процесс
+
+def create_search_index(connection):
+    """Индексы поиска; вызывается в миграции 8. PostgreSQL - CONCURRENTLY вне транзакции,
+    таблица objects остаётся доступной на запись, пока строится GIN"""
+    if connection.dialect.name == "postgresql":
+        build_index(connection, "ix_objects_search_tsv", "objects", f"to_tsvector('russian', {SEARCH_DOCUMENT})", using="gin")
+        try:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            build_index(connection, "ix_objects_search_trgm", "objects", f"lower({SEARCH_DOCUMENT}) gin_trgm_ops", using="gin")
+        except Exception as e:
+            print(f"⚠️ pg_trgm недоступен, поиск без исправления опечаток: {e}")
+    elif connection.dialect.name == "sqlite":
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'objects_fts'")).first()
+        if exists:
+            return
+        columns = ", ".join(SEARCH_COLUMNS)
+        new_values = ", ".join(f"new.{name}" for name in SEARCH_COLUMNS)
+        old_values = ", ".join(f"old.{name}" for name in SEARCH_COLUMNS)
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE objects_fts USING fts5({columns}, content='objects', content_rowid='id', "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        ))
+        connection.execute(text("CREATE VIRTUAL TABLE objects_fts_vocab USING fts5vocab(objects_fts, 'row')"))
+        connection.execute(text(
+            f"CREATE TRIGGER objects_fts_insert AFTER INSERT ON objects BEGIN "
+            f"INSERT INTO objects_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER objects_fts_delete AFTER DELETE ON objects BEGIN "
+            f"INSERT INTO objects_fts(objects_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER objects_fts_update AFTER UPDATE OF {columns} ON objects BEGIN "
+            f"INSERT INTO objects_fts(objects_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO objects_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        ))
+        connection.execute(text("INSERT INTO objects_fts(objects_fts) VALUES ('rebuild')"))
+        print("✅ Поисковый индекс FTS5 построен")
+
+def create_tool_constraints(connection):
+    """PostgreSQL: пересекающиеся выдачи одного инструмента запрещает сама БД"""
+    if connection.dialect.name != "postgresql":
+        return
+    exists_already = connection.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'tool_assignments_no_overlap'"
+    )).first()
+    if exists_already:
+        return
     try:
-        db = SessionLocal()
-        objects = db.query(Object).all()
-        result = []
-        for obj in objects:
-            result.append({
-                "id": obj.id,
-                "name": obj.name,
-                "location": obj.location,
-                "customer": obj.customer,
-                "status": obj.status,
-                "budget": obj.budget,
-                "progress": obj.progress,
-                "start_date": obj.start_date.isoformat() if obj.start_date else None,
-                "end_date": obj.end_date.isoformat() if obj.end_date else None,
-                "description": obj.description
-            })
-        db.close()
-        return {"objects": result, "count": len(result)}
+        with connection.begin_nested():
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+            connection.execute(text(
+                "ALTER TABLE tool_assignments ADD CONSTRAINT tool_assignments_no_overlap "
+                "EXCLUDE USING gist (tool_id WITH =, tsrange(starts_at, ends_at) WITH &&)"
+            ))
+    except Exception as e:
+        print(f"⚠️ btree_gist недоступен, двойную выдачу исключают только блокировки: {e}")
+
+def search_terms(q):
+    """Слова запроса в нижнем регистре; всё, кроме букв и цифр, отбрасывается"""
+    return re.findall(r"[^\W_]+", q.lower())[:10]
+
+def edit_distance(a, b, limit):
+    """Расстояние Левенштейна; больше limit не считаем - возвращаем limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+async def sqlite_fuzzy_terms(db, term):
+    """Варианты слова из словаря FTS5, если само слово (и как префикс) в индексе не встречается.
+    Первая буква считается верной - так кандидатов немного и поиск по словарю идёт по диапазону."""
+    found = (await db.execute(
+        text("SELECT 1 FROM objects_fts_vocab WHERE term >= :term AND term < :upper LIMIT 1"),
+        {"term": term, "upper": term + "\uffff"}
+    )).first()
+    if found or len(term) < 4:
+        return []
+    limit = 1 if len(term) < 8 else 2
+    rows = await db.execute(
+        text("SELECT term, cnt FROM objects_fts_vocab WHERE term >= :first AND term < :upper "
+             "AND length(term) BETWEEN :shortest AND :longest"),
+        {"first": term[0], "upper": term[0] + "\uffff", "shortest": len(term) - limit, "longest": len(term) + limit}
+    )
+    candidates = sorted(
+        (distance, -count, candidate) for candidate, count in rows
+        for distance in [edit_distance(term, candidate, limit)] if distance <= limit
+    )
+    return [candidate for _, _, candidate in candidates[:FUZZY_CANDIDATES]]
+
+async def search_objects_sqlite(db, terms, names, status, limit, offset, fuzzy):
+    groups = []
+    for term in terms:
+        variants = [f'"{term}"*'] + [f'"{candidate}"' for candidate in (await sqlite_fuzzy_terms(db, term) if fuzzy else [])]
+        groups.append("(" + " OR ".join(variants) + ")")
+    fts = table("objects_fts", column("rowid"))
+    # bm25: меньше - лучше; название весит больше описания
+    rank = literal_column("bm25(objects_fts, 10.0, 3.0, 3.0, 1.0)")
+    stmt = (
+        select(*(OBJECT_FIELDS[name] for name in names), (-rank).label("score"))
+        .select_from(Object).join(fts, fts.c.rowid == Object.id)
+        .where(text("objects_fts MATCH :match").bindparams(match=" AND ".join(groups)))
+        .order_by(rank, Object.id).limit(limit).offset(offset)
+    )
+    if status:
+        stmt = stmt.where(Object.status == status)
+    return (await db.execute(stmt)).all()
+
+async def search_objects_postgres(db, q, terms, names, status, limit, offset, fuzzy):
+    global _search_trigram
+    if _search_trigram is None:
+        _search_trigram = (await db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))).first() is not None
+    # Выражения совпадают с индексами из create_search_index - иначе планировщик их не возьмёт
+    document = func.to_tsvector(literal_column("'russian'"), literal_column(SEARCH_DOCUMENT))
+    # Каждое слово - префикс со стеммингом: "резерв" найдёт "резервуаров"
+    query = func.to_tsquery(literal_column("'russian'"), " & ".join(f"{term}:*" for term in terms))
+    match = document.op("@@")(query)
+    score = func.ts_rank_cd(document, query)
+    if fuzzy and _search_trigram:
+        # <% использует GIN pg_trgm и прощает опечатки
+        lowered = func.lower(literal_column(SEARCH_DOCUMENT))
+        match = match | literal(q.lower()).op("<%")(lowered)
+        score = score + func.word_similarity(q.lower(), lowered)
+    stmt = (
+        select(*(OBJECT_FIELDS[name] for name in names), score.label("score"))
+        .where(match)
+        .order_by(score.desc(), Object.id).limit(limit).offset(offset)
+    )
+    if status:
+        stmt = stmt.where(Object.status == status)
+    return (await db.execute(stmt)).all()
+
+@app.get("/api/objects/search")
+async def search_objects(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    status: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Поля через запятую, например id,name,status"),
+    fuzzy: bool = Query(True, description="Искать с учётом опечаток"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Ранжированный поиск: префиксы слов, опечатки, постраничная выдача через offset"""
+    names = parse_object_fields(fields)
+    terms = search_terms(q)
+    if not terms:
+        return FastJSONResponse({"objects": [], "count": 0, "next_offset": None})
+    try:
+        if db.bind.dialect.name == "postgresql":
+            rows = await search_objects_postgres(db, q, terms, names, status, limit + 1, offset, fuzzy)
+        else:
+            rows = await search_objects_sqlite(db, terms, names, status, limit + 1, offset, fuzzy)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return FastJSONResponse({
+        "objects": [dict(zip(names, row), score=round(float(row[-1]), 4)) for row in rows],
+        "count": len(rows),
+        "next_offset": offset + limit if has_more and offset + limit <= SEARCH_MAX_OFFSET else None
+    })
 
-@app.get("/api/gantt")
-async def get_gantt_data():
+# Гео-запросы: ближайшие объекты и кластеры для карты.
+# PostgreSQL + PostGIS: GiST по geography, KNN через <->. SQLite: R-tree objects_rtree
+# с триггерами. Без них - B-tree (latitude, longitude). В двух последних случаях индекс
+# отбирает кандидатов в описанных прямоугольниках, точное расстояние считается в Python.
+NEARBY_DEFAULT = 10
+NEARBY_MAX = 100
+NEARBY_START_RADIUS_KM = 25  # k ближайших без радиуса: круг растёт x4, пока не наберётся k
+NEARBY_KEYS = ("id", "name", "location", "customer", "status", "progress", "latitude", "longitude", "region")
+NEARBY_COLUMNS = [OBJECT_FIELDS[name] for name in NEARBY_KEYS]
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM  # половина окружности - весь шар
+OBJECTS_RTREE = table("objects_rtree", column("id"), column("min_lat"), column("max_lat"), column("min_lon"), column("max_lon"))
+_spatial_backend = None  # postgis, rtree или bbox - проверяется один раз на процесс
+
+class Geography(UserDefinedType):
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "geography"
+
+def geography_point(longitude, latitude):
+    return cast(func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326), Geography())
+
+# То же выражение, что в индексе ix_objects_geog - иначе планировщик его не использует
+OBJECT_GEOGRAPHY = geography_point(Object.longitude, Object.latitude)
+OBJECT_GEOGRAPHY_SQL = "CAST(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) AS geography)"
+
+def create_spatial_index(connection):
+    """SQLite: R-tree по координатам, синхронизируется триггерами; вызывается в миграции 4"""
+    if connection.dialect.name != "sqlite":
+        return
+    if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'objects_rtree'")).first():
+        return
     try:
-        db = SessionLocal()
-        objects = db.query(Object).all()
-        result = []
-        for obj in objects:
-            result.append({
-                "id": obj.id,
-                "name": obj.name,
-                "start": obj.start_date.isoformat() if obj.start_date else None,
-                "end": obj.end_date.isoformat() if obj.end_date else None,
-                "progress": obj.progress,
-                "status": obj.status
-            })
-        db.close()
-        return {"gantt_data": result}
+        connection.execute(text("CREATE VIRTUAL TABLE objects_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)"))
+    except Exception as e:
+        print(f"⚠️ Модуль R-tree недоступен, гео-запросы пойдут по индексу (latitude, longitude): {e}")
+        return
+    point = "new.id, new.latitude, new.latitude, new.longitude, new.longitude"
+    located = "new.latitude IS NOT NULL AND new.longitude IS NOT NULL"
+    for statement in (
+        f"CREATE TRIGGER objects_rtree_ai AFTER INSERT ON objects WHEN {located} BEGIN "
+        f"INSERT INTO objects_rtree VALUES ({point}); END",
+        f"CREATE TRIGGER objects_rtree_au AFTER UPDATE OF latitude, longitude ON objects BEGIN "
+        f"DELETE FROM objects_rtree WHERE id = old.id; "
+        f"INSERT INTO objects_rtree SELECT {point} WHERE {located}; END",
+        "CREATE TRIGGER objects_rtree_ad AFTER DELETE ON objects BEGIN "
+        "DELETE FROM objects_rtree WHERE id = old.id; END",
+        "INSERT INTO objects_rtree SELECT id, latitude, latitude, longitude, longitude FROM objects "
+        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL",
+    ):
+        connection.execute(text(statement))
+    print("✅ Пространственный индекс R-tree построен")
+
+def create_postgis_index(connection):
+    """PostgreSQL: GiST по geography, если PostGIS можно включить; вызывается в миграции 5"""
+    try:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+        build_index(connection, "ix_objects_geog", "objects", f"({OBJECT_GEOGRAPHY_SQL})", using="gist")
+    except Exception as e:
+        print(f"⚠️ PostGIS недоступен, гео-запросы пойдут по индексу (latitude, longitude): {e}")
+
+async def spatial_backend(db):
+    global _spatial_backend
+    if _spatial_backend is None:
+        if db.bind.dialect.name == "postgresql":
+            found = (await db.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_objects_geog'"))).first()
+            _spatial_backend = "postgis" if found else "bbox"
+        else:
+            found = (await db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'objects_rtree'"))).first()
+            _spatial_backend = "rtree" if found else "bbox"
+    return _spatial_backend
+
+def bounding_boxes(latitude, longitude, radius_km):
+    """Прямоугольники (lat_min, lat_max, lon_min, lon_max), покрывающие круг;
+    через 180-й меридиан (Чукотка) - два прямоугольника"""
+    angle = radius_km / EARTH_RADIUS_KM
+    lat_min, lat_max = latitude - math.degrees(angle), latitude + math.degrees(angle)
+    if lat_min <= -90 or lat_max >= 90:
+        # Круг накрывает полюс - подходит любая долгота
+        return [(max(lat_min, -90.0), min(lat_max, 90.0), -180.0, 180.0)]
+    delta = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(latitude)))))
+    lon_min, lon_max = longitude - delta, longitude + delta
+    if lon_min < -180:
+        return [(lat_min, lat_max, lon_min + 360, 180.0), (lat_min, lat_max, -180.0, lon_max)]
+    if lon_max > 180:
+        return [(lat_min, lat_max, lon_min, 180.0), (lat_min, lat_max, -180.0, lon_max - 360)]
+    return [(lat_min, lat_max, lon_min, lon_max)]
+
+def within_boxes(boxes, backend):
+    """Условие "объект в одном из прямоугольников" через R-tree или B-tree по координатам"""
+    if backend == "rtree":
+        # Пересечение, а не вложенность: R-tree хранит float32 и округляет границы наружу
+        queries = [
+            select(OBJECTS_RTREE.c.id).where(
+                OBJECTS_RTREE.c.max_lat >= lat_min, OBJECTS_RTREE.c.min_lat <= lat_max,
+                OBJECTS_RTREE.c.max_lon >= lon_min, OBJECTS_RTREE.c.min_lon <= lon_max
+            )
+            for lat_min, lat_max, lon_min, lon_max in boxes
+        ]
+        return Object.id.in_(queries[0] if len(queries) == 1 else union_all(*queries))
+    return or_(*(
+        and_(Object.latitude.between(lat_min, lat_max), Object.longitude.between(lon_min, lon_max))
+        for lat_min, lat_max, lon_min, lon_max in boxes
+    ))
+
+async def load_gazetteer_async(db):
+    return _gazetteer or build_places((await db.execute(
+        select(Gazetteer.name_key, Gazetteer.latitude, Gazetteer.longitude, Gazetteer.region)
+    )).all())
+
+async def nearby_center(db, latitude, longitude, object_id, location):
+    """Центр поиска: координаты, другой объект или место из справочника"""
+    if sum((latitude is not None or longitude is not None, object_id is not None, bool(location))) != 1:
+        raise HTTPException(status_code=400, detail="Specify exactly one of lat+lon, object_id or location")
+    if object_id is not None:
+        row = (await db.execute(select(Object.latitude, Object.longitude).where(Object.id == object_id))).first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Object not found")
+        if row.latitude is None:
+            raise HTTPException(status_code=422, detail="Object has no coordinates")
+        return row.latitude, row.longitude, "object"
+    if location:
+        place = geocode(location, await load_gazetteer_async(db))
+        if place is None:
+            raise HTTPException(status_code=404, detail=f"Unknown location: {location}")
+        return place[0], place[1], "gazetteer"
+    if latitude is None or longitude is None:
+        raise HTTPException(status_code=400, detail="lat and lon must be given together")
+    return latitude, longitude, "coordinates"
+
+@app.get("/api/objects/nearby")
+async def get_nearby_objects(
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    object_id: Optional[int] = Query(None, description="Искать рядом с этим объектом"),
+    location: Optional[str] = Query(None, description="Место из справочника, например Сургут"),
+    radius_km: Optional[float] = Query(None, gt=0, le=MAX_DISTANCE_KM),
+    limit: int = Query(NEARBY_DEFAULT, ge=1, le=NEARBY_MAX),
+    status: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """k ближайших объектов (в радиусе radius_km, если задан), по возрастанию расстояния"""
+    latitude, longitude, source = await nearby_center(db, lat, lon, object_id, location)
+    filters = [Object.latitude.isnot(None), Object.longitude.isnot(None)]
+    if status:
+        filters.append(Object.status == status)
+    if object_id is not None:
+        filters.append(Object.id != object_id)
+    try:
+        backend = await spatial_backend(db)
+        if backend == "postgis":
+            center = geography_point(longitude, latitude)
+            stmt = select(*NEARBY_COLUMNS, (func.ST_Distance(OBJECT_GEOGRAPHY, center) / 1000).label("distance")).where(*filters)
+            if radius_km is not None:
+                stmt = stmt.where(func.ST_DWithin(OBJECT_GEOGRAPHY, center, radius_km * 1000))
+            rows = await db.execute(stmt.order_by(OBJECT_GEOGRAPHY.op("<->")(center)).limit(limit))
+            found = [(row.distance, row) for row in rows]
+        else:
+            radius = radius_km or NEARBY_START_RADIUS_KM
+            while True:
+                rows = await db.execute(select(*NEARBY_COLUMNS).where(
+                    *filters, within_boxes(bounding_boxes(latitude, longitude, radius), backend)
+                ))
+                found = sorted(
+                    (item for item in ((distance_km(latitude, longitude, row.latitude, row.longitude), row) for row in rows)
+                     if item[0] <= radius),
+                    key=lambda item: item[0]
+                )
+                # В круге radius найдены все объекты - k ближайших среди них точные
+                if radius_km is not None or len(found) >= limit or radius >= MAX_DISTANCE_KM:
+                    break
+                radius = min(radius * 4, MAX_DISTANCE_KM)
+            found = found[:limit]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    objects = [dict(zip(NEARBY_KEYS, row), distance_km=round(float(distance), 3)) for distance, row in found]
+    return FastJSONResponse({
+        "center": {"latitude": latitude, "longitude": longitude, "source": source},
+        "radius_km": radius_km,
+        "objects": objects,
+        "count": len(objects),
+        "index": backend
+    })
 
-@app.get("/api/stats")
-async def get_stats():
+@app.get("/api/objects/clusters")
+async def get_object_clusters(
+    by: str = Query("geohash", pattern="^(geohash|region)$"),
+    precision: int = Query(3, ge=1, le=GEOHASH_PRECISION, description="Длина префикса geohash: 2 - пол-страны, 4 - город, 6 - площадка"),
+    bbox: Optional[str] = Query(None, description="Видимая область карты: min_lon,min_lat,max_lon,max_lat"),
+    status: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Объекты, сгруппированные в кластеры для карты: по префиксу geohash или по региону"""
+    filters = [Object.latitude.isnot(None), Object.longitude.isnot(None)]
+    if status:
+        filters.append(Object.status == status)
+    if bbox:
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(","))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="bbox must be min_lon,min_lat,max_lon,max_lat")
+        # min_lon > max_lon - окно карты через 180-й меридиан
+        boxes = [(min_lat, max_lat, min_lon, max_lon)] if min_lon <= max_lon else \
+            [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    key = (func.substr(Object.geohash, 1, precision) if by == "geohash" else Object.region).label("key")
     try:
-        db = SessionLocal()
-        total_objects = db.query(Object).count()
-        completed = db.query(Object).filter(Object.status == "completed").count()
-        in_progress = db.query(Object).filter(Object.status == "in_progress").count()
-        planning = db.query(Object).filter(Object.status == "planning").count()
-        
-        total_budget = db.query(Object).with_entities(func.sum(Object.budget)).scalar() or 0
-        
-        db.close()
-        
-        return {
-            "total_objects": total_objects,
-            "completed": completed,
-            "in_progress": in_progress,
-            "planning": planning,
-            "completion_rate": round((completed / total_objects * 100) if total_objects > 0 else 0, 1),
-            "total_budget": total_budget,
-            "average_budget": round(total_budget / total_objects) if total_objects > 0 else 0
-        }
+        if bbox:
+            backend = await spatial_backend(db)
+            filters.append(within_boxes(boxes, "rtree" if backend == "rtree" else "bbox"))
+        rows = await db.execute(
+            select(
+                key,
+                func.count(Object.id).label("count"),
+                func.avg(Object.latitude).label("latitude"),
+                func.avg(Object.longitude).label("longitude"),
+                func.min(Object.latitude), func.min(Object.longitude), func.max(Object.latitude), func.max(Object.longitude),
+                func.avg(Object.progress).label("progress"),
+                *(func.sum(case((Object.status == name, 1), else_=0)) for name in OBJECT_STATUSES)
+            ).where(*filters).group_by(key).order_by(func.count(Object.id).desc())
+        )
+        clusters = []
+        for row in rows:
+            clusters.append({
+                "key": row.key,
+                "count": row.count,
+                "latitude": round(row.latitude, 5),
+                "longitude": round(row.longitude, 5),
+                "bbox": [row[5], row[4], row[7], row[6]],
+                "progress": round(float(row.progress or 0), 1),
+                "statuses": {name: int(row[9 + index] or 0) for index, name in enumerate(OBJECT_STATUSES)}
+            })
+        unlocated = (await db.execute(select(func.count(Object.id)).where(
+            or_(Object.latitude.is_(None), Object.longitude.is_(None)), *([Object.status == status] if status else [])
+        ))).scalar()
     except Exception as e:
-        return {
-            "total_objects": 5,  # Fallback to test data
-            "completed": 1,
-            "in_progress": 2,
-            "planning": 2,
-            "completion_rate": 20.0,
-            "total_budget": 30450000,
-            "average_budget": 6090000
-        }
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return FastJSONResponse({
+        "by": by,
+        "precision": precision if by == "geohash" else None,
+        "clusters": clusters,
+        "count": len(clusters),
+        "unlocated": unlocated
+    })
+
+def period_start_expr(column, zoom, dialect_name):
+    """Начало периода (неделя/месяц/квартал/год), в который попадает дата"""
+    if dialect_name == "postgresql":
+        return func.date_trunc(zoom, column)
+    # SQLite: строковые даты, неделя начинается с понедельника
+    if zoom == "week":
+        return func.date(column, "weekday 0", "-6 days")
+    if zoom == "month":
+        return func.strftime("%Y-%m-01", column)
+    if zoom == "quarter":
+        quarter_month = (cast(func.strftime("%m", column), Integer) - 1) // 3 * 3 + 1
+        return func.printf("%s-%02d-01", func.strftime("%Y", column), quarter_month)
+    return func.strftime("%Y-01-01", column)
+
+def as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(value)
+
+def gantt_window(stmt, date_from, date_to):
+    """Только интервалы, пересекающие окно; условие покрывается ix_objects_start_end"""
+    if date_to is not None:
+        stmt = stmt.where(Object.start_date <= date_to)
+    if date_from is not None:
+        stmt = stmt.where(Object.end_date >= date_from)
+    return stmt
+
+# Запись объектов
+OBJECT_STATUSES = ("planning", "in_progress", "completed")
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 500))  # строк в одной транзакции
+
+class ObjectIn(BaseModel):
+    id: Optional[int] = Field(None, ge=1)
+    name: str = Field(..., min_length=1, max_length=200)
+    location: Optional[str] = Field(None, max_length=200)
+    customer: Optional[str] = Field(None, max_length=200)
+    status: str = Field("planning", pattern="^(planning|in_progress|completed)$")
+    budget: Optional[int] = Field(None, ge=0)
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    progress: int = Field(0, ge=0, le=100)
+    description: Optional[str] = None
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+class ObjectPatch(BaseModel):
+    name: Optional[str] = Field(None, min_length=1, max_length=200)
+    location: Optional[str] = Field(None, max_length=200)
+    customer: Optional[str] = Field(None, max_length=200)
+    status: Optional[str] = Field(None, pattern="^(planning|in_progress|completed)$")
+    budget: Optional[int] = Field(None, ge=0)
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    progress: Optional[int] = Field(None, ge=0, le=100)
+    description: Optional[str] = None
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+def validate_object_row(data):
+    """Проверка одной строки импорта; возвращает словарь колонок или бросает ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("row must be a JSON object")
+    try:
+        row = ObjectIn(**data).model_dump()
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+    if row["start_date"] and row["end_date"] and row["start_date"] > row["end_date"]:
+        raise ValueError("start_date is later than end_date")
+    if (row["latitude"] is None) != (row["longitude"] is None):
+        raise ValueError("latitude and longitude must be given together")
+    return row
+
+async def iter_request_rows(request):
+    """(данные, ошибка) для каждой строки тела: JSON-объект, JSON-массив или NDJSON.
+    NDJSON читается потоком, весь файл в памяти не держим."""
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type:
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    try:
+                        yield json.loads(line), None
+                    except ValueError as e:
+                        yield None, f"invalid JSON: {e}"
+        if buffer.strip():
+            try:
+                yield json.loads(buffer), None
+            except ValueError as e:
+                yield None, f"invalid JSON: {e}"
+        return
+    try:
+        payload = json.loads(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+    if isinstance(payload, dict) and isinstance(payload.get("objects"), list):
+        payload = payload["objects"]
+    for item in payload if isinstance(payload, list) else [payload]:
+        yield item, None
+
+def write_objects_sync(connection, rows):
+    """Пишет пачку строк одной транзакцией: executemany для новых,
+    INSERT ... ON CONFLICT (id) DO UPDATE для строк с id. Возвращает (created, updated).
+    Строки с id сюда попадают только из PUT - import_objects отсекает их для POST."""
+    table = Object.__table__
+    now = datetime.utcnow()
+    lock_change_log(connection)
+    customer_ids = resolve_customer_ids(connection, [row.get("customer") for row in rows])
+    places = load_gazetteer(connection)
+    rows = [
+        dict(row, customer_id=customer_ids.get(row.get("customer")),
+             **object_geo(places, row.get("location"), row.get("latitude"), row.get("longitude")))
+        for row in rows
+    ]
+    fresh = [dict(row, created_at=now, updated_at=now) for row in rows if row.get("id") is None]
+    keyed = [dict(row, updated_at=now) for row in rows if row.get("id") is not None]
+    changes = []
+    created, updated = [], []
+
+    if fresh:
+        for row in fresh:
+            row.pop("id", None)
+        result = connection.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True), fresh)
+        for row, new_id in zip(fresh, result.scalars()):
+            created.append(new_id)
+            changes.append((None, {"id": new_id, **{f: row[f] for f in TRACKED_OBJECT_FIELDS}}))
+
+    if keyed:
+        existing_stmt = select(table.c.id, *(table.c[f] for f in TRACKED_OBJECT_FIELDS)).where(
+            table.c.id.in_([row["id"] for row in keyed])
+        )
+        if connection.dialect.name == "postgresql":
+            existing_stmt = existing_stmt.with_for_update()
+        existing = {row.id: dict(row._mapping) for row in connection.execute(existing_stmt)}
+
+        dialect_insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}.get(connection.dialect.name)
+        if dialect_insert is None:
+            raise ValueError(f"upsert is not supported for {connection.dialect.name}")
+        stmt = dialect_insert(table)
+        update_columns = [name for name in keyed[0] if name != "id"]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={name: stmt.excluded[name] for name in update_columns}
+        )
+        connection.execute(stmt, [dict(row, created_at=now) for row in keyed])
+
+        for row in keyed:
+            (updated if row["id"] in existing else created).append(row["id"])
+            changes.append((existing.get(row["id"]), {"id": row["id"], **{f: row[f] for f in TRACKED_OBJECT_FIELDS}}))
+        if connection.dialect.name == "postgresql" and len(existing) < len(keyed):
+            # Явные id не двигают последовательность - подтягиваем её, иначе следующий INSERT упадёт
+            connection.execute(text("SELECT setval(pg_get_serial_sequence('objects', 'id'), (SELECT MAX(id) FROM objects))"))
+
+    on_objects_written(connection, changes)
+    return created, updated
+
+async def write_objects_chunk(indexed_rows, report):
+    """Пачка в одной транзакции; при ошибке БД пачка повторяется построчно,
+    чтобы в отчёт попали только виноватые строки"""
+    try:
+        async with async_engine.begin() as connection:
+            created, updated = await connection.run_sync(write_objects_sync, [row for _, row in indexed_rows])
+    except Exception as e:
+        if len(indexed_rows) == 1:
+            report["errors"].append({"index": indexed_rows[0][0], "error": str(e).splitlines()[0]})
+            return
+        for indexed_row in indexed_rows:
+            await write_objects_chunk([indexed_row], report)
+        return
+    response_cache.clear()
+    report["created"].extend(created)
+    report["updated"].extend(updated)
+
+async def aenumerate(iterable):
+    index = 0
+    async for item in iterable:
+        yield index, item
+        index += 1
+
+async def import_objects(request, upsert):
+    if async_engine is None:
+        raise HTTPException(status_code=503, detail="Async database driver is not installed")
+    report = {"created": [], "updated": [], "errors": []}
+    chunk = []
+    index = -1
+    async for index, (data, error) in aenumerate(iter_request_rows(request)):
+        if error is None:
+            try:
+                row = validate_object_row(data)
+                if row["id"] is not None and not upsert:
+                    raise ValueError("id is assigned by the server; use PUT /api/objects to upsert")
+                chunk.append((index, row))
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            report["errors"].append({"index": index, "error": error})
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await write_objects_chunk(chunk, report)
+            chunk = []
+    if chunk:
+        await write_objects_chunk(chunk, report)
+    report["errors"].sort(key=lambda item: item["index"])
+    return {
+        "received": index + 1,
+        "created": len(report["created"]),
+        "updated": len(report["updated"]),
+        "failed": len(report["errors"]),
+        "ids": report["created"] + report["updated"],
+        "errors": report["errors"]
+    }
+
+@app.post("/api/objects", status_code=201)
+async def create_objects(request: Request):
+    """Создание объектов: один JSON-объект, массив или NDJSON (application/x-ndjson)"""
+    return await import_objects(request, upsert=False)
+
+@app.put("/api/objects")
+async def upsert_objects(request: Request):
+    """Пакетный upsert: строки с id заменяют существующие объекты, без id - создаются"""
+    return await import_objects(request, upsert=True)
+
+def apply_object_patch(obj, patch):
+    """Правка объекта с проверками, общими для PATCH и офлайн-синхронизации;
+    ValueError - правка отклонена, объект не тронут"""
+    changes = patch.model_dump(exclude_unset=True)
+    if ("latitude" in changes) != ("longitude" in changes):
+        raise ValueError("latitude and longitude must be given together")
+    start_date = changes.get("start_date", obj.start_date)
+    end_date = changes.get("end_date", obj.end_date)
+    if start_date and end_date and start_date > end_date:
+        raise ValueError("start_date is later than end_date")
+    for field, value in changes.items():
+        setattr(obj, field, value)
+
+@app.patch("/api/objects/{object_id}")
+async def update_object(object_id: int, patch: ObjectPatch, db: AsyncSession = Depends(get_async_db)):
+    obj = await db.get(Object, object_id)
+    if obj is None:
+        raise HTTPException(status_code=404, detail="Object not found")
+    try:
+        apply_object_patch(obj, patch)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    await db.commit()
+    return FastJSONResponse({name: getattr(obj, name) for name in OBJECT_FIELDS})
+
+# Ключи ответа в порядке колонок SELECT
+GANTT_KEYS = ("id", "name", "start", "end", "progress", "status", "projected_end", "variance_days", "risk")
+GANTT_BUCKET_KEYS = ("period", "count", "start", "end", "progress", "completed", "at_risk")
+RISK_LEVELS = ("completed", "unscheduled", "overdue", "not_started", "at_risk", "stalled", "on_track")
+AT_RISK = {"overdue", "at_risk", "stalled"}
+SCHEDULE_CLOCK_SECONDS = 3600  # риск оценивается на начало часа: ответ стабилен в пределах часа
+CLOCK_PATHS = {"/api/gantt", "/api/analytics/schedule"}  # ответы зависят от текущего времени
+
+def schedule_now():
+    """Текущий момент для оценки риска, с шагом SCHEDULE_CLOCK_SECONDS. Входит в ETag
+    CLOCK_PATHS - кэш и 304 не отдают флаги риска, посчитанные на прошлый шаг."""
+    seconds = int((datetime.utcnow() - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % SCHEDULE_CLOCK_SECONDS)
+
+def risk_expr(now):
+    """Оценка риска прямо в SQL: фильтр и сводка по рискам не тянут строки в Python"""
+    return case(
+        (or_(Object.status == "completed", Object.progress >= 100), "completed"),
+        (Object.end_date.is_(None), "unscheduled"),
+        (Object.end_date < now, "overdue"),
+        (Object.start_date > now, "not_started"),
+        (ObjectSchedule.variance_days > SCHEDULE_TOLERANCE_DAYS, "at_risk"),
+        (or_(ObjectSchedule.velocity.is_(None), ObjectSchedule.velocity <= 0), "stalled"),
+        else_="on_track"
+    )
+
+def planned_progress(start_date, end_date, now):
+    """Сколько процентов должно быть готово к now при равномерном графике"""
+    if start_date is None or end_date is None or end_date <= start_date:
+        return None
+    share = (now - start_date).total_seconds() / (end_date - start_date).total_seconds()
+    return round(min(max(share, 0), 1) * 100, 1)
+
+@app.get("/api/gantt")
+async def get_gantt_data(
+    date_from: Optional[datetime] = Query(None, alias="from", description="Начало видимого окна"),
+    date_to: Optional[datetime] = Query(None, alias="to", description="Конец видимого окна"),
+    zoom: Optional[str] = Query(None, pattern="^(week|month|quarter|year)$", description="Свернуть объекты в полосы по периодам"),
+    format: str = Query("json", pattern="^(json|columnar)$"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    if date_from is not None and date_to is not None and date_from > date_to:
+        raise HTTPException(status_code=400, detail="'from' must not be later than 'to'")
+    try:
+        if zoom:
+            period = period_start_expr(Object.start_date, zoom, db.bind.dialect.name).label("period")
+            stmt = gantt_window(
+                select(
+                    period,
+                    func.count(Object.id).label("count"),
+                    func.min(Object.start_date).label("start"),
+                    func.max(Object.end_date).label("end"),
+                    func.avg(Object.progress).label("progress"),
+                    func.sum(case((Object.status == "completed", 1), else_=0)).label("completed"),
+                    func.sum(case((risk_expr(schedule_now()).in_(AT_RISK), 1), else_=0)).label("at_risk")
+                ).outerjoin(ObjectSchedule, ObjectSchedule.object_id == Object.id).where(Object.start_date.is_not(None)),
+                date_from, date_to
+            ).group_by(period).order_by(period)
+            rows = await db.execute(stmt)
+            buckets = []
+            for row in rows:
+                buckets.append({
+                    "period": as_datetime(row.period),
+                    "count": row.count,
+                    "start": as_datetime(row.start),
+                    "end": as_datetime(row.end),
+                    "progress": round(float(row.progress or 0), 1),
+                    "completed": int(row.completed or 0),
+                    "at_risk": int(row.at_risk or 0)
+                })
+            if format == "columnar":
+                return FastJSONResponse(dict(columnar(GANTT_BUCKET_KEYS, ([bucket[key] for key in GANTT_BUCKET_KEYS] for bucket in buckets)), zoom=zoom))
+            return FastJSONResponse({"gantt_data": buckets, "zoom": zoom})
+
+        rows = await db.execute(
+            gantt_window(
+                select(
+                    Object.id, Object.name, Object.start_date, Object.end_date, Object.progress, Object.status,
+                    ObjectSchedule.projected_end, ObjectSchedule.variance_days, risk_expr(schedule_now())
+                ).outerjoin(ObjectSchedule, ObjectSchedule.object_id == Object.id),
+                date_from, date_to
+            ).order_by(Object.start_date, Object.id)
+        )
+        if format == "columnar":
+            return FastJSONResponse(columnar(GANTT_KEYS, rows))
+        return FastJSONResponse({"gantt_data": [dict(zip(GANTT_KEYS, row)) for row in rows]})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+SCHEDULE_KEYS = ("id", "name", "status", "progress", "start_date", "end_date", "velocity", "projected_end", "variance_days", "risk")
+
+@app.get("/api/analytics/schedule")
+async def get_schedule_analytics(
+    risk: Optional[str] = Query(None, description="Уровни риска через запятую, например overdue,at_risk"),
+    customer_id: Optional[int] = None,
+    limit: int = Query(OBJECTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего объекта предыдущей страницы"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Отклонение от графика, прогноз окончания и риск по объектам из готовой проекции
+    object_schedule; сводка по уровням риска считается одним GROUP BY"""
+    levels = [level.strip() for level in risk.split(",") if level.strip()] if risk else []
+    unknown = [level for level in levels if level not in RISK_LEVELS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown risk levels: {', '.join(unknown)}")
+    now = schedule_now()
+    level = risk_expr(now).label("risk")
+
+    def scoped(stmt):
+        stmt = stmt.outerjoin(ObjectSchedule, ObjectSchedule.object_id == Object.id)
+        return stmt.where(Object.customer_id == customer_id) if customer_id is not None else stmt
+
+    try:
+        summary = dict((await db.execute(scoped(select(level, func.count(Object.id))).group_by(level))).all())
+        stmt = scoped(select(
+            Object.id, Object.name, Object.status, Object.progress, Object.start_date, Object.end_date,
+            ObjectSchedule.velocity, ObjectSchedule.projected_end, ObjectSchedule.variance_days, level
+        )).order_by(Object.id).limit(limit + 1)
+        if after is not None:
+            stmt = stmt.where(Object.id > after)
+        if levels:
+            stmt = stmt.where(risk_expr(now).in_(levels))
+        rows = (await db.execute(stmt)).all()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    objects = []
+    for row in rows:
+        item = dict(zip(SCHEDULE_KEYS, row))
+        item["velocity"] = round(item["velocity"], 2) if item["velocity"] is not None else None
+        item["planned_progress"] = planned_progress(row.start_date, row.end_date, now)
+        item["at_risk"] = row.risk in AT_RISK
+        objects.append(item)
+    return FastJSONResponse({
+        "objects": objects,
+        "count": len(objects),
+        "next_after": rows[-1][0] if has_more else None,
+        "summary": {name: summary.get(name, 0) for name in RISK_LEVELS},
+        "at_risk": sum(summary.get(name, 0) for name in AT_RISK),
+        "computed_at": now
+    })
+
+async def stats_snapshot(db):
+    """Статистика из готовой сводки: несколько строк вместо сканирования objects"""
+    summary = (await db.execute(select(ObjectStats))).scalars().all()
+    totals = {row.status: (row.count, row.budget_sum) for row in summary}
+
+    total_objects = sum(count for count, _ in totals.values())
+    total_budget = sum(budget for _, budget in totals.values())
+    completed = totals.get("completed", (0, 0))[0]
+    in_progress = totals.get("in_progress", (0, 0))[0]
+    planning = totals.get("planning", (0, 0))[0]
+
+    return {
+        "total_objects": total_objects,
+        "completed": completed,
+        "in_progress": in_progress,
+        "planning": planning,
+        "completion_rate": round((completed / total_objects * 100) if total_objects > 0 else 0, 1),
+        "total_budget": total_budget,
+        "average_budget": round(total_budget / total_objects) if total_objects > 0 else 0,
+        "by_status": {
+            status: {"count": count, "budget": budget}
+            for status, (count, budget) in totals.items()
+            if count
+        }
+    }
+
+@app.get("/api/stats")
+async def get_stats(db: AsyncSession = Depends(get_read_db)):
+    try:
+        return FastJSONResponse(await stats_snapshot(db))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+# Портал заказчика: всё по индексу customer_id и по сводке customer_stats
+CUSTOMER_PROGRESS_FIELDS = ["id", "name", "status", "progress", "start_date", "end_date"]
+
+def customer_json(customer, summary):
+    total_objects = sum(row.count for row in summary)
+    total_budget = sum(row.budget_sum for row in summary)
+    completed = sum(row.count for row in summary if row.status == "completed")
+    return {
+        "id": customer.id,
+        "name": customer.name,
+        "total_objects": total_objects,
+        "completed": completed,
+        "completion_rate": round((completed / total_objects * 100) if total_objects > 0 else 0, 1),
+        "total_budget": total_budget,
+        "average_progress": round(sum(row.progress_sum for row in summary) / total_objects, 1) if total_objects > 0 else 0
+    }
+
+async def get_customer_or_404(db, customer_id):
+    customer = await db.get(Customer, customer_id)
+    if customer is None:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    return customer
+
+async def customer_summary(db, customer_ids):
+    rows = (await db.execute(select(CustomerStats).where(CustomerStats.customer_id.in_(customer_ids)))).scalars().all()
+    summary = {}
+    for row in rows:
+        if row.count:
+            summary.setdefault(row.customer_id, []).append(row)
+    return summary
+
+async def customer_objects_page(db, customer_id, names, limit, after, status):
+    stmt = build_objects_query(names, after, status, customer_id=customer_id)
+    rows = (await db.execute(stmt.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "objects": [dict(zip(names, row)) for row in rows],
+        "count": len(rows),
+        "next_after": rows[-1][0] if has_more else None
+    }
+
+@app.get("/api/customers")
+async def get_customers(
+    limit: int = Query(OBJECTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего заказчика предыдущей страницы"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    stmt = select(Customer).order_by(Customer.id).limit(limit + 1)
+    if after is not None:
+        stmt = stmt.where(Customer.id > after)
+    customers = (await db.execute(stmt)).scalars().all()
+    has_more = len(customers) > limit
+    customers = customers[:limit]
+    summary = await customer_summary(db, [customer.id for customer in customers])
+    return FastJSONResponse({
+        "customers": [customer_json(customer, summary.get(customer.id, [])) for customer in customers],
+        "count": len(customers),
+        "next_after": customers[-1].id if has_more else None
+    })
+
+@app.get("/api/customers/{customer_id}")
+async def get_customer(customer_id: int, db: AsyncSession = Depends(get_async_db)):
+    customer = await get_customer_or_404(db, customer_id)
+    summary = await customer_summary(db, [customer_id])
+    return FastJSONResponse(customer_json(customer, summary.get(customer_id, [])))
+
+@app.get("/api/customers/{customer_id}/stats")
+async def get_customer_stats(customer_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Та же форма, что у /api/stats, но только из строк сводки этого заказчика"""
+    customer = await get_customer_or_404(db, customer_id)
+    summary = (await customer_summary(db, [customer_id])).get(customer_id, [])
+    result = customer_json(customer, summary)
+    by_status = {row.status: row for row in summary}
+    result.update({
+        "in_progress": by_status["in_progress"].count if "in_progress" in by_status else 0,
+        "planning": by_status["planning"].count if "planning" in by_status else 0,
+        "average_budget": round(result["total_budget"] / result["total_objects"]) if result["total_objects"] > 0 else 0,
+        "by_status": {
+            row.status: {"count": row.count, "budget": row.budget_sum, "average_progress": round(row.progress_sum / row.count, 1)}
+            for row in summary
+        }
+    })
+    return FastJSONResponse(result)
+
+@app.get("/api/customers/{customer_id}/objects")
+async def get_customer_objects(
+    customer_id: int,
+    limit: int = Query(OBJECTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего объекта предыдущей страницы"),
+    status: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Поля через запятую, например id,name,status"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    await get_customer_or_404(db, customer_id)
+    return FastJSONResponse(await customer_objects_page(db, customer_id, parse_object_fields(fields), limit, after, status))
+
+@app.get("/api/customers/{customer_id}/progress")
+async def get_customer_progress(
+    customer_id: int,
+    limit: int = Query(OBJECTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего объекта предыдущей страницы"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Прогресс по объектам заказчика и средний прогресс из сводки"""
+    customer = await get_customer_or_404(db, customer_id)
+    summary = (await customer_summary(db, [customer_id])).get(customer_id, [])
+    page = await customer_objects_page(db, customer_id, CUSTOMER_PROGRESS_FIELDS, limit, after, None)
+    page["average_progress"] = customer_json(customer, summary)["average_progress"]
+    return FastJSONResponse(page)
+
+@app.get("/api/db/pool")
+async def get_pool_status():
+    """Насыщение пула асинхронного движка"""
+    if async_engine is None:
+        raise HTTPException(status_code=503, detail="Async database driver is not installed")
+    pool = async_engine.pool
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    return {
+        "pool": pool.status(),
+        "size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout": DB_POOL_TIMEOUT,
+        "recycle": DB_POOL_RECYCLE,
+        "in_use": pool_metrics["in_use"],
+        "peak_in_use": pool_metrics["peak_in_use"],
+        "checkouts": pool_metrics["checkouts"],
+        "timeouts": pool_metrics["timeouts"],
+        "saturation": round(pool_metrics["in_use"] / capacity, 3) if capacity > 0 else None,
+        "primary_reads": replica_router.primary_reads,
+        "replicas": [replica.status() for replica in replica_router.replicas]
+    }
+
+# Ежедневные отчёты и загрузка фото
+PHOTO_DIR = os.environ.get("PHOTO_DIR", "./uploads")
+MAX_PHOTO_SIZE = int(os.environ.get("MAX_PHOTO_SIZE", 25 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 512 * 1024))  # рекомендуемый размер куска
+UPLOAD_CLAIM_TIMEOUT = float(os.environ.get("UPLOAD_CLAIM_TIMEOUT", 300))  # секунд, после которых брошенную запись куска можно перехватить
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 320))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+REPORTS_PAGE_DEFAULT = 50
+
+class ReportIn(BaseModel):
+    object_id: int
+    author: Optional[str] = Field(None, max_length=200)
+    report_date: Optional[datetime] = None
+    text: Optional[str] = None
+    progress: Optional[int] = Field(None, ge=0, le=100)
+
+class PhotoUploadIn(BaseModel):
+    filename: Optional[str] = Field(None, max_length=255)
+    content_type: str = Field("image/jpeg", pattern="^image/")
+    size: int = Field(..., ge=1)
+    sha256: Optional[str] = Field(None, pattern="^[0-9a-f]{64}$")
+
+def photo_path(sha256):
+    return os.path.join(PHOTO_DIR, "blobs", sha256[:2], sha256)
+
+def thumbnail_path(sha256):
+    return os.path.join(PHOTO_DIR, "thumbs", sha256[:2], sha256 + ".jpg")
+
+def partial_path(upload_id):
+    return os.path.join(PHOTO_DIR, "partial", upload_id + ".part")
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def render_thumbnail(source, target, size):
+    """Выполняется в дочернем процессе: уменьшенная JPEG-копия фото"""
+    from PIL import Image
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        image.convert("RGB").save(target + ".tmp", "JPEG", quality=80)
+    os.replace(target + ".tmp", target)
+    return target
+
+_thumbnail_pool = None
+
+def schedule_thumbnail(sha256):
+    """Миниатюра в пуле процессов - декодирование JPEG не держит GIL воркера"""
+    global _thumbnail_pool
+    if importlib.util.find_spec("PIL") is None or os.path.exists(thumbnail_path(sha256)):
+        return
+    if _thumbnail_pool is None:
+        # spawn: форкать процесс с работающим event loop и пулами соединений небезопасно
+        _thumbnail_pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    future = _thumbnail_pool.submit(render_thumbnail, photo_path(sha256), thumbnail_path(sha256), THUMBNAIL_SIZE)
+    future.add_done_callback(lambda f: f.exception() and print(f"⚠️ Миниатюра {sha256[:12]} не создана: {f.exception()}"))
+
+def photo_json(photo):
+    return {
+        "id": photo.id,
+        "report_id": photo.report_id,
+        "sha256": photo.sha256,
+        "size": photo.size,
+        "content_type": photo.content_type,
+        "filename": photo.filename,
+        "url": f"/api/photos/{photo.id}",
+        "thumbnail_url": f"/api/photos/{photo.id}/thumbnail"
+    }
+
+def upload_json(upload, offset):
+    return {
+        "upload_id": upload.id,
+        "offset": offset,
+        "size": upload.size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "complete": upload.photo_id is not None,
+        "photo_id": upload.photo_id
+    }
+
+async def list_reports(db, object_id, after, limit):
+    stmt = select(Report).order_by(Report.id).limit(limit + 1)
+    if object_id is not None:
+        stmt = stmt.where(Report.object_id == object_id)
+    if after is not None:
+        stmt = stmt.where(Report.id > after)
+    reports = (await db.execute(stmt)).scalars().all()
+    has_more = len(reports) > limit
+    reports = reports[:limit]
+    # Фото всех отчётов страницы - одним запросом, без N+1
+    photos = {}
+    if reports:
+        photo_rows = await db.execute(
+            select(ReportPhoto).where(ReportPhoto.report_id.in_([r.id for r in reports])).order_by(ReportPhoto.id)
+        )
+        for photo in photo_rows.scalars():
+            photos.setdefault(photo.report_id, []).append(photo_json(photo))
+    return FastJSONResponse({
+        "reports": [
+            {
+                "id": r.id,
+                "object_id": r.object_id,
+                "author": r.author,
+                "report_date": r.report_date,
+                "text": r.text,
+                "progress": r.progress,
+                "photos": photos.get(r.id, [])
+            }
+            for r in reports
+        ],
+        "count": len(reports),
+        "next_after": reports[-1].id if has_more else None
+    })
+
+@app.get("/api/reports")
+async def get_reports(
+    object_id: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(REPORTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await list_reports(db, object_id, after, limit)
+
+@app.get("/api/reports/{object_id}")
+async def get_object_reports(
+    object_id: int,
+    after: Optional[int] = None,
+    limit: int = Query(REPORTS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Отчёты по объекту"""
+    return await list_reports(db, object_id, after, limit)
+
+@app.post("/api/reports", status_code=201)
+async def create_report(report_in: ReportIn, db: AsyncSession = Depends(get_async_db)):
+    obj = await db.get(Object, report_in.object_id)
+    if obj is None:
+        raise HTTPException(status_code=404, detail="Object not found")
+    report = Report(**report_in.model_dump(exclude_none=True))
+    db.add(report)
+    if report_in.progress is not None:
+        obj.progress = report_in.progress
+    await db.commit()
+    return {"id": report.id, "object_id": report.object_id, "report_date": report.report_date, "photos_url": f"/api/reports/{report.id}/photos"}
+
+@app.post("/api/reports/{report_id}/photos", status_code=201)
+async def start_photo_upload(report_id: int, upload_in: PhotoUploadIn, db: AsyncSession = Depends(get_async_db)):
+    """Начало загрузки фото. Если такой файл уже есть (по sha256), загрузка не нужна."""
+    if await db.get(Report, report_id) is None:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if upload_in.size > MAX_PHOTO_SIZE:
+        raise HTTPException(status_code=413, detail=f"Photo is larger than {MAX_PHOTO_SIZE} bytes")
+    upload = PhotoUpload(id=uuid.uuid4().hex, report_id=report_id, **upload_in.model_dump())
+    db.add(upload)
+    if upload_in.sha256 and os.path.exists(photo_path(upload_in.sha256)):
+        photo = ReportPhoto(report_id=report_id, sha256=upload_in.sha256, size=upload_in.size,
+                            content_type=upload_in.content_type, filename=upload_in.filename)
+        db.add(photo)
+        await db.flush()
+        upload.photo_id = photo.id
+    await db.commit()
+    return upload_json(upload, upload.size if upload.photo_id else 0)
+
+@app.head("/api/uploads/{upload_id}")
+@app.get("/api/uploads/{upload_id}")
+async def get_photo_upload(upload_id: str, db: AsyncSession = Depends(get_async_db)):
+    """Сколько байт уже принято - клиент продолжает с этого смещения"""
+    upload = await db.get(PhotoUpload, upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    offset = upload.size if upload.photo_id else upload.received
+    return FastJSONResponse(upload_json(upload, offset), headers={"Upload-Offset": str(offset)})
+
+async def finish_photo_upload(db, upload):
+    """Проверка хэша, перенос в хранилище (или удаление дубля), запись ReportPhoto"""
+    part = partial_path(upload.id)
+    sha256 = await run_in_threadpool(file_sha256, part)
+    if upload.sha256 and upload.sha256 != sha256:
+        os.remove(part)
+        raise HTTPException(status_code=422, detail="Checksum mismatch, upload discarded")
+    target = photo_path(sha256)
+    if os.path.exists(target):
+        os.remove(part)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(part, target)
+    photo = ReportPhoto(report_id=upload.report_id, sha256=sha256, size=upload.size,
+                        content_type=upload.content_type, filename=upload.filename)
+    db.add(photo)
+    await db.flush()
+    upload.photo_id = photo.id
+    await db.commit()
+    schedule_thumbnail(sha256)
+    return photo
+
+async def claim_upload(db, upload_id, offset):
+    """Право дописать кусок с этого смещения: условный UPDATE по принятому смещению,
+    поэтому два воркера не пишут один .part одновременно. None - смещение не то или занято."""
+    now = datetime.utcnow()
+    table = PhotoUpload.__table__
+    result = await db.execute(table.update().where(
+        table.c.id == upload_id,
+        table.c.photo_id.is_(None),
+        table.c.received == offset,
+        # Воркер, упавший посреди куска, не держит загрузку вечно
+        or_(table.c.writing_since.is_(None), table.c.writing_since < now - timedelta(seconds=UPLOAD_CLAIM_TIMEOUT))
+    ).values(writing_since=now))
+    await db.commit()
+    return now if result.rowcount else None
+
+async def release_upload(db, upload_id, claimed, received):
+    table = PhotoUpload.__table__
+    await db.execute(
+        table.update().where(table.c.id == upload_id, table.c.writing_since == claimed)
+        .values(received=received, writing_since=None)
+    )
+    await db.commit()
+
+@app.patch("/api/uploads/{upload_id}")
+async def upload_photo_chunk(upload_id: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Очередной кусок файла. Заголовок Upload-Offset должен совпадать с принятым объёмом;
+    тело пишется на диск по мере поступления, целиком в памяти не держится."""
+    upload = await db.get(PhotoUpload, upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if upload.photo_id is not None:
+        return upload_json(upload, upload.size)
+    client_offset = request.headers.get("upload-offset")
+    try:
+        offset = upload.received if client_offset is None else int(client_offset)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Upload-Offset must be an integer")
+
+    claimed = await claim_upload(db, upload_id, offset)
+    if claimed is None:
+        await db.refresh(upload)
+        offset = upload.size if upload.photo_id else upload.received
+        return FastJSONResponse(upload_json(upload, offset), status_code=409, headers={"Upload-Offset": str(offset)})
+
+    part = partial_path(upload_id)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    received = 0
+    try:
+        with open(part, "r+b" if os.path.exists(part) else "w+b") as f:
+            # Хвост после принятого смещения остался от оборванной записи - он не засчитан
+            f.seek(offset)
+            f.truncate()
+            async for chunk in request.stream():
+                if offset + received + len(chunk) > upload.size:
+                    f.truncate(offset)
+                    received = 0
+                    raise HTTPException(status_code=413, detail="Chunk goes past the declared size")
+                await run_in_threadpool(f.write, chunk)
+                received += len(chunk)
+        offset, received = offset + received, 0
+        if offset == upload.size:
+            try:
+                await finish_photo_upload(db, upload)
+            except HTTPException:
+                offset = 0  # хэш не сошёлся, файл удалён - загрузка начинается заново
+                raise
+    finally:
+        # Записанное до обрыва связи засчитывается - клиент продолжит с нового смещения
+        await release_upload(db, upload_id, claimed, offset + received)
+    upload.received = offset
+    return FastJSONResponse(upload_json(upload, offset), headers={"Upload-Offset": str(offset)})
+
+@app.get("/api/photos/{photo_id}")
+async def get_photo(photo_id: int, db: AsyncSession = Depends(get_async_db)):
+    photo = await db.get(ReportPhoto, photo_id)
+    if photo is None or not os.path.exists(photo_path(photo.sha256)):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return FileResponse(photo_path(photo.sha256), media_type=photo.content_type, filename=photo.filename)
+
+@app.get("/api/photos/{photo_id}/thumbnail")
+async def get_photo_thumbnail(photo_id: int, db: AsyncSession = Depends(get_async_db)):
+    photo = await db.get(ReportPhoto, photo_id)
+    if photo is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    if not os.path.exists(thumbnail_path(photo.sha256)):
+        raise HTTPException(status_code=404, detail="Thumbnail is not ready yet")
+    return FileResponse(thumbnail_path(photo.sha256), media_type="image/jpeg")
+
+# Экспорт отчётов о ходе работ (CSV/XLSX/PDF) в фоне.
+# Задание пишется в export_jobs, файл строится в пуле процессов, который читает
+# строки из БД потоком. Имя файла - хэш параметров и версии данных: повторный
+# запрос по неизменившимся данным отдаёт готовый файл без пересборки.
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "./exports")
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", 2))
+PDF_FONT = os.environ.get("PDF_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")  # нужен шрифт с кириллицей
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", None),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "openpyxl"),
+    "pdf": ("application/pdf", "reportlab")
+}
+EXPORT_ROWS_BATCH = 1000
+EXPORT_HEARTBEAT = 15  # секунд между отметками "задание живо"
+EXPORT_STALE_AFTER = float(os.environ.get("EXPORT_STALE_AFTER", 120))  # секунд без отметки - воркер задания потерян
+
+class ExportJob(Base):
+    __tablename__ = "export_jobs"
+
+    id = Column(String(32), primary_key=True)
+    kind = Column(String(20), nullable=False)  # object, customer
+    target_id = Column(Integer, nullable=False)
+    format = Column(String(10), nullable=False)  # csv, xlsx, pdf
+    cache_key = Column(String(64), nullable=False, index=True)
+    status = Column(String(20), nullable=False, default="queued")  # queued, running, done, failed
+    size = Column(BigInteger)
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow)  # обновляет воркер, пока задание в работе
+    finished_at = Column(DateTime)
+
+class ExportIn(BaseModel):
+    kind: str = Field(..., pattern="^(object|customer)$")
+    id: int = Field(..., ge=1)
+    format: str = Field("csv", pattern="^(csv|xlsx|pdf)$")
+
+def export_path(cache_key, fmt):
+    return os.path.join(EXPORT_DIR, cache_key[:2], f"{cache_key}.{fmt}")
+
+def export_rows(connection, kind, target_id):
+    """(заголовок отчёта, названия колонок, итератор строк) - строки идут с серверного курсора"""
+    if kind == "object":
+        obj = connection.execute(select(Object.name, Object.location, Object.progress).where(Object.id == target_id)).first()
+        title = f"{obj.name} ({obj.location or '-'}): {obj.progress or 0}%"
+        columns = ["Дата", "Мастер", "Прогресс, %", "Отчёт"]
+        stmt = (
+            select(Report.report_date, Report.author, Report.progress, Report.text)
+            .where(Report.object_id == target_id).order_by(Report.report_date, Report.id)
+        )
+    else:
+        name = connection.execute(select(Customer.name).where(Customer.id == target_id)).scalar()
+        title = f"Заказчик: {name}"
+        columns = ["ID", "Объект", "Место", "Статус", "Прогресс, %", "Начало", "Окончание", "Бюджет, ₽"]
+        stmt = (
+            select(Object.id, Object.name, Object.location, Object.status, Object.progress,
+                   Object.start_date, Object.end_date, Object.budget)
+            .where(Object.customer_id == target_id).order_by(Object.id)
+        )
+    rows = connection.execution_options(stream_results=True, yield_per=EXPORT_ROWS_BATCH).execute(stmt)
+    return title, columns, rows
+
+def export_cell(value):
+    if isinstance(value, datetime):
+        return value.strftime("%d.%m.%Y")
+    return "" if value is None else value
+
+def write_csv(target, title, columns, rows):
+    # utf-8-sig: Excel открывает кириллицу без мастера импорта
+    with open(target, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow([title])
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([export_cell(value) for value in row])
+
+def write_xlsx(target, title, columns, rows):
+    from openpyxl import Workbook
+    # write_only: строки сбрасываются на диск сразу, память не растёт с размером отчёта
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Отчёт")
+    sheet.append([title])
+    sheet.append(columns)
+    for row in rows:
+        sheet.append(list(row))  # даты остаются датами Excel
+    workbook.save(target)
+
+def write_pdf(target, title, columns, rows):
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+    if not os.path.exists(PDF_FONT):
+        raise RuntimeError(f"PDF font not found: {PDF_FONT}")
+    pdfmetrics.registerFont(TTFont("Report", PDF_FONT))
+    width, height = landscape(A4)
+    margin, line = 36, 14
+    column_width = (width - 2 * margin) / len(columns)
+    pdf = canvas.Canvas(target, pagesize=(width, height))
+
+    def start_page():
+        pdf.setFont("Report", 12)
+        pdf.drawString(margin, height - margin, title)
+        pdf.setFont("Report", 8)
+        for i, name in enumerate(columns):
+            pdf.drawString(margin + i * column_width, height - margin - 2 * line, name)
+        return height - margin - 3 * line
+
+    y = start_page()
+    for row in rows:
+        if y < margin:
+            pdf.showPage()
+            y = start_page()
+        for i, value in enumerate(row):
+            text_value = str(export_cell(value))
+            # Длинный текст обрезаем по ширине колонки
+            while text_value and pdfmetrics.stringWidth(text_value, "Report", 8) > column_width - 4:
+                text_value = text_value[:-2]
+            pdf.drawString(margin + i * column_width, y, text_value)
+        y -= line
+    pdf.save()
+
+EXPORT_WRITERS = {"csv": write_csv, "xlsx": write_xlsx, "pdf": write_pdf}
+
+def render_export(kind, target_id, fmt, target):
+    """Выполняется в дочернем процессе: своё соединение с БД, запись во временный файл и rename"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f"{target}.{os.getpid()}.tmp"
+    try:
+        with engine.connect() as connection:
+            title, columns, rows = export_rows(connection, kind, target_id)
+            EXPORT_WRITERS[fmt](partial, title, columns, rows)
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return os.path.getsize(target)
+
+_export_pool = None
+
+def get_export_pool():
+    global _export_pool
+    if _export_pool is None:
+        _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _export_pool
+
+async def export_version(db, kind, target_id):
+    """Версия данных отчёта: меняется при любой правке объекта(ов) или их отчётов"""
+    if kind == "object":
+        if await db.get(Object, target_id) is None:
+            raise HTTPException(status_code=404, detail="Object not found")
+        objects = select(Object.updated_at).where(Object.id == target_id)
+        reports = select(func.max(Report.updated_at), func.count(Report.id)).where(Report.object_id == target_id)
+    else:
+        await get_customer_or_404(db, target_id)
+        objects = select(func.max(Object.updated_at), func.count(Object.id)).where(Object.customer_id == target_id)
+        reports = None
+    version = list((await db.execute(objects)).first() or [])
+    if reports is not None:
+        version += list((await db.execute(reports)).first())
+    return version
+
+def export_job_json(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "target_id": job.target_id,
+        "format": job.format,
+        "status": job.status,
+        "size": job.size,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "download_url": f"/api/exports/{job.id}/download" if job.status == "done" else None
+    }
+
+async def export_heartbeat(job_id):
+    while True:
+        await asyncio.sleep(EXPORT_HEARTBEAT)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(ExportJob).where(ExportJob.id == job_id).values(heartbeat_at=datetime.utcnow()))
+                await db.commit()
+        except Exception as e:
+            print(f"⚠️ Отметка задания экспорта {job_id} не записана: {e}")
+
+async def fail_orphaned_exports(db, cache_key=None):
+    """Задания в очереди или в работе, чей воркер перестал отмечаться (рестарт, падение),
+    помечаются failed - иначе дедупликация вечно отдавала бы их как строящиеся"""
+    stale = datetime.utcnow() - timedelta(seconds=EXPORT_STALE_AFTER)
+    stmt = update(ExportJob).where(
+        ExportJob.status.in_(("queued", "running")),
+        or_(ExportJob.heartbeat_at.is_(None), ExportJob.heartbeat_at < stale)
+    ).values(status="failed", error="export worker was lost", finished_at=datetime.utcnow())
+    if cache_key is not None:
+        stmt = stmt.where(ExportJob.cache_key == cache_key)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
+
+async def run_export_job(job_id, kind, target_id, fmt, cache_key):
+    async with AsyncSessionLocal() as db:
+        job = await db.get(ExportJob, job_id)
+        job.status = "running"
+        job.heartbeat_at = datetime.utcnow()
+        await db.commit()
+        heartbeat = asyncio.ensure_future(export_heartbeat(job_id))
+        try:
+            loop = asyncio.get_running_loop()
+            job.size = await loop.run_in_executor(
+                get_export_pool(), render_export, kind, target_id, fmt, export_path(cache_key, fmt)
+            )
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            print(f"❌ Экспорт {job_id} не построен: {job.error}")
+        finally:
+            heartbeat.cancel()
+        job.finished_at = datetime.utcnow()
+        await db.commit()
+
+_export_tasks = set()
+
+@app.post("/api/exports", status_code=202)
+async def create_export(export: ExportIn, db: AsyncSession = Depends(get_async_db)):
+    """Ставит отчёт в очередь; если такой файл уже есть для текущих данных - сразу готово"""
+    media_type, module = EXPORT_FORMATS[export.format]
+    if module is not None and importlib.util.find_spec(module) is None:
+        raise HTTPException(status_code=400, detail=f"Format {export.format} requires {module}")
+    version = await export_version(db, export.kind, export.id)
+    cache_key = hashlib.sha256(
+        dumps_json([export.kind, export.id, export.format, version])
+    ).hexdigest()
+
+    # Тот же отчёт уже строится - второе задание не нужно; брошенное задание не в счёт
+    await fail_orphaned_exports(db, cache_key)
+    running = (await db.execute(
+        select(ExportJob).where(ExportJob.cache_key == cache_key, ExportJob.status.in_(("queued", "running")))
+    )).scalars().first()
+    if running is not None:
+        return FastJSONResponse(export_job_json(running), status_code=202)
+
+    job = ExportJob(id=uuid.uuid4().hex, kind=export.kind, target_id=export.id, format=export.format, cache_key=cache_key)
+    path = export_path(cache_key, export.format)
+    if os.path.exists(path):
+        job.status = "done"
+        job.size = os.path.getsize(path)
+        job.finished_at = datetime.utcnow()
+    db.add(job)
+    await db.commit()
+    if job.status == "done":
+        return FastJSONResponse(export_job_json(job), status_code=200)
+
+    task = asyncio.ensure_future(run_export_job(job.id, export.kind, export.id, export.format, cache_key))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
+    return FastJSONResponse(export_job_json(job), status_code=202)
+
+@app.get("/api/exports/{job_id}")
+async def get_export(job_id: str, db: AsyncSession = Depends(get_async_db)):
+    job = await db.get(ExportJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return FastJSONResponse(export_job_json(job))
+
+@app.get("/api/exports/{job_id}/download")
+async def download_export(job_id: str, db: AsyncSession = Depends(get_async_db)):
+    job = await db.get(ExportJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    path = export_path(job.cache_key, job.format)
+    if job.status != "done" or not os.path.exists(path):
+        raise HTTPException(status_code=409, detail=f"Export is {job.status}")
+    filename = f"{job.kind}-{job.target_id}-{job.created_at:%Y%m%d}.{job.format}"
+    return FileResponse(path, media_type=EXPORT_FORMATS[job.format][0], filename=filename)
+
+# Учёт инструмента: выдача на объекты с блокировкой строки инструмента
+TOOLS_PAGE_DEFAULT = 100
+
+class ToolIn(BaseModel):
+    name: str = Field(..., min_length=1, max_length=200)
+    kind: str = Field(..., min_length=1, max_length=50)
+    serial: Optional[str] = Field(None, max_length=100)
+    location: Optional[str] = Field(None, max_length=200)
+    status: str = Field("active", pattern="^(active|maintenance|retired)$")
+
+class CheckoutIn(BaseModel):
+    object_id: int
+    foreman: Optional[str] = Field(None, max_length=200)
+    starts_at: Optional[datetime] = None  # в будущем - бронь; по умолчанию - выдача сейчас
+    ends_at: datetime  # плановый возврат
+    assignment_id: Optional[int] = None  # выдать по ранее сделанной брони
+
+def tool_json(tool):
+    return {
+        "id": tool.id,
+        "name": tool.name,
+        "kind": tool.kind,
+        "serial": tool.serial,
+        "location": tool.location,
+        "status": tool.status
+    }
+
+def assignment_json(assignment):
+    return {
+        "id": assignment.id,
+        "tool_id": assignment.tool_id,
+        "object_id": assignment.object_id,
+        "foreman": assignment.foreman,
+        "starts_at": assignment.starts_at,
+        "ends_at": assignment.ends_at,
+        "checked_out_at": assignment.checked_out_at,
+        "checked_in_at": assignment.checked_in_at
+    }
+
+def tool_conflicts(tool_id, date_from, date_to, now):
+    """Выдачи, мешающие окну [date_from, date_to): пересекающиеся по времени
+    и просроченные невозвращённые - инструмент занят, пока его не вернули"""
+    busy = and_(ToolAssignment.ends_at > date_from, ToolAssignment.starts_at < date_to)
+    if date_to > now:
+        busy = or_(busy, and_(
+            ToolAssignment.checked_in_at.is_(None),
+            ToolAssignment.checked_out_at.isnot(None),
+            ToolAssignment.ends_at <= now
+        ))
+    return and_(ToolAssignment.tool_id == tool_id, busy)
+
+async def lock_tool(db, tool_id):
+    """UPDATE строки инструмента в начале транзакции: в PostgreSQL - блокировка строки
+    до коммита, в SQLite - блокировка записи. Вторая выдача того же инструмента ждёт
+    первую и уже видит её бронь."""
+    try:
+        result = await db.execute(update(Tool).where(Tool.id == tool_id).values(updated_at=datetime.utcnow()))
+    except OperationalError:
+        raise HTTPException(status_code=409, detail="Tool is being updated concurrently, retry")
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Tool not found")
+    return await db.get(Tool, tool_id)
+
+@app.get("/api/tools")
+async def get_tools(
+    kind: Optional[str] = None,
+    location: Optional[str] = None,
+    limit: int = Query(TOOLS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    after: Optional[int] = Query(None, description="id последнего инструмента предыдущей страницы"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    stmt = select(Tool).order_by(Tool.id).limit(limit + 1)
+    if kind:
+        stmt = stmt.where(Tool.kind == kind)
+    if location:
+        stmt = stmt.where(Tool.location == location)
+    if after is not None:
+        stmt = stmt.where(Tool.id > after)
+    tools = (await db.execute(stmt)).scalars().all()
+    has_more = len(tools) > limit
+    tools = tools[:limit]
+    return FastJSONResponse({
+        "tools": [tool_json(tool) for tool in tools],
+        "count": len(tools),
+        "next_after": tools[-1].id if has_more else None
+    })
+
+@app.post("/api/tools", status_code=201)
+async def create_tool(tool_in: ToolIn, db: AsyncSession = Depends(get_async_db)):
+    tool = Tool(**tool_in.model_dump())
+    db.add(tool)
+    try:
+        await db.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Tool with this serial already exists")
+    return tool_json(tool)
+
+@app.get("/api/tools/available")
+async def get_available_tools(
+    date_from: datetime = Query(..., alias="from"),
+    date_to: datetime = Query(..., alias="to"),
+    kind: Optional[str] = None,
+    location: Optional[str] = Query(None, description="Место из справочника: ближний инструмент - первым"),
+    limit: int = Query(TOOLS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Свободный на всё окно инструмент: NOT EXISTS по ix_tool_assignments_busy на каждый инструмент"""
+    if date_from >= date_to:
+        raise HTTPException(status_code=400, detail="'from' must be earlier than 'to'")
+    stmt = select(Tool).where(
+        Tool.status == "active",
+        ~exists().where(tool_conflicts(Tool.id, date_from, date_to, datetime.utcnow()))
+    )
+    if kind:
+        stmt = stmt.where(Tool.kind == kind)
+    center = geocode(location, await load_gazetteer_async(db)) if location else None
+    if center is not None:
+        # Ближние первыми: порядок по плоскому приближению расстояния считает БД,
+        # точное расстояние - только для отданной страницы
+        scale = math.cos(math.radians(center[0]))
+        planar = (Tool.latitude - center[0]) * (Tool.latitude - center[0]) + \
+            (Tool.longitude - center[1]) * scale * (Tool.longitude - center[1]) * scale
+        stmt = stmt.order_by(Tool.latitude.is_(None), planar)
+    elif location:
+        # Места нет в справочнике - остаётся точное совпадение строки места
+        stmt = stmt.order_by(case((Tool.location == location, 0), else_=1))
+    tools = (await db.execute(stmt.order_by(Tool.id).limit(limit))).scalars().all()
+    if center is None:
+        return FastJSONResponse({"tools": [tool_json(tool) for tool in tools], "count": len(tools)})
+    return FastJSONResponse({
+        "tools": [
+            dict(tool_json(tool), distance_km=round(distance_km(center[0], center[1], tool.latitude, tool.longitude), 1)
+                 if tool.latitude is not None else None)
+            for tool in tools
+        ],
+        "count": len(tools)
+    })
+
+@app.get("/api/tools/{tool_id}")
+async def get_tool(tool_id: int, db: AsyncSession = Depends(get_async_db)):
+    tool = await db.get(Tool, tool_id)
+    if tool is None:
+        raise HTTPException(status_code=404, detail="Tool not found")
+    current = (await db.execute(
+        select(ToolAssignment).where(
+            ToolAssignment.tool_id == tool_id,
+            ToolAssignment.checked_out_at.isnot(None),
+            ToolAssignment.checked_in_at.is_(None)
+        )
+    )).scalars().first()
+    return FastJSONResponse(dict(tool_json(tool), current_assignment=assignment_json(current) if current else None))
+
+@app.get("/api/tools/{tool_id}/assignments")
+async def get_tool_assignments(
+    tool_id: int,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    limit: int = Query(TOOLS_PAGE_DEFAULT, ge=1, le=OBJECTS_PAGE_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Выдачи инструмента, пересекающие окно, от последних к первым"""
+    stmt = select(ToolAssignment).where(ToolAssignment.tool_id == tool_id)
+    if date_from is not None:
+        stmt = stmt.where(ToolAssignment.ends_at > date_from)
+    if date_to is not None:
+        stmt = stmt.where(ToolAssignment.starts_at < date_to)
+    assignments = (await db.execute(stmt.order_by(ToolAssignment.ends_at.desc()).limit(limit))).scalars().all()
+    return FastJSONResponse({"assignments": [assignment_json(a) for a in assignments], "count": len(assignments)})
+
+@app.post("/api/tools/{tool_id}/checkout", status_code=201)
+async def checkout_tool(tool_id: int, checkout: CheckoutIn, db: AsyncSession = Depends(get_async_db)):
+    """Выдача или бронь инструмента на объект; пересечение с чужой выдачей - 409"""
+    now = datetime.utcnow()
+    starts_at = checkout.starts_at or now
+    if starts_at >= checkout.ends_at:
+        raise HTTPException(status_code=400, detail="ends_at must be later than starts_at")
+    if await db.get(Object, checkout.object_id) is None:
+        raise HTTPException(status_code=404, detail="Object not found")
+    tool = await lock_tool(db, tool_id)
+    if tool.status != "active":
+        raise HTTPException(status_code=409, detail=f"Tool is in {tool.status}")
+
+    reservation = None
+    if checkout.assignment_id is not None:
+        reservation = await db.get(ToolAssignment, checkout.assignment_id)
+        if reservation is None or reservation.tool_id != tool_id or reservation.checked_out_at is not None:
+            raise HTTPException(status_code=409, detail="Reservation not found or already checked out")
+    conflict_stmt = select(ToolAssignment).where(tool_conflicts(tool_id, starts_at, checkout.ends_at, now))
+    if reservation is not None:
+        conflict_stmt = conflict_stmt.where(ToolAssignment.id != reservation.id)
+    conflict = (await db.execute(conflict_stmt.limit(1))).scalars().first()
+    if conflict is not None:
+        # Та же форма, что у HTTPException, плюс мешающая выдача
+        return FastJSONResponse({"detail": "Tool is busy", "assignment": assignment_json(conflict)}, status_code=409)
+
+    assignment = reservation or ToolAssignment(tool_id=tool_id)
+    assignment.object_id = checkout.object_id
+    assignment.foreman = checkout.foreman or assignment.foreman
+    assignment.starts_at = starts_at
+    assignment.ends_at = checkout.ends_at
+    if starts_at <= now:
+        assignment.checked_out_at = now
+    db.add(assignment)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Ограничение tool_assignments_no_overlap в PostgreSQL
+        raise HTTPException(status_code=409, detail="Tool is busy")
+    return FastJSONResponse(assignment_json(assignment), status_code=201)
+
+@app.post("/api/tools/{tool_id}/checkin")
+async def checkin_tool(tool_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Возврат инструмента; раньше срока - интервал выдачи сокращается и инструмент снова свободен"""
+    await lock_tool(db, tool_id)
+    assignment = (await db.execute(
+        select(ToolAssignment).where(
+            ToolAssignment.tool_id == tool_id,
+            ToolAssignment.checked_out_at.isnot(None),
+            ToolAssignment.checked_in_at.is_(None)
+        ).order_by(ToolAssignment.starts_at)
+    )).scalars().first()
+    if assignment is None:
+        raise HTTPException(status_code=409, detail="Tool is not checked out")
+    now = datetime.utcnow()
+    assignment.checked_in_at = now
+    assignment.ends_at = min(assignment.ends_at, now)
+    await db.commit()
+    return FastJSONResponse(assignment_json(assignment))
+
+@app.delete("/api/tools/{tool_id}/assignments/{assignment_id}", status_code=204)
+async def cancel_tool_reservation(tool_id: int, assignment_id: int, db: AsyncSession = Depends(get_async_db)):
+    await lock_tool(db, tool_id)
+    assignment = await db.get(ToolAssignment, assignment_id)
+    if assignment is None or assignment.tool_id != tool_id:
+        raise HTTPException(status_code=404, detail="Assignment not found")
+    if assignment.checked_out_at is not None:
+        raise HTTPException(status_code=409, detail="Tool is already checked out; use checkin")
+    await db.delete(assignment)
+    await db.commit()
+    return Response(status_code=204)
+
+# Офлайн-синхронизация PWA: дельты по журналу изменений и пакетная отправка правок
+SYNC_BATCH_DEFAULT = int(os.environ.get("SYNC_BATCH_DEFAULT", 500))  # изменений в одной пачке
+SYNC_BATCH_MAX = 5000
+
+REPORT_FIELDS = {
+    "id": Report.id,
+    "object_id": Report.object_id,
+    "author": Report.author,
+    "report_date": Report.report_date,
+    "text": Report.text,
+    "progress": Report.progress
+}
+SYNC_ENTITIES = {
+    "object": (Object, dict(OBJECT_FIELDS, updated_at=Object.updated_at)),
+    "report": (Report, dict(REPORT_FIELDS, updated_at=Report.updated_at))
+}
+
+@app.get("/api/sync")
+async def pull_changes(
+    since: int = Query(0, ge=0, description="Последний seq, который клиент уже применил"),
+    limit: int = Query(SYNC_BATCH_DEFAULT, ge=1, le=SYNC_BATCH_MAX),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Вставки, изменения и удаления после since; несколько правок одной записи
+    в пачке схлопываются в одну с её текущим состоянием. seq в журнале идут в порядке
+    коммитов (lock_change_log), поэтому курсор since не перескакивает ещё не видимые записи."""
+    log = (await db.execute(
+        select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op)
+        .where(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit + 1)
+    )).all()
+    has_more = len(log) > limit
+    log = log[:limit]
+
+    latest = {}
+    for entry in log:
+        latest[(entry.entity, entry.entity_id)] = entry
+
+    # Текущее состояние изменённых записей - один запрос на тип сущности
+    current = {}
+    for entity, (model, fields) in SYNC_ENTITIES.items():
+        ids = [entity_id for (kind, entity_id), entry in latest.items() if kind == entity and entry.op == "upsert"]
+        if ids:
+            names = list(fields)
+            rows = await db.execute(select(*fields.values()).where(model.id.in_(ids)))
+            current[entity] = {row[0]: dict(zip(names, row)) for row in rows}
+
+    changes = []
+    for (entity, entity_id), entry in sorted(latest.items(), key=lambda item: item[1].seq):
+        data = current.get(entity, {}).get(entity_id)
+        if entry.op == "delete" or data is None:
+            # Запись удалена (возможно, позже этой пачки) - клиенту достаточно tombstone
+            changes.append({"seq": entry.seq, "entity": entity, "id": entity_id, "op": "delete"})
+        else:
+            changes.append({"seq": entry.seq, "entity": entity, "id": entity_id, "op": "upsert", "data": data})
+
+    return FastJSONResponse({
+        "changes": changes,
+        "next_since": log[-1].seq if log else since,
+        "has_more": has_more
+    })
+
+class SyncChange(BaseModel):
+    entity: str = Field(..., pattern="^(object|report)$")
+    op: str = Field(..., pattern="^(create|update|delete)$")
+    id: Optional[int] = None
+    client_id: Optional[str] = Field(None, max_length=64)  # временный id записи на устройстве
+    base_seq: Optional[int] = None  # seq, на котором клиент последний раз видел запись
+    data: dict = Field(default_factory=dict)
+
+class SyncPush(BaseModel):
+    changes: List[SyncChange] = Field(..., max_length=SYNC_BATCH_MAX)
+
+async def latest_seq(db, entity, entity_id):
+    return (await db.execute(
+        select(func.max(ChangeLog.seq)).where(ChangeLog.entity == entity, ChangeLog.entity_id == entity_id)
+    )).scalar()
+
+async def entity_state(db, entity, entity_id):
+    model, fields = SYNC_ENTITIES[entity]
+    row = (await db.execute(select(*fields.values()).where(model.id == entity_id))).first()
+    return dict(zip(fields, row)) if row is not None else None
+
+async def apply_sync_change(db, change, own_seq):
+    """Одна офлайн-правка. Конфликт - если запись менялась после base_seq кем-то другим."""
+    if change.op == "create":
+        if change.entity == "object":
+            row = validate_object_row(change.data)
+            row.pop("id")
+            record = Object(**row)
+        else:
+            report_in = ReportIn(**change.data)
+            obj = await db.get(Object, report_in.object_id)
+            if obj is None:
+                raise ValueError("object not found")
+            record = Report(**report_in.model_dump(exclude_none=True))
+            if report_in.progress is not None:
+                obj.progress = report_in.progress
+        db.add(record)
+        await db.commit()
+        return {"status": "created", "id": record.id}
+
+    if change.entity != "object":
+        raise ValueError(f"{change.op} is not supported for {change.entity}")
+    if change.id is None:
+        raise ValueError("id is required")
+    key = (change.entity, change.id)
+    seq = await latest_seq(db, *key)
+    if change.base_seq is not None and seq is not None and seq > change.base_seq and seq != own_seq.get(key):
+        return {"status": "conflict", "seq": seq, "server": await entity_state(db, *key)}
+    obj = await db.get(Object, change.id)
+    if obj is None:
+        return {"status": "conflict", "seq": seq, "server": None}
+    if change.op == "delete":
+        await db.delete(obj)
+    else:
+        apply_object_patch(obj, ObjectPatch(**change.data))
+    await db.commit()
+    own_seq[key] = await latest_seq(db, *key)
+    return {"status": "deleted" if change.op == "delete" else "updated", "id": change.id}
+
+@app.post("/api/sync")
+async def push_changes(push: SyncPush, db: AsyncSession = Depends(get_async_db)):
+    """Очередь офлайн-правок одним запросом; каждая правка - отдельная транзакция"""
+    results = []
+    own_seq = {}  # seq собственных правок из этой пачки - они не конфликтуют друг с другом
+    for index, change in enumerate(push.changes):
+        try:
+            result = await apply_sync_change(db, change, own_seq)
+        except (ValueError, ValidationError) as e:
+            await db.rollback()
+            result = {"status": "error", "error": str(e).splitlines()[0]}
+        except Exception as e:
+            await db.rollback()
+            result = {"status": "error", "error": f"Database error: {e}".splitlines()[0]}
+        results.append(dict(result, index=index, client_id=change.client_id))
+    last_seq = (await db.execute(select(func.max(ChangeLog.seq)))).scalar() or 0
+    return FastJSONResponse({"results": results, "last_seq": last_seq})
+
+# Живые обновления для дашбордов: SSE и WebSocket вместо опроса.
+# Запись в БД -> после коммита id изменённых объектов уходят в backend (локальный
+# или PostgreSQL LISTEN/NOTIFY для нескольких воркеров) -> каждый воркер раз в
+# EVENTS_DEBOUNCE читает свежие строки и сводку одним запросом и раздаёт всем
+# подписчикам. Стоимость для БД не зависит от числа открытых вкладок.
+EVENTS_BACKEND = os.environ.get("EVENTS_BACKEND", "local")  # local, postgres
+EVENTS_DEBOUNCE = float(os.environ.get("EVENTS_DEBOUNCE", 0.25))  # секунд на сбор пачки изменений
+EVENTS_CLIENT_BUFFER = int(os.environ.get("EVENTS_CLIENT_BUFFER", 1000))  # событий в очереди одного клиента
+EVENTS_HEARTBEAT = 15  # секунд между ping, чтобы прокси не рвали соединение
+EVENTS_CHANNEL = "vega_events"
+NOTIFY_BATCH = 500  # id в одном NOTIFY - payload ограничен 8000 байт
+
+class Subscriber:
+    """Очередь одного клиента с коалесценцией: несколько изменений одного объекта
+    до отправки схлопываются в последнее. Медленный клиент, переполнивший буфер,
+    получает одно событие resync вместо потока - и перечитывает данные сам."""
+
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+
+    def offer(self, key, event):
+        if "resync" in self.pending:
+            return
+        self.pending.pop(key, None)
+        self.pending[key] = event
+        if len(self.pending) > EVENTS_CLIENT_BUFFER:
+            self.pending.clear()
+            self.pending["resync"] = {"type": "resync"}
+        self.ready.set()
+
+    async def get(self, timeout):
+        """Следующее событие или None, если за timeout ничего не пришло"""
+        if not self.pending:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.pending.popitem(last=False)[1]
+
+class LocalEventBackend:
+    """Доставка внутри процесса - для одного воркера и для тестов"""
+
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, ids):
+        self.deliver(ids)
+
+    async def stop(self):
+        pass
+
+class PostgresEventBackend:
+    """LISTEN/NOTIFY: события доходят до всех воркеров и всех экземпляров сервиса"""
+
+    def __init__(self, url):
+        self.dsn = make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.connection = None
+
+    async def start(self, deliver):
+        import asyncpg
+        self.deliver = deliver
+        self.connection = await asyncpg.connect(self.dsn)
+        await self.connection.add_listener(EVENTS_CHANNEL, self._on_notify)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.deliver(json.loads(payload))
+
+    async def publish(self, ids):
+        for start in range(0, len(ids), NOTIFY_BATCH):
+            await self.connection.execute("SELECT pg_notify($1, $2)", EVENTS_CHANNEL, json.dumps(ids[start:start + NOTIFY_BATCH]))
+
+    async def stop(self):
+        if self.connection is not None:
+            await self.connection.close()
+
+class EventHub:
+    """Fan-out событий по подписчикам этого воркера"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.backend = None
+        self.loop = None
+        self.dirty = set()
+        self.stats_dirty = True
+        self.last_stats = None
+        self.flush_task = None
+
+    async def start(self):
+        backend = PostgresEventBackend(DATABASE_URL) if EVENTS_BACKEND == "postgres" else LocalEventBackend()
+        try:
+            await backend.start(self.on_changed)
+        except Exception as e:
+            print(f"⚠️ Backend событий {EVENTS_BACKEND} недоступен, события только внутри процесса: {e}")
+            backend = LocalEventBackend()
+            await backend.start(self.on_changed)
+        self.backend = backend
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.backend is not None:
+            await self.backend.stop()
+        self.loop = None
+
+    def publish_threadsafe(self, ids):
+        """Вызывается из обработчика коммита - в цикле событий или в потоке пула"""
+        if self.loop is not None and ids:
+            self.loop.call_soon_threadsafe(self._publish, sorted(ids))
+
+    def _publish(self, ids):
+        asyncio.ensure_future(self.backend.publish(ids))
+
+    def on_changed(self, ids):
+        self.stats_dirty = True
+        if not self.subscribers:
+            return
+        self.dirty.update(ids)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(EVENTS_DEBOUNCE)
+        ids, self.dirty = self.dirty, set()
+        try:
+            async with AsyncSessionLocal() as db:
+                rows = await db.execute(select(*OBJECT_FIELDS.values()).where(Object.id.in_(ids)))
+                names = list(OBJECT_FIELDS)
+                current = {row[0]: dict(zip(names, row)) for row in rows}
+                stats = await self.stats(db)
+        except Exception as e:
+            print(f"❌ Не удалось прочитать изменения для подписчиков: {e}")
+            for subscriber in self.subscribers:
+                subscriber.offer("resync", {"type": "resync"})
+            return
+        for object_id in sorted(ids):
+            data = current.get(object_id)
+            event = {"type": "object", "op": "upsert", "id": object_id, "data": data} if data is not None \
+                else {"type": "object", "op": "delete", "id": object_id}
+            for subscriber in self.subscribers:
+                subscriber.offer(("object", object_id), event)
+        for subscriber in self.subscribers:
+            subscriber.offer("stats", {"type": "stats", "data": stats})
+
+    async def stats(self, db):
+        """Сводка пересчитывается только после изменений - не на каждого клиента"""
+        if self.stats_dirty or self.last_stats is None:
+            self.stats_dirty = False
+            self.last_stats = await stats_snapshot(db)
+        return self.last_stats
+
+    async def subscribe(self):
+        subscriber = Subscriber()
+        async with AsyncSessionLocal() as db:
+            subscriber.offer("stats", {"type": "stats", "data": await self.stats(db)})
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+event_hub = EventHub()
+
+def _publish_committed(connection):
+    connection.info.pop("change_log_locked", None)
+    changed = connection.info.pop("changed_objects", None)
+    if changed:
+        event_hub.publish_threadsafe(changed)
+
+def _discard_rolled_back(connection):
+    connection.info.pop("change_log_locked", None)
+    connection.info.pop("changed_objects", None)
+
+for _engine in (engine, async_engine.sync_engine if async_engine is not None else None):
+    if _engine is not None:
+        event.listen(_engine, "commit", _publish_committed)
+        event.listen(_engine, "rollback", _discard_rolled_back)
+
+@app.get("/api/events")
+async def event_stream(request: Request):
+    """Server-Sent Events: object (upsert/delete), stats, resync"""
+    if async_engine is None:
+        raise HTTPException(status_code=503, detail="Async database driver is not installed")
+    subscriber = await event_hub.subscribe()
+
+    async def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                event = await subscriber.get(EVENTS_HEARTBEAT)
+                if event is None:
+                    yield ": ping\n\n"
+                else:
+                    yield f"event: {event['type']}\ndata: {dumps_json(event).decode()}\n\n"
+        finally:
+            event_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # nginx не должен копить поток
+    })
+
+@app.websocket("/api/ws")
+async def event_socket(websocket: WebSocket):
+    """Те же события, что и /api/events, по WebSocket"""
+    await websocket.accept()
+    if async_engine is None:
+        await websocket.close(code=1011)
+        return
+    subscriber = await event_hub.subscribe()
+
+    async def send_events():
+        while True:
+            event = await subscriber.get(EVENTS_HEARTBEAT)
+            await websocket.send_text(dumps_json(event or {"type": "ping"}).decode())
+
+    async def wait_disconnect():
+        # Входящие сообщения не нужны - читаем только чтобы заметить закрытие
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        event_hub.unsubscribe(subscriber)
+
+# HTTP-кэш для читающих endpoints: ETag от версии данных + LRU готовых ответов
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 30))  # секунды
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get("RESPONSE_CACHE_MAX_BODY", 1024 * 1024))  # крупнее - не кэшируется
+CACHED_PATHS = {"/api/objects", "/api/objects/search", "/api/objects/nearby", "/api/objects/clusters", "/api/gantt", "/api/stats", "/api/analytics/schedule"}
+
+class ResponseCache:
+    """LRU сериализованных ответов; запись действительна только для своей версии данных.
+    Отдельно хранится последний ответ по каждому ключу - его не сбрасывает запись,
+    он отдаётся с пометкой устаревшего, пока БД недоступна."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.last_known = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry["version"] != version or entry["expires"] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def stale(self, key):
+        """Последний ответ по ключу без проверки версии и срока - когда БД недоступна"""
+        return self.last_known.get(key)
+
+    def put(self, key, version, status, headers, body):
+        entry = {
+            "version": version,
+            "stored": time.monotonic(),
+            "expires": time.monotonic() + self.ttl,
+            "status": status,
+            "headers": headers,
+            "body": body
+        }
+        for entries in (self.entries, self.last_known):
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+# Записи объектов сбрасывают кэш после коммита; остальные воркеры отсекут
+# устаревшее по версии данных. Сброс до коммита не годится: параллельное чтение
+# успело бы положить в кэш ещё старые данные.
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+@event.listens_for(Session, "after_commit")
+def _clear_cache_after_commit(session):
+    if session.info.pop("objects_written", False):
+        response_cache.clear()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_writes(session):
+    session.info.pop("objects_written", None)
+
+async def data_version(bind):
+    """Версия данных - последний seq журнала изменений. seq выдаётся в порядке коммитов
+    (lock_change_log), поэтому его сдвигает любая закоммиченная запись, удаление тоже;
+    updated_at проставляется до коммита и у параллельных записей идёт не по порядку"""
+    async with bind.connect() as connection:
+        row = (await connection.execute(
+            select(ChangeLog.seq, ChangeLog.changed_at).order_by(ChangeLog.seq.desc()).limit(1)
+        )).first()
+    if row is None:
+        return "0", None
+    return str(row.seq), as_datetime(row.changed_at)
+
+class ConditionalGetMiddleware:
+    """ETag/Last-Modified, ответ 304 на If-None-Match и отдача ответов из LRU"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in CACHED_PATHS or async_engine is None:
+            await self.app(scope, receive, send)
+            return
+        key = scope["path"] + "?" + scope["query_string"].decode("latin-1")
+        # Версия и данные - из одной БД: выбранная здесь реплика передаётся в get_read_db
+        replica = replica_router.choose(scope)
+        scope.setdefault("state", {})["read_replica"] = replica
+        if replica is None and db_breaker.is_open:
+            # БД недоступна - отдаём последний известный ответ с явной пометкой, иначе 503
+            stale = response_cache.stale(key)
+            if stale is None:
+                await self.app(scope, receive, send)
+                return
+            await send({"type": "http.response.start", "status": stale["status"], "headers": stale["headers"] + [
+                (b"cache-control", b"no-store"),
+                (b"age", str(int(time.monotonic() - stale["stored"])).encode()),
+                (b"warning", b'110 - "Response is Stale"'),
+                (b"x-data-stale", b"true")
+            ]})
+            await send({"type": "http.response.body", "body": stale["body"]})
+            return
+        try:
+            version, changed_at = await data_version(replica.engine if replica is not None else async_engine)
+        except Exception:
+            # БД недоступна - кэшировать нечего, пусть обработчик решает сам
+            await self.app(scope, receive, send)
+            return
+
+        if scope["path"] in CLOCK_PATHS:
+            version = f"{version}:{schedule_now().isoformat()}"
+        etag = '"' + hashlib.sha1(f"{key}|{version}".encode()).hexdigest()[:20] + '"'
+        validators = [(b"etag", etag.encode()), (b"cache-control", b"no-cache")]
+        if changed_at is not None:
+            # Только для информации: время записи в журнал ставится до коммита, поэтому
+            # If-Modified-Since не проверяем - условные запросы идут по ETag
+            last_modified = format_datetime(changed_at.replace(tzinfo=timezone.utc), usegmt=True)
+            validators.append((b"last-modified", last_modified.encode()))
+
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match", b"").decode("latin-1")
+        # Сжатый ответ несёт слабый W/-вариант того же ETag (см. CompressionMiddleware)
+        if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            await send({"type": "http.response.start", "status": 304, "headers": validators})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        cached = response_cache.get(key, version)
+        if cached is not None:
+            await send({"type": "http.response.start", "status": cached["status"], "headers": cached["headers"] + validators})
+            await send({"type": "http.response.body", "body": cached["body"]})
+            return
+
+        headers = []
+        chunks = []
+        captured = 0
+
+        async def capture_send(message):
+            nonlocal headers, chunks, captured
+            if message["type"] == "http.response.start":
+                response_headers = {name.lower(): value for name, value in message.get("headers", [])}
+                length = response_headers.get(b"content-length")
+                # Кэшируется только готовый JSON известной длины; потоки (NDJSON) и крупные
+                # ответы идут мимо, не накапливаясь в памяти
+                if (
+                    message["status"] == 200
+                    and response_headers.get(b"content-type", b"").startswith(b"application/json")
+                    and b"content-encoding" not in response_headers
+                    and length is not None and int(length) <= RESPONSE_CACHE_MAX_BODY
+                ):
+                    headers = [(name, response_headers[name]) for name in (b"content-type", b"content-length")]
+                message = dict(message, headers=list(message.get("headers", [])) + validators)
+            elif message["type"] == "http.response.body" and headers:
+                body = message.get("body", b"")
+                captured += len(body)
+                if captured > RESPONSE_CACHE_MAX_BODY:
+                    headers, chunks = [], []
+                else:
+                    chunks.append(body)
+                    if not message.get("more_body", False):
+                        response_cache.put(key, version, 200, headers, b"".join(chunks))
+            await send(message)
+
+        await self.app(scope, receive, capture_send)
+
+app.add_middleware(ConditionalGetMiddleware)
+
+# Сжатие ответов по Accept-Encoding: zstd/brotli (если установлены) или gzip.
+# JSON списков объектов состоит из повторяющихся ключей и кириллицы и жмётся в 5-10 раз -
+# заметная экономия на медленной мобильной связи прорабов.
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))  # меньшие ответы сжимать невыгодно
+COMPRESS_THREADPOOL_SIZE = int(os.environ.get("COMPRESS_THREADPOOL_SIZE", 64 * 1024))  # крупнее - сжимаем вне event loop
+COMPRESS_ENCODINGS = [name.strip() for name in os.environ.get("COMPRESS_ENCODINGS", "zstd,br,gzip").split(",") if name.strip()]
+COMPRESS_CACHE_SIZE = int(os.environ.get("COMPRESS_CACHE_SIZE", 64))  # сжатых вариантов ответов с ETag
+COMPRESSIBLE_TYPES = (b"application/json", b"application/x-ndjson", b"text/csv", b"text/html", b"text/plain", b"application/javascript")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class _GzipStream:
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 - формат gzip
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+class _ZstdStream:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+# Уровни подобраны для динамических ответов: степень сжатия близка к максимальной
+# при единицах миллисекунд на сотни килобайт
+ENCODERS = {"gzip": (lambda body: gzip.compress(body, compresslevel=6), _GzipStream)}
+if brotli is not None:
+    ENCODERS["br"] = (lambda body: brotli.compress(body, quality=4), _BrotliStream)
+if zstandard is not None:
+    ENCODERS["zstd"] = (lambda body: zstandard.ZstdCompressor(level=3).compress(body), _ZstdStream)
+compression_totals = {}  # encoding -> [байт до, байт после]
+
+def negotiate_encoding(accept_encoding):
+    """Лучшее из поддерживаемых сжатий по q-весам Accept-Encoding; при равных весах - порядок COMPRESS_ENCODINGS"""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for name in COMPRESS_ENCODINGS:
+        weight = weights.get(name, weights.get("*", 0.0))
+        if name in ENCODERS and weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+class CompressionMiddleware:
+    """Сжатие JSON/текста по Accept-Encoding; потоковые ответы (NDJSON) жмутся по ходу отдачи"""
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = OrderedDict()  # (etag, encoding) -> сжатое тело
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"))
+        state = {"start": None, "stream": None}
+
+        async def compress_send(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                names = {name.lower() for name, _ in headers}
+                content_type = dict((name.lower(), value) for name, value in headers).get(b"content-type", b"")
+                if message["status"] < 200 or message["status"] in (204, 206, 304) or b"content-encoding" in names \
+                        or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    # SSE, картинки, архивы и уже сжатое - как есть
+                    await send(message)
+                    return
+                state["start"] = dict(message, headers=[(name, value) for name, value in headers if name.lower() != b"vary"]
+                                      + [(b"vary", merge_vary(headers))])
+                if encoding is None:
+                    await send(state.pop("start"))
+                return
+            if message["type"] != "http.response.body" or state.get("start") is None and state["stream"] is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if state["stream"] is None:
+                start = state.pop("start")
+                if not more_body:
+                    if len(body) < COMPRESS_MIN_SIZE:
+                        await send(start)
+                        await send(message)
+                        return
+                    compressed = await self.compress(encoding, body, start["headers"])
+                    await send(dict(start, headers=encoded_headers(start["headers"], encoding, len(compressed))))
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                # Длина потока заранее неизвестна - сжимаем по ходу, без Content-Length
+                state["stream"] = ENCODERS[encoding][1]()
+                await send(dict(start, headers=encoded_headers(start["headers"], encoding, None)))
+            chunk = state["stream"].compress(body)
+            if not more_body:
+                chunk += state["stream"].finish()
+            totals = compression_totals.setdefault(encoding, [0, 0])
+            totals[0] += len(body)
+            totals[1] += len(chunk)
+            if chunk or not more_body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, compress_send)
+
+    async def compress(self, encoding, body, headers):
+        """Сжатие целого тела; ответы с ETag не пережимаются, пока данные не изменились"""
+        etag = dict((name.lower(), value) for name, value in headers).get(b"etag")
+        key = (etag, encoding)
+        if etag is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        compress = ENCODERS[encoding][0]
+        # zlib, brotli и zstd отпускают GIL - крупные тела жмём в пуле потоков
+        compressed = await run_in_threadpool(compress, body) if len(body) >= COMPRESS_THREADPOOL_SIZE else compress(body)
+        totals = compression_totals.setdefault(encoding, [0, 0])
+        totals[0] += len(body)
+        totals[1] += len(compressed)
+        if etag is not None and COMPRESS_CACHE_SIZE > 0:
+            self.cache[key] = compressed
+            while len(self.cache) > COMPRESS_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return compressed
+
+def merge_vary(headers):
+    """Vary с добавленным Accept-Encoding: кэши не должны отдать сжатое клиенту без поддержки"""
+    values = [value.decode("latin-1") for name, value in headers if name.lower() == b"vary"]
+    fields = [field.strip() for value in values for field in value.split(",") if field.strip()]
+    if "accept-encoding" not in [field.lower() for field in fields]:
+        fields.append("Accept-Encoding")
+    return ", ".join(fields).encode("latin-1")
+
+def encoded_headers(headers, encoding, length):
+    """Заголовки сжатого ответа: Content-Encoding, новая длина и слабый ETag (байты уже другие)"""
+    result = [(b"content-encoding", encoding.encode())]
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered == b"content-length":
+            continue
+        if lowered == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        result.append((name, value))
+    if length is not None:
+        result.append((b"content-length", str(length).encode()))
+    return result
+
+app.add_middleware(CompressionMiddleware)
+
+# Допуск запросов: корзина токенов на клиента и лимит одновременных запросов на класс
+# маршрутов с ограниченной очередью. Всё сверх очереди получает 503 сразу, не дожидаясь
+# исчерпания пула БД, - отчёты прорабов (класс field) не стоят в очереди за дашбордами.
+# Лимиты действуют в каждом воркере отдельно.
+RATE_LIMIT_RPS = float(os.environ.get("RATE_LIMIT_RPS", 20))  # запросов в секунду на клиента, 0 - без лимита
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 60))  # запас на всплеск
+RATE_LIMIT_CLIENTS = 10000  # клиентов в памяти, давно молчащие вытесняются
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))  # прокси перед сервером (Railway - 1); 0 - X-Forwarded-For не читаем
+ADMISSION_CONCURRENCY = os.environ.get("ADMISSION_CONCURRENCY", "read=24,write=8,field=8,heavy=2")
+ADMISSION_QUEUE_FACTOR = int(os.environ.get("ADMISSION_QUEUE_FACTOR", 2))  # глубина очереди = лимит * N
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 2))  # секунд ожидания в очереди
+ROUTE_COST = {"read": 1, "write": 1, "field": 1, "heavy": 10}  # токенов за запрос
+ADMISSION_EXEMPT = {"/", "/livez", "/readyz", "/api/health", "/metrics", "/api/events", "/docs", "/redoc", "/openapi.json"}
+
+def admission_class(scope):
+    """Класс маршрута: read, write, field (отчёты и фото с объектов), heavy; None - без ограничений"""
+    path, method = scope["path"], scope["method"]
+    if path in ADMISSION_EXEMPT or method == "OPTIONS":
+        return None
+    if method in ("GET", "HEAD"):
+        if path == "/api/objects" and b"format=ndjson" in scope["query_string"]:
+            return "heavy"
+        return "read"
+    if path.startswith(("/api/reports", "/api/uploads/")) or path == "/api/sync":
+        return "field"
+    if path == "/api/exports" or (path == "/api/objects" and method in ("POST", "PUT")):
+        return "heavy"
+    return "write"
+
+def client_key(scope):
+    """Клиент для лимита - адрес соединения. За TRUSTED_PROXIES прокси - адрес из
+    X-Forwarded-For: каждый прокси дописывает в конец адрес своего собеседника, поэтому
+    N-й с конца записал наш крайний доверенный прокси, а всё левее клиент мог подставить сам.
+    Authorization в ключ не входит: сервер токены не проверяет, и случайный токен на каждый
+    запрос давал бы новую корзину. Ключ по токену - только когда появится его проверка."""
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    if TRUSTED_PROXIES > 0:
+        forwarded = [
+            item.strip()
+            for name, value in scope["headers"] if name == b"x-forwarded-for"
+            for item in value.decode("latin-1").split(",")
+        ]
+        # Записей меньше, чем прокси, - запрос пришёл в обход цепочки, доверяем только соединению
+        if len(forwarded) >= TRUSTED_PROXIES and forwarded[-TRUSTED_PROXIES]:
+            address = forwarded[-TRUSTED_PROXIES]
+    return "ip:" + address
+
+class TokenBuckets:
+    """Корзины токенов по клиентам (LRU, не больше max_clients)"""
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # client -> (токены, время пополнения)
+
+    def take(self, client, cost):
+        """0 - запрос проходит, иначе секунд до появления нужных токенов"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (min(cost, self.burst) - tokens) / self.rate
+        self.buckets[client] = (tokens, now)
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+class AdmissionGate:
+    """Не больше limit одновременных запросов класса; ещё queue_depth ждут освобождения
+    слота не дольше ADMISSION_QUEUE_TIMEOUT, остальные отклоняются сразу"""
+
+    def __init__(self, limit, queue_depth):
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.in_flight = 0
+        self.waiters = deque()
+        self.service_time = 0.05  # скользящее среднее времени обработки, секунд
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return True
+        if len(self.waiters) >= self.queue_depth:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, ADMISSION_QUEUE_TIMEOUT)
+            return True
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам, но клиент ушёл - отдаём следующему
+                self.release(None)
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self, elapsed):
+        if elapsed is not None:
+            self.service_time = self.service_time * 0.9 + elapsed * 0.1
+        # Слот переходит первому в очереди, in_flight не меняется
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def retry_after(self):
+        """Оценка, через сколько секунд очередь рассосётся"""
+        return max(1, math.ceil((len(self.waiters) + 1) * self.service_time / max(self.limit, 1)))
+
+def parse_admission_limits(value):
+    limits = {"read": 24, "write": 8, "field": 8, "heavy": 2}
+    for part in value.split(","):
+        name, _, number = part.partition("=")
+        if name.strip() in limits and number.strip().isdigit():
+            limits[name.strip()] = int(number)
+    return limits
+
+rate_buckets = TokenBuckets(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_CLIENTS)
+admission_gates = {
+    name: AdmissionGate(limit, limit * ADMISSION_QUEUE_FACTOR)
+    for name, limit in parse_admission_limits(ADMISSION_CONCURRENCY).items()
+}
+admission_rejected = {}  # (класс, причина) -> количество
+
+class AdmissionMiddleware:
+    """429 при превышении лимита клиента, 503 при переполненной очереди класса; оба с Retry-After"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route_class = admission_class(scope) if scope["type"] == "http" else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+        if RATE_LIMIT_RPS > 0:
+            wait = rate_buckets.take(client_key(scope), ROUTE_COST[route_class])
+            if wait > 0:
+                await self.reject(send, route_class, 429, "Rate limit exceeded", math.ceil(wait))
+                return
+        gate = admission_gates[route_class]
+        if not await gate.acquire():
+            await self.reject(send, route_class, 503, "Server is overloaded, retry later", gate.retry_after())
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release(time.perf_counter() - started)
+
+    async def reject(self, send, route_class, status, detail, retry_after):
+        key = (route_class, "rate_limit" if status == 429 else "overload")
+        admission_rejected[key] = admission_rejected.get(key, 0) + 1
+        body = dumps_json({"detail": detail, "retry_after": retry_after})
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode())
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+app.add_middleware(AdmissionMiddleware)
+
+# Метрики производительности: гистограммы по маршрутам, счётчики SQL, /metrics
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))  # порог лога медленных запросов
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(pairs):
+    return ",".join(f'{name}="{_label_value(value)}"' for name, value in pairs)
+
+class Histogram:
+    """Гистограмма в формате Prometheus; серии различаются набором меток"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{{{_labels(labels + (('le', bound),))}}} {count}")
+            lines.append(f"{self.name}_bucket{{{_labels(labels + (('le', '+Inf'),))}}} {series['count']}")
+            lines.append(f"{self.name}_sum{{{_labels(labels)}}} {series['sum']}")
+            lines.append(f"{self.name}_count{{{_labels(labels)}}} {series['count']}")
+        return lines
+
+request_latency = Histogram("vega_http_request_duration_seconds", "Request latency by route", LATENCY_BUCKETS)
+response_size = Histogram("vega_http_response_size_bytes", "Response body size by route", SIZE_BUCKETS)
+request_queries = Histogram("vega_db_queries_per_request", "SQL statements per request by route (N+1 detector)", QUERY_COUNT_BUCKETS)
+requests_total = {}  # (route, method, status) -> count
+http_in_flight = {"value": 0}
+db_totals = {"queries": 0, "seconds": 0.0, "slow": 0}
+
+# SQL-время текущего HTTP-запроса; словарь общий для всех задач запроса
+request_db_timing = contextvars.ContextVar("request_db_timing", default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    db_totals["queries"] += 1
+    db_totals["seconds"] += elapsed
+    timing = request_db_timing.get()
+    if timing is not None:
+        timing["queries"] += 1
+        timing["seconds"] += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        db_totals["slow"] += 1
+        print(f"🐢 Медленный запрос {elapsed * 1000:.1f} мс: {' '.join(statement.split())[:1000]}")
+
+def _query_failed(exception_context):
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+for _engine in [engine] + ([async_engine.sync_engine] if async_engine is not None else []):
+    event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(_engine, "handle_error", _query_failed)
+
+def route_template(scope):
+    """Шаблон маршрута (/api/objects/{object_id}), чтобы id не плодили серии метрик"""
+    route = scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    for candidate in app.router.routes:
+        match, _ = candidate.matches(scope)
+        if match == Match.FULL:
+            return getattr(candidate, "path", scope["path"])
+    return "unmatched"
+
+class MetricsMiddleware:
+    """Латентность, размер ответа, число SQL на запрос и заголовок Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = {"queries": 0, "seconds": 0.0}
+        token = request_db_timing.set(timing)
+        started = time.perf_counter()
+        result = {"status": 500, "size": 0}
+        http_in_flight["value"] += 1
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                result["status"] = message["status"]
+                server_timing = (
+                    f"app;dur={(time.perf_counter() - started) * 1000:.1f}, "
+                    f'db;dur={timing["seconds"] * 1000:.1f};desc="{timing["queries"]} queries"'
+                )
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"server-timing", server_timing.encode())])
+            elif message["type"] == "http.response.body":
+                result["size"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            http_in_flight["value"] -= 1
+            request_db_timing.reset(token)
+            route = route_template(scope)
+            key = (route, scope["method"], result["status"])
+            requests_total[key] = requests_total.get(key, 0) + 1
+            labels = (("route", route), ("method", scope["method"]))
+            request_latency.observe(labels, time.perf_counter() - started)
+            response_size.observe(labels, result["size"])
+            request_queries.observe(labels, timing["queries"])
+
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    lines = ["# HELP vega_http_requests_total Requests by route, method and status", "# TYPE vega_http_requests_total counter"]
+    for (route, method, status), count in sorted(requests_total.items()):
+        lines.append(f"vega_http_requests_total{{{_labels((('route', route), ('method', method), ('status', status)))}}} {count}")
+    lines += ["# HELP vega_http_requests_in_flight Requests being processed", "# TYPE vega_http_requests_in_flight gauge",
+              f"vega_http_requests_in_flight {http_in_flight['value']}"]
+    lines += request_latency.render() + response_size.render() + request_queries.render()
+    lines += [
+        "# HELP vega_db_queries_total SQL statements executed", "# TYPE vega_db_queries_total counter",
+        f"vega_db_queries_total {db_totals['queries']}",
+        "# HELP vega_db_query_seconds_total Time spent in SQL statements", "# TYPE vega_db_query_seconds_total counter",
+        f"vega_db_query_seconds_total {db_totals['seconds']}",
+        "# HELP vega_db_slow_queries_total Statements slower than SLOW_QUERY_MS", "# TYPE vega_db_slow_queries_total counter",
+        f"vega_db_slow_queries_total {db_totals['slow']}",
+        "# HELP vega_db_pool_in_use Connections checked out of the async pool", "# TYPE vega_db_pool_in_use gauge",
+        f"vega_db_pool_in_use {pool_metrics['in_use']}",
+        "# HELP vega_db_pool_timeouts_total Pool checkout timeouts", "# TYPE vega_db_pool_timeouts_total counter",
+        f"vega_db_pool_timeouts_total {pool_metrics['timeouts']}",
+        "# HELP vega_response_cache_hits_total Response cache hits", "# TYPE vega_response_cache_hits_total counter",
+        f"vega_response_cache_hits_total {response_cache.hits}",
+        "# HELP vega_response_cache_misses_total Response cache misses", "# TYPE vega_response_cache_misses_total counter",
+        f"vega_response_cache_misses_total {response_cache.misses}",
+        "# HELP vega_db_up Last background database probe succeeded", "# TYPE vega_db_up gauge",
+        f"vega_db_up {int(database_state()[0])}",
+        "# HELP vega_db_breaker_trips_total Times the database circuit breaker opened", "# TYPE vega_db_breaker_trips_total counter",
+        f"vega_db_breaker_trips_total {db_breaker.trips}",
+        "# HELP vega_db_reads_total Read-endpoint sessions by target database", "# TYPE vega_db_reads_total counter",
+        f'vega_db_reads_total{{target="primary"}} {replica_router.primary_reads}',
+    ]
+    for replica in replica_router.replicas:
+        lines.append(f"vega_db_reads_total{{{_labels((('target', replica.name),))}}} {replica.reads}")
+    lines += ["# HELP vega_db_replica_lag_seconds Replica lag behind the primary change log", "# TYPE vega_db_replica_lag_seconds gauge"]
+    for replica in replica_router.replicas:
+        if replica.lag is not None:
+            lines.append(f"vega_db_replica_lag_seconds{{{_labels((('replica', replica.name),))}}} {replica.lag}")
+    lines += [
+        "# HELP vega_admission_in_flight Requests admitted per route class", "# TYPE vega_admission_in_flight gauge",
+    ]
+    for name, gate in admission_gates.items():
+        lines.append(f"vega_admission_in_flight{{{_labels((('class', name),))}}} {gate.in_flight}")
+    lines += ["# HELP vega_admission_queued Requests waiting for a slot per route class", "# TYPE vega_admission_queued gauge"]
+    for name, gate in admission_gates.items():
+        lines.append(f"vega_admission_queued{{{_labels((('class', name),))}}} {len(gate.waiters)}")
+    lines += ["# HELP vega_admission_rejected_total Requests rejected by rate limit or load shedding", "# TYPE vega_admission_rejected_total counter"]
+    for (name, reason), count in sorted(admission_rejected.items()):
+        lines.append(f"vega_admission_rejected_total{{{_labels((('class', name), ('reason', reason)))}}} {count}")
+    lines += [
+        "# HELP vega_compression_bytes_total Response bytes before and after compression", "# TYPE vega_compression_bytes_total counter",
+    ]
+    for encoding, (raw, compressed) in sorted(compression_totals.items()):
+        lines.append(f"vega_compression_bytes_total{{{_labels((('encoding', encoding), ('stage', 'in')))}}} {raw}")
+        lines.append(f"vega_compression_bytes_total{{{_labels((('encoding', encoding), ('stage', 'out')))}}} {compressed}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# CORS подключаем последним: он должен оборачивать все middleware выше (в т.ч. ответы 304)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Write-Seq", "X-Data-Stale"],  # PWA читает seq своей записи и пометку устаревших данных
+)
+
+# Production-запуск: несколько воркеров на все выделенные контейнеру ядра
+def available_cpus():
+    """Ядра, доступные процессу, с учётом cpuset и квоты cgroup v2"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 30))  # секунд на завершение активных запросов
+
+try:
+    from uvicorn_worker import UvicornWorker as _BaseWorker
+except ImportError:
+    try:
+        from uvicorn.workers import UvicornWorker as _BaseWorker
+    except ImportError:
+        _BaseWorker = None
+
+if _BaseWorker is not None:
+    class VegaWorker(_BaseWorker):
+        """uvicorn-воркер с uvloop и httptools, если они установлены"""
+        CONFIG_KWARGS = {
+            "loop": "uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+            "http": "httptools" if importlib.util.find_spec("httptools") else "h11",
+            "lifespan": "on",
+        }
+
+def run_production(port, workers):
+    """Gunicorn-мастер с uvicorn-воркерами: приложение и схема готовятся один раз до fork,
+    SIGHUP - плавная замена воркеров, SIGTERM - дожидаемся активных запросов"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+    if BaseApplication is None or _BaseWorker is None:
+        # Без gunicorn (например, Windows) - встроенный менеджер процессов uvicorn;
+        # схему по-прежнему защищает schema_lock
+        import uvicorn
+        print("⚠️ gunicorn не установлен, запускаю воркеры uvicorn без preload")
+        uvicorn.run("railway_server:app", host="0.0.0.0", port=port, workers=workers,
+                    timeout_graceful_shutdown=GRACEFUL_TIMEOUT)
+        return
+
+    # Схема и тестовые данные - один раз, в мастере
+    create_tables()
+    # Соединения, открытые мастером, не должны достаться воркерам
+    engine.dispose()
+
+    def post_fork(server, worker):
+        engine.dispose(close=False)
+        if async_engine is not None:
+            async_engine.sync_engine.dispose(close=False)
+        for replica in replica_router.replicas:
+            replica.engine.sync_engine.dispose(close=False)
+
+    class VegaApplication(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"0.0.0.0:{port}",
+                "workers": workers,
+                "worker_class": VegaWorker,
+                "preload_app": True,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "timeout": GRACEFUL_TIMEOUT + 30,
+                "keepalive": 5,
+                "max_requests": int(os.environ.get("MAX_REQUESTS", 0)),
+                "max_requests_jitter": int(os.environ.get("MAX_REQUESTS_JITTER", 0)),
+                "post_fork": post_fork,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    VegaApplication().run()
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
+    production = "--production" in sys.argv or os.environ.get("SERVER_MODE") == "production"
+    if "--migrate" in sys.argv:
+        # Отдельный шаг деплоя: миграции до запуска новых воркеров
+        create_tables()
+        sys.exit(0 if schema_ready else 1)
     print(f"🚀 Запуск Vega CRM сервера на порту {port}")
     print(f"📊 База данных: {DATABASE_URL[:50]}...")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if production:
+        workers = int(os.environ.get("WEB_CONCURRENCY", available_cpus()))
+        print(f"⚙️ Production-режим: {workers} воркеров")
+        run_production(port, workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Тесты railway_server на временной SQLite-базе: python -m pytest -q
+"""
+
+import hashlib
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+# Настройки читаются при импорте сервера - задаём их до него
+TEST_DIR = tempfile.mkdtemp(prefix="vega_test_")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DIR}/vega.db"
+os.environ["PHOTO_DIR"] = os.path.join(TEST_DIR, "uploads")
+os.environ["EXPORT_DIR"] = os.path.join(TEST_DIR, "exports")
+os.environ["RATE_LIMIT_RPS"] = "0"  # лимиты проверяются отдельным экземпляром middleware
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select, func
+
+import railway_server as rs
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(rs.app) as test_client:
+        yield test_client
+
+
+def create_object(client, **fields):
+    response = client.post("/api/objects", json=dict({"name": "Резервуар", "location": "Сургут"}, **fields))
+    assert response.status_code == 201, response.text
+    assert response.json()["failed"] == 0, response.json()
+    return response.json()["ids"][0]
+
+
+def assert_stats_consistent():
+    """Сводки object_stats и customer_stats совпадают с пересчётом по objects"""
+    with rs.engine.connect() as connection:
+        expected = {
+            status or "": (count, int(budget))
+            for status, count, budget in connection.execute(
+                select(rs.Object.status, func.count(), func.coalesce(func.sum(rs.Object.budget), 0)).group_by(rs.Object.status)
+            )
+        }
+        summary = {
+            row.status: (row.count, row.budget_sum)
+            for row in connection.execute(select(rs.ObjectStats))
+            if row.count or row.budget_sum
+        }
+        assert summary == expected
+
+        expected = {
+            (customer_id, status or ""): (count, int(budget), int(progress))
+            for customer_id, status, count, budget, progress in connection.execute(
+                select(
+                    rs.Object.customer_id, rs.Object.status, func.count(),
+                    func.coalesce(func.sum(rs.Object.budget), 0), func.coalesce(func.sum(rs.Object.progress), 0)
+                ).where(rs.Object.customer_id.isnot(None)).group_by(rs.Object.customer_id, rs.Object.status)
+            )
+        }
+        summary = {
+            (row.customer_id, row.status): (row.count, row.budget_sum, row.progress_sum)
+            for row in connection.execute(select(rs.CustomerStats))
+            if row.count or row.budget_sum or row.progress_sum
+        }
+        assert summary == expected
+
+
+def test_stats_follow_every_write_path(client):
+    object_id = create_object(client, customer="ООО Сводка", budget=1000, status="planning")
+    assert_stats_consistent()
+
+    response = client.post("/api/objects", json=[
+        {"name": f"Пакет {index}", "customer": "ООО Сводка", "budget": 100 * index, "status": "in_progress", "progress": index}
+        for index in range(5)
+    ])
+    assert response.json()["created"] == 5
+    assert_stats_consistent()
+
+    response = client.put("/api/objects", json=[
+        {"id": object_id, "name": "Резервуар", "customer": "АО Другой", "budget": 5000, "status": "completed", "progress": 100},
+        {"name": "Новый через upsert", "budget": 70}
+    ])
+    assert (response.json()["created"], response.json()["updated"]) == (1, 1)
+    assert_stats_consistent()
+
+    response = client.patch(f"/api/objects/{object_id}", json={"status": "in_progress", "budget": 10, "progress": 30})
+    assert response.status_code == 200
+    assert_stats_consistent()
+
+    response = client.post("/api/sync", json={"changes": [{"entity": "object", "op": "delete", "id": object_id}]})
+    assert response.json()["results"][0]["status"] == "deleted"
+    assert_stats_consistent()
+
+    stats = client.get("/api/stats").json()
+    with rs.engine.connect() as connection:
+        assert stats["total_objects"] == connection.execute(select(func.count()).select_from(rs.Object)).scalar()
+
+
+def test_etag_not_modified_until_write(client):
+    first = client.get("/api/stats")
+    etag = first.headers["etag"]
+    assert client.get("/api/stats", headers={"If-None-Match": etag}).status_code == 304
+
+    create_object(client, status="completed", budget=1)
+    second = client.get("/api/stats", headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["etag"] != etag
+    assert second.json()["completed"] == first.json()["completed"] + 1
+
+
+
+def test_etag_follows_commit_order_not_updated_at(client):
+    """Запись, проставившая updated_at раньше уже закоммиченной, но закоммиченная позже,
+    тоже меняет версию: max(updated_at) и число строк при этом не меняются"""
+    object_id = create_object(client)
+    create_object(client)
+    etag = client.get("/api/objects").headers["etag"]
+    with rs.SessionLocal() as db:
+        obj = db.get(rs.Object, object_id)
+        obj.name = "Резервуар, переименован"
+        obj.updated_at = rs.datetime(2000, 1, 1)
+        db.commit()
+    response = client.get("/api/objects", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "Резервуар, переименован" in response.text
+
+def test_cache_skips_streams_and_keeps_stale_copy(client):
+    client.get("/api/objects", params={"format": "ndjson"})
+    assert not any("format=ndjson" in key for key in rs.response_cache.entries)
+
+    client.get("/api/objects", params={"limit": 5})
+    key = "/api/objects?limit=5"
+    assert key in rs.response_cache.entries
+    object_id = create_object(client)
+    # Запись сбрасывает кэш, но последний ответ остаётся для отдачи при недоступной БД
+    assert key not in rs.response_cache.entries
+    assert rs.response_cache.stale(key) is not None
+
+    client.get("/api/objects", params={"limit": 5})
+    client.patch(f"/api/objects/{object_id}", json={"progress": 5})
+    assert key not in rs.response_cache.entries
+
+
+def test_bulk_import_reports_bad_rows_by_index(client):
+    body = "\n".join([
+        '{"name": "Пакет NDJSON 1", "status": "planning"}',
+        '{"name": "", "status": "planning"}',
+        'не JSON',
+        '{"name": "Пакет NDJSON 2", "start_date": "2030-01-01", "end_date": "2020-01-01"}',
+        '{"name": "Пакет NDJSON 3", "status": "completed", "budget": 10}',
+    ])
+    response = client.post("/api/objects", content=body.encode(), headers={"Content-Type": "application/x-ndjson"})
+    report = response.json()
+    assert (report["received"], report["created"], report["failed"]) == (5, 2, 3)
+    assert [error["index"] for error in report["errors"]] == [1, 2, 3]
+
+    # id назначает сервер; заменить существующие строки можно только через PUT
+    response = client.post("/api/objects", json={"id": report["ids"][0], "name": "Чужой id"})
+    assert response.json()["failed"] == 1
+    response = client.put("/api/objects", json=[{"id": report["ids"][0], "name": "Заменён"}, {"id": 900000, "name": "Новый с id"}])
+    assert (response.json()["updated"], response.json()["created"]) == (1, 1)
+    assert_stats_consistent()
+
+
+def test_photo_upload_offsets_and_resume(client):
+    object_id = create_object(client)
+    report_id = client.post("/api/reports", json={"object_id": object_id, "text": "Отчёт"}).json()["id"]
+    data = os.urandom(1000)
+    sha256 = hashlib.sha256(data).hexdigest()
+    upload = client.post(f"/api/reports/{report_id}/photos", json={"size": len(data), "sha256": sha256}).json()
+    url = f"/api/uploads/{upload['upload_id']}"
+
+    response = client.patch(url, content=data[:400], headers={"Upload-Offset": "0"})
+    assert response.headers["upload-offset"] == "400"
+    assert client.patch(url, content=b"x", headers={"Upload-Offset": "abc"}).status_code == 400
+    response = client.patch(url, content=data[:400], headers={"Upload-Offset": "0"})
+    assert (response.status_code, response.headers["upload-offset"]) == (409, "400")
+
+    # Оборванная запись оставила хвост за принятым смещением - он отбрасывается
+    with open(rs.partial_path(upload["upload_id"]), "ab") as part:
+        part.write(b"garbage")
+    assert client.head(url).headers["upload-offset"] == "400"
+    response = client.patch(url, content=data[400:], headers={"Upload-Offset": "400"})
+    assert response.json()["complete"] is True
+    assert client.get(f"/api/photos/{response.json()['photo_id']}").content == data
+
+    # Тот же файл повторно не загружается
+    again = client.post(f"/api/reports/{report_id}/photos", json={"size": len(data), "sha256": sha256}).json()
+    assert again["complete"] is True and again["offset"] == len(data)
+
+
+def test_photo_upload_chunk_is_exclusive(client):
+    object_id = create_object(client)
+    report_id = client.post("/api/reports", json={"object_id": object_id}).json()["id"]
+    upload = client.post(f"/api/reports/{report_id}/photos", json={"size": 10}).json()
+    # Кусок уже пишет другой воркер - второй писатель получает 409
+    with rs.engine.begin() as connection:
+        connection.execute(
+            rs.PhotoUpload.__table__.update().where(rs.PhotoUpload.id == upload["upload_id"])
+            .values(writing_since=rs.datetime.utcnow())
+        )
+    response = client.patch(f"/api/uploads/{upload['upload_id']}", content=b"0123456789", headers={"Upload-Offset": "0"})
+    assert response.status_code == 409
+
+
+def test_sync_pull_push_and_conflicts(client):
+    since = client.get("/api/sync", params={"since": 0, "limit": 5000}).json()["next_since"]
+    object_id = create_object(client, name="Синхронизация")
+    pulled = client.get("/api/sync", params={"since": since}).json()
+    assert [(change["id"], change["op"]) for change in pulled["changes"]] == [(object_id, "upsert")]
+    base_seq = pulled["next_since"]
+
+    response = client.post("/api/sync", json={"changes": [
+        {"entity": "object", "op": "update", "id": object_id, "base_seq": base_seq, "data": {"progress": 10}},
+        # Вторая правка той же записи из той же пачки - своя, не конфликт
+        {"entity": "object", "op": "update", "id": object_id, "base_seq": base_seq, "data": {"progress": 20}},
+        {"entity": "object", "op": "create", "client_id": "tmp-1", "data": {"name": "С планшета"}},
+    ]}).json()
+    assert [result["status"] for result in response["results"]] == ["updated", "updated", "created"]
+    assert response["results"][2]["client_id"] == "tmp-1"
+
+    # Кто-то другой поменял запись после base_seq - правка устройства не применяется
+    client.patch(f"/api/objects/{object_id}", json={"progress": 50})
+    result = client.post("/api/sync", json={"changes": [
+        {"entity": "object", "op": "update", "id": object_id, "base_seq": base_seq, "data": {"progress": 30}}
+    ]}).json()["results"][0]
+    assert result["status"] == "conflict"
+    assert result["server"]["progress"] == 50
+
+    pulled = client.get("/api/sync", params={"since": base_seq}).json()
+    assert {change["id"] for change in pulled["changes"]} == {object_id, response["results"][2]["id"]}
+    assert pulled["has_more"] is False
+
+
+def test_sync_push_validates_like_patch(client):
+    object_id = create_object(client, start_date="2026-01-01T00:00:00", end_date="2026-06-01T00:00:00")
+    results = client.post("/api/sync", json={"changes": [
+        {"entity": "object", "op": "update", "id": object_id, "data": {"start_date": "2030-01-01T00:00:00"}},
+        {"entity": "object", "op": "update", "id": object_id, "data": {"latitude": 61.0}},
+        {"entity": "object", "op": "update", "id": object_id, "data": {"progress": 150}},
+        {"entity": "object", "op": "update", "id": object_id, "data": {"progress": 15}},
+    ]}).json()["results"]
+    assert [result["status"] for result in results] == ["error", "error", "error", "updated"]
+    assert "start_date" in results[0]["error"]
+    with rs.engine.connect() as connection:
+        row = connection.execute(select(rs.Object.start_date, rs.Object.latitude, rs.Object.progress).where(rs.Object.id == object_id)).one()
+    assert (row.start_date.year, row.progress) == (2026, 15)
+
+
+def wait_for_export(client, job_id):
+    for _ in range(200):
+        job = client.get(f"/api/exports/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"export {job_id} did not finish")
+
+
+def test_export_dedupe_and_orphaned_jobs(client):
+    object_id = create_object(client)
+    first = client.post("/api/exports", json={"kind": "object", "id": object_id, "format": "csv"}).json()
+    assert wait_for_export(client, first["id"])["status"] == "done"
+    # Те же данные - готовый файл, без нового построения
+    again = client.post("/api/exports", json={"kind": "object", "id": object_id, "format": "csv"})
+    assert again.status_code == 200 and again.json()["status"] == "done"
+
+    # Задание ещё строится (живой воркер) - повторный запрос получает его же
+    with rs.engine.begin() as connection:
+        cache_key = connection.execute(select(rs.ExportJob.cache_key).where(rs.ExportJob.id == first["id"])).scalar()
+        connection.execute(rs.ExportJob.__table__.update().where(rs.ExportJob.id == first["id"]).values(
+            status="running", heartbeat_at=rs.datetime.utcnow()
+        ))
+    os.remove(rs.export_path(cache_key, "csv"))
+    assert client.post("/api/exports", json={"kind": "object", "id": object_id, "format": "csv"}).json()["id"] == first["id"]
+
+    # Воркер задания пропал (рестарт) - задание не держит ключ, отчёт строится заново
+    with rs.engine.begin() as connection:
+        connection.execute(rs.ExportJob.__table__.update().where(rs.ExportJob.id == first["id"]).values(
+            heartbeat_at=rs.datetime.utcnow() - rs.timedelta(seconds=rs.EXPORT_STALE_AFTER + 1)
+        ))
+    retry = client.post("/api/exports", json={"kind": "object", "id": object_id, "format": "csv"}).json()
+    assert retry["id"] != first["id"]
+    assert client.get(f"/api/exports/{first['id']}").json()["status"] == "failed"
+    assert wait_for_export(client, retry["id"])["status"] == "done"
+
+
+def test_risk_responses_revalidate_when_clock_moves(client, monkeypatch):
+    create_object(client, start_date="2026-01-01T00:00:00", end_date="2026-12-01T00:00:00")
+    etag = client.get("/api/gantt").headers["etag"]
+    assert client.get("/api/gantt", headers={"If-None-Match": etag}).status_code == 304
+
+    # Следующий час: те же данные, но флаги риска пересчитываются - 304 и кэш недействительны
+    next_hour = rs.schedule_now() + rs.timedelta(seconds=rs.SCHEDULE_CLOCK_SECONDS)
+    monkeypatch.setattr(rs, "schedule_now", lambda: next_hour)
+    response = client.get("/api/gantt", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_tool_double_checkout_conflicts_and_nearest_first(client):
+    serial = f"T-{time.time_ns()}"
+    near = client.post("/api/tools", json={"name": "Сварочный аппарат", "kind": "welder", "serial": serial, "location": "г. Нефтеюганск, база"})
+    far = client.post("/api/tools", json={"name": "Сварочный аппарат", "kind": "welder", "serial": serial + "-2", "location": "Москва"})
+    assert near.status_code == far.status_code == 201
+    object_id = create_object(client)
+    window = {"from": "2030-01-01T00:00:00", "to": "2030-01-02T00:00:00", "kind": "welder"}
+
+    # Рядом с Сургутом - Нефтеюганск, хотя строка места не совпадает
+    tools = client.get("/api/tools/available", params=dict(window, location="Сургут")).json()["tools"]
+    assert [tool["id"] for tool in tools][:2] == [near.json()["id"], far.json()["id"]]
+    assert tools[0]["distance_km"] < 100 < tools[1]["distance_km"]
+    nearest = client.get("/api/tools/available", params=dict(window, location="Сургут", limit=1)).json()["tools"]
+    assert [tool["id"] for tool in nearest] == [near.json()["id"]]
+
+    checkout = {"object_id": object_id, "starts_at": "2030-01-01T08:00:00", "ends_at": "2030-01-01T18:00:00"}
+    tool_id = near.json()["id"]
+    assert client.post(f"/api/tools/{tool_id}/checkout", json=checkout).status_code == 201
+    response = client.post(f"/api/tools/{tool_id}/checkout", json=dict(checkout, starts_at="2030-01-01T12:00:00"))
+    assert response.status_code == 409
+    assert response.json()["assignment"]["object_id"] == object_id
+    tools = client.get("/api/tools/available", params=dict(window, location="Сургут")).json()["tools"]
+    assert tool_id not in [tool["id"] for tool in tools]
+
+
+def test_migrations_upgrade_baseline_database():
+    """База первой версии (одна таблица objects, без schema_version) доходит до
+    последней миграции и получает ту же схему, что описывают модели"""
+    path = os.path.join(TEST_DIR, "baseline.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE objects (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(200) NOT NULL, "
+            "location VARCHAR(200), customer VARCHAR(200), status VARCHAR(50), budget INTEGER, "
+            "start_date DATETIME, end_date DATETIME, progress INTEGER, description TEXT, "
+            "created_at DATETIME, updated_at DATETIME)"
+        )
+        connection.executemany(
+            "INSERT INTO objects (name, location, customer, status, budget, progress, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                ("Резервуар 1", "г. Сургут", "ООО Альфа", "in_progress", 100, 30, "2026-01-10 00:00:00"),
+                ("Резервуар 2", "Нефтеюганск", "ООО Альфа", "planning", 200, 0, "2026-01-11 00:00:00"),
+                ("Резервуар 3", "Неизвестное место", None, None, None, None, None),
+            ]
+        )
+
+    def run_migrate():
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+        return subprocess.run([sys.executable, rs.__file__, "--migrate"], env=env, capture_output=True, text=True, timeout=120)
+
+    result = run_migrate()
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Миграция 1:" in result.stdout
+
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT max(version) FROM schema_version").fetchone()[0] == rs.MIGRATIONS[-1][0]
+        for table in rs.Base.metadata.sorted_tables:
+            columns = {row[1] for row in connection.execute(f"PRAGMA table_info({table.name})")}
+            assert columns == set(table.columns.keys()), table.name
+        # Существующие объекты остались, тестовые данные не добавлены
+        assert connection.execute("SELECT count(*) FROM objects").fetchone()[0] == 3
+        assert connection.execute("SELECT sum(count), sum(budget_sum) FROM object_stats").fetchone() == (3, 300)
+        assert connection.execute("SELECT count, budget_sum, progress_sum FROM customer_stats").fetchall() == [(1, 100, 30), (1, 200, 0)]
+        assert connection.execute(
+            "SELECT count(*) FROM objects JOIN customers ON customers.id = objects.customer_id WHERE customers.name = 'ООО Альфа'"
+        ).fetchone()[0] == 2
+        assert connection.execute("SELECT count(*) FROM change_log WHERE entity = 'object'").fetchone()[0] >= 3
+        assert connection.execute("SELECT count(*) FROM object_schedule").fetchone()[0] == 3
+        assert connection.execute("SELECT region FROM objects WHERE name = 'Резервуар 1'").fetchone()[0] == "ХМАО"
+        assert connection.execute("SELECT rowid FROM objects_fts WHERE objects_fts MATCH 'нефтеюганск'").fetchall() == [(2,)]
+
+    # Актуальная база - повторный запуск ничего не применяет
+    result = run_migrate()
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Миграция" not in result.stdout
+
+
+def test_rate_limit_keys_on_peer_address(client, monkeypatch):
+    monkeypatch.setattr(rs, "RATE_LIMIT_RPS", 0.01)
+    monkeypatch.setattr(rs, "rate_buckets", rs.TokenBuckets(0.01, 2, 100))
+    assert client.get("/api/stats").status_code == 200
+    assert client.get("/api/stats").status_code == 200
+    # Ни свой X-Forwarded-For, ни новый токен не дают новой корзины
+    response = client.get("/api/stats", headers={"X-Forwarded-For": "203.0.113.7", "Authorization": "Bearer random"})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+
+    # За одним доверенным прокси клиент - последняя запись, подставленное левее не считается
+    monkeypatch.setattr(rs, "TRUSTED_PROXIES", 1)
+    assert client.get("/api/stats", headers={"X-Forwarded-For": "203.0.113.7"}).status_code == 200
+    assert client.get("/api/stats", headers={"X-Forwarded-For": "198.51.100.1, 203.0.113.7"}).status_code == 200
+    assert client.get("/api/stats", headers={"X-Forwarded-For": "198.51.100.2, 203.0.113.7"}).status_code == 429
+    scope = {"client": ("10.0.0.2", 5000), "headers": [(b"x-forwarded-for", b"1.1.1.1, 203.0.113.7")]}
+    assert rs.client_key(scope) == "ip:203.0.113.7"
+    monkeypatch.setattr(rs, "TRUSTED_PROXIES", 3)
+    assert rs.client_key(scope) == "ip:10.0.0.2"
+
+
+def test_benchmark_seed_matches_server_writes():
+    """Засев бенчмарка идёт через пакетную запись сервера: сводки, журнал, прогноз
+    и координаты согласованы с objects, повторный засев заменяет прошлые данные"""
+    path = os.path.join(TEST_DIR, "bench.db")
+    script = (
+        "import benchmark, railway_server\n"
+        "benchmark.seed_database(railway_server, 250, batch_size=100)\n"
+        "benchmark.seed_database(railway_server, 120, batch_size=100)\n"
+    )
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+    result = subprocess.run([sys.executable, "-c", script], env=env, cwd=os.path.dirname(rs.__file__),
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    with sqlite3.connect(path) as connection:
+        def scalar(sql):
+            return connection.execute(sql).fetchone()[0]
+
+        assert scalar("SELECT count(*) FROM objects") == 120
+        assert scalar("SELECT sum(count) FROM object_stats") == 120
+        assert scalar("SELECT sum(budget_sum) FROM object_stats") == scalar("SELECT sum(budget) FROM objects")
+        assert scalar("SELECT sum(count) FROM customer_stats") == 120
+        assert scalar("SELECT count(*) FROM object_schedule") == 120
+        assert scalar("SELECT count(*) FROM objects WHERE latitude IS NULL OR customer_id IS NULL") == 0
+        # Последняя запись журнала о каждом текущем объекте - upsert, об удалённых - delete
+        last_ops = dict(connection.execute(
+            "SELECT entity_id, op FROM change_log WHERE seq IN (SELECT max(seq) FROM change_log WHERE entity = 'object' GROUP BY entity_id)"
+        ).fetchall())
+        current = {row[0] for row in connection.execute("SELECT id FROM objects")}
+        assert {object_id for object_id, op in last_ops.items() if op == "upsert"} == current